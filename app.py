@@ -2,37 +2,114 @@ from flask import Flask, render_template, request, jsonify, send_file, url_for
 import os
 import json
 import uuid
+import threading
 import numpy as np
 from werkzeug.utils import secure_filename
-import torch
 from datetime import datetime
 import traceback
+import multiprocessing
 
-from system.model_inference import ModelInference
-from system.visualization import ResultVisualizer
+import system
 from system.config import SystemConfig
-from system.result_validator import ResultValidator
-from system.report_generator import ReportGenerator
-from system.ai_analyzer import AIAnalyzer
+from system.model_loader import ModelLoader
+from system.worker_pool import InferenceWorkerPool
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'ticnet-system-2024'
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
 app.config['JSON_AS_ASCII'] = False  # 支持中文JSON响应
 
-# 初始化系统组件
+# 初始化系统组件：模型在后台线程中加载和预热，其他组件在首次使用时创建
+# pool_workers > 0时模型副本运行在推理进程池中，Flask进程内不加载模型
 config = SystemConfig()
-model_inference = ModelInference(config)
-visualizer = ResultVisualizer(config)
-validator = ResultValidator(model_inference.annotation_handler)
-report_generator = ReportGenerator(config)
-ai_analyzer = AIAnalyzer()
+model_loader, worker_pool = None, None
+if multiprocessing.parent_process() is None:  # spawn出的副本进程会重新导入本模块
+    if config.INFERENCE_CONFIG.get('pool_workers', 0) > 0:
+        worker_pool = InferenceWorkerPool(config).start()
+    else:
+        model_loader = ModelLoader(config, warmup=config.MODEL_CONFIG.get('warmup', True)).start()
+
+_components = {}
+_components_lock = threading.Lock()
+
+
+def _get_component(name, factory):
+    with _components_lock:
+        if name not in _components:
+            _components[name] = factory()
+        return _components[name]
+
+
+def get_model_inference():
+    return model_loader.get(timeout=config.MODEL_CONFIG.get('load_timeout'))
+
+
+def predict(image_path, task_id):
+    """由推理进程池中空闲的副本或Flask进程内的模型进行推理"""
+    if worker_pool is not None:
+        return worker_pool.predict(image_path, task_id, timeout=config.MODEL_CONFIG.get('load_timeout'))
+    if config.INFERENCE_CONFIG.get('micro_batching', False):
+        return get_batch_scheduler().predict(image_path, task_id)
+    return get_model_inference().predict(image_path, task_id)
+
+
+def get_batch_scheduler():
+    model_inference = get_model_inference()
+    return _get_component('batch_scheduler', lambda: system.BatchScheduler(model_inference).start())
+
+
+def get_annotation_handler():
+    if worker_pool is not None:
+        return _get_component('annotation_handler', lambda: system.AnnotationHandler())
+    return get_model_inference().annotation_handler
+
+
+def get_visualizer():
+    return _get_component('visualizer', lambda: system.ResultVisualizer(config))
+
+
+def get_validator():
+    annotation_handler = get_annotation_handler()
+    return _get_component('validator', lambda: system.ResultValidator(annotation_handler))
+
+
+def get_report_generator():
+    return _get_component('report_generator', lambda: system.ReportGenerator(config))
+
+
+def get_ai_analyzer():
+    return _get_component('ai_analyzer', lambda: system.AIAnalyzer())
 
 # 确保上传和结果目录存在
 os.makedirs(config.UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(config.RESULTS_FOLDER, exist_ok=True)
 os.makedirs(config.VISUALIZATION_FOLDER, exist_ok=True)
 
+@app.route('/healthz')
+def healthz():
+    """存活检查：进程在运行即返回200"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """就绪检查：模型加载并预热完成后返回200，否则返回503"""
+    if worker_pool is not None:
+        status = worker_pool.status
+        body = {'status': status, 'workers': worker_pool.stats()}
+        return jsonify(body), 200 if status == 'ready' else 503
+
+    status = model_loader.status
+    body = {'status': status, 'load_time': model_loader.load_time}
+    if status == 'failed':
+        body['error'] = model_loader.error
+    return jsonify(body), 200 if status == 'ready' else 503
+
+@app.route('/metrics')
+def metrics():
+    """微批调度的排队等待时间和batch填充率"""
+    scheduler = _components.get('batch_scheduler')
+    return jsonify({'batch_scheduler': scheduler.metrics() if scheduler is not None else None})
+
 @app.route('/')
 def index():
     """主页"""
@@ -106,7 +183,7 @@ def preview_file():
         print(f"主文件: {main_filename}")
         
         # 生成预览图像
-        preview_path = visualizer.create_preview(main_file_path, task_id)
+        preview_path = get_visualizer().create_preview(main_file_path, task_id)
         
         if preview_path:
             return jsonify({
@@ -194,10 +271,10 @@ def upload_file():
         print(f"开始处理: {main_file_path}")
         
         # 进行模型推理
-        results = model_inference.predict(main_file_path, task_id)
+        results = predict(main_file_path, task_id)
         
         # 进行结果验证
-        validation_result = validator.validate_detection_results(
+        validation_result = get_validator().validate_detection_results(
             main_file_path, results['detections'], results['meta_info']
         )
         
@@ -205,7 +282,7 @@ def upload_file():
         ground_truth_boxes = []
         if validation_result.get('has_ground_truth', False):
             # 从annotation_handler获取ground truth
-            truth_boxes, truth_labels = model_inference.annotation_handler.get_truth_data_for_image(
+            truth_boxes, truth_labels = get_annotation_handler().get_truth_data_for_image(
                 main_file_path, 
                 results['meta_info']['spacing'],
                 results['meta_info']['origin'], 
@@ -213,14 +290,14 @@ def upload_file():
             )
             ground_truth_boxes = truth_boxes
         
-        visualization_paths = visualizer.create_visualizations(
+        visualization_paths = get_visualizer().create_visualizations(
             main_file_path, results, task_id, ground_truth_boxes=ground_truth_boxes
         )
         
         # 如果有真实标注，创建对比可视化
         if validation_result.get('has_ground_truth', False):
-            image_data = visualizer._load_image(main_file_path)
-            comparison_viz = validator.create_comparison_visualization(
+            image_data = get_visualizer()._load_image(main_file_path)
+            comparison_viz = get_validator().create_comparison_visualization(
                 image_data, results['detections'], validation_result, 
                 task_id, config.VISUALIZATION_FOLDER
             )
@@ -392,7 +469,7 @@ def get_ai_analysis(task_id):
             results = json.load(f)
         
         # 调用AI分析器生成分析
-        analysis_result = ai_analyzer.generate_analysis(results)
+        analysis_result = get_ai_analyzer().generate_analysis(results)
         
         return jsonify(analysis_result)
     
@@ -404,7 +481,7 @@ def get_ai_analysis(task_id):
         try:
             with open(result_file, 'r', encoding='utf-8') as f:
                 results = json.load(f)
-            fallback_text = ai_analyzer._generate_fallback_analysis(results)
+            fallback_text = get_ai_analyzer()._generate_fallback_analysis(results)
             return jsonify({
                 'success': False,
                 'analysis': fallback_text,
@@ -422,7 +499,7 @@ def generate_report(task_id):
     """生成PDF报告（下载）"""
     try:
         # 生成PDF报告
-        report_path = report_generator.generate_report(task_id)
+        report_path = get_report_generator().generate_report(task_id)
         
         # 返回PDF文件
         return send_file(
@@ -442,7 +519,7 @@ def api_generate_report(task_id):
     """生成报告的API接口（异步）"""
     try:
         # 生成报告
-        report_path = report_generator.generate_report(task_id)
+        report_path = get_report_generator().generate_report(task_id)
         
         # 返回报告文件名
         report_filename = os.path.basename(report_path)
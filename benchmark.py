@@ -0,0 +1,447 @@
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+
+from config import net_config, train_config
+from export_model import load_model
+from net.export import RpnBackbone, time_module
+from net.fuse import fuse_for_inference
+from net.layer.rpn_nms import make_rpn_windows
+from net.layer.rpn_target import make_one_rpn_target, make_rpn_target
+from net.layer.util import tensor_nms
+from net.lib.box.nms.sweep_nms import sweep_nms, NMS_METHODS
+from net.lib.box.overlap.sparse_overlap import sparse_box_overlap, sparse_max_overlap
+from utils.util import py_box_overlap
+
+try:
+    from utils.pybox import torch_nms, torch_overlap
+except ImportError:
+    print('Warning: C++ module import failed! Comparing against the python nms and overlap')
+    from utils.util import py_nms as torch_nms
+    from utils.util import py_box_overlap as torch_overlap
+
+parser = argparse.ArgumentParser(description='Latency, memory and parity benchmarks of TiCNet inference')
+parser.add_argument("--weight", type=str, default=train_config['initial_checkpoint'],
+                    help="path to model weights")
+parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                    help="device to run the benchmark on")
+parser.add_argument("--shape", type=str, default=','.join(str(s) for s in net_config['tile_size']),
+                    help="synthetic input volume D,H,W")
+parser.add_argument("--repeat", type=int, default=3,
+                    help="number of timed runs")
+parser.add_argument("--seed", type=int, default=0,
+                    help="seed of the synthetic volume")
+subparsers = parser.add_subparsers(dest='command', required=True)
+
+precision_parser = subparsers.add_parser('precision', help='fp32 vs bf16 autocast inference')
+precision_parser.add_argument("--iou", type=float, default=0.5,
+                              help="overlap to match a bf16 detection with a fp32 detection")
+
+nms_parser = subparsers.add_parser('nms', help='tensor_nms and the sweep nms variants vs the torch_nms extension')
+nms_parser.add_argument("--num-boxes", type=int, nargs='+', default=[1000, 5000, 20000],
+                        help="number of synthetic boxes")
+nms_parser.add_argument("--thresh", type=float, default=0.1,
+                        help="nms overlap threshold")
+
+overlap_parser = subparsers.add_parser('overlap', help='sparse vs dense anchor/truth overlap of rpn targets')
+overlap_parser.add_argument("--num-truths", type=int, nargs='+', default=[1, 4, 16],
+                            help="number of synthetic truth boxes")
+overlap_parser.add_argument("--slab", type=str, default='16,512,512',
+                            help="also time a thin d,h,w crop, where every anchor is within z reach of every "
+                                 "truth box; empty to skip")
+
+targets_parser = subparsers.add_parser('targets', help='per image loop vs batched rpn target generation')
+targets_parser.add_argument("--batch-size", type=int, default=4,
+                            help="number of crops per iteration")
+targets_parser.add_argument("--num-truths", type=int, default=2,
+                            help="number of synthetic truth boxes per crop")
+
+pool_parser = subparsers.add_parser('pool', help='throughput of the inference worker pool with K replicas')
+pool_parser.add_argument("--images", type=str, nargs='+', required=True,
+                         help="scans submitted to the pool, e.g. .mhd or .npy files")
+pool_parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4],
+                         help="number of replicas to compare")
+pool_parser.add_argument("--requests", type=int, default=16,
+                         help="number of requests per run, cycling over the images")
+
+memory_parser = subparsers.add_parser('memory', help='peak memory and throughput of FeatureNet training with checkpointing')
+memory_parser.add_argument("--crop-sizes", type=int, nargs='+', default=[96, 128, 160, 192],
+                           help="cubic crop sizes, multiples of the max stride")
+memory_parser.add_argument("--batch-sizes", type=int, nargs='+', default=[1, 2, 4],
+                           help="number of crops per iteration")
+memory_parser.add_argument("--stages", type=str, nargs='+', default=['none', 'mamba,transformer', 'all'],
+                           help="comma separated checkpoint stages to compare, 'none' or 'all'")
+
+attention_parser = subparsers.add_parser('attention', help='peak memory and parity of the transformer attention implementations')
+attention_parser.add_argument("--grids", type=int, nargs='+', default=[4, 8, 12, 16],
+                              help="cubic bottleneck grid sizes, the input volume divided by 16")
+attention_parser.add_argument("--window-size", type=int, nargs=3, default=net_config['attention_window_size'],
+                              help="window of the 'window' attention")
+
+fuse_parser = subparsers.add_parser('fuse', help='latency and parity of the BatchNorm folding pass')
+
+
+def synthetic_volume(shape, seed):
+    generator = torch.Generator().manual_seed(seed)
+    d, h, w = [int(s) for s in shape.split(',')]
+    return torch.randn(1, 1, d, h, w, generator=generator).clamp(-1, 1)
+
+
+def run(net, inputs, repeat):
+    """
+    Forward inputs through net, return (latency in ms, peak gpu memory in MB or None)
+    """
+    forward = lambda x: net.forward(x, [None] * len(x), [None] * len(x))
+    if inputs.is_cuda:
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+    ms = time_module(forward, inputs, repeat=repeat, warmup=1)
+    mb = torch.cuda.max_memory_allocated() / 1024 / 1024 if inputs.is_cuda else None
+
+    return ms, mb
+
+
+def compare_detections(reference, outputs, iou=0.5):
+    """
+    Match every reference detection [b, p, z, y, x, d, h, w, ...] with the best overlapping
+    output detection of the same image.
+
+    return
+    recall: fraction of reference detections matched with overlap >= iou
+    max_prob_diff: max abs probability difference of the matched pairs
+    """
+    if len(reference) == 0:
+        return (1.0 if len(outputs) == 0 else 0.0), 0.0
+
+    matched, diffs = 0, [0.0]
+    for b in np.unique(reference[:, 0]):
+        ref = reference[reference[:, 0] == b]
+        out = outputs[outputs[:, 0] == b]
+        if len(out) == 0:
+            continue
+        overlap = py_box_overlap(ref[:, 2:8], out[:, 2:8])
+        best = overlap.argmax(1)
+        ok = overlap[np.arange(len(ref)), best] >= iou
+        matched += int(ok.sum())
+        diffs.extend(np.abs(ref[ok, 1] - out[best[ok], 1]).tolist())
+
+    return matched / len(reference), max(diffs)
+
+
+def benchmark_precision(args, net, inputs):
+    results = {}
+    for name, dtype in [('fp32', None), ('bf16', torch.bfloat16)]:
+        net.inference_dtype = dtype
+        ms, mb = run(net, inputs, args.repeat)
+        results[name] = {
+            'ms': ms,
+            'mb': mb,
+            'detections': net.detections.cpu().numpy().copy(),
+            'ensemble': net.ensemble_proposals.cpu().numpy().copy(),
+        }
+
+    for name, res in results.items():
+        memory = f'{res["mb"]:.0f} MB' if res['mb'] is not None else 'n/a'
+        print(f'[{name}] latency {res["ms"]:.1f} ms, peak memory {memory}, '
+              f'detections {len(res["detections"])}')
+
+    print(f'[speedup] {results["fp32"]["ms"] / results["bf16"]["ms"]:.2f}x')
+    for key in ['detections', 'ensemble']:
+        recall, diff = compare_detections(results['fp32'][key], results['bf16'][key], args.iou)
+        print(f'[parity] {key}: {recall:.1%} of fp32 boxes matched at iou {args.iou}, '
+              f'max prob diff {diff:.4f}')
+
+
+def benchmark_fuse(args, net, inputs):
+    fused = fuse_for_inference(copy.deepcopy(net))
+    names = ['fs', 'feat_4', 'logits', 'deltas']
+
+    with torch.no_grad():
+        reference = RpnBackbone(net)(inputs)
+        outputs = RpnBackbone(fused)(inputs)
+    for name, ref, out in zip(names, reference, outputs):
+        diff = (ref - out).abs().max().item()
+        print(f'[parity] {name}: max abs diff {diff:.2e}, max rel diff {diff / max(ref.abs().max().item(), 1e-12):.2e}')
+
+    results = {}
+    for name, model in [('unfused', net), ('fused', fused)]:
+        backbone_ms = time_module(RpnBackbone(model), inputs, repeat=args.repeat, warmup=1)
+        ms, _ = run(model, inputs, args.repeat)
+        results[name] = (backbone_ms, ms)
+        print(f'[{name}] backbone {backbone_ms:.1f} ms, full forward {ms:.1f} ms')
+
+    saved = [a - b for a, b in zip(results['unfused'], results['fused'])]
+    print(f'[saved] backbone {saved[0]:.1f} ms, full forward {saved[1]:.1f} ms')
+
+
+def synthetic_boxes(num_boxes, shape, seed):
+    """
+    Proposal-like boxes [p, z, y, x, d, h, w]: jittered clusters around random
+    nodules, in a volume of the given shape.
+    """
+    rng = np.random.RandomState(seed)
+    shape = np.array([int(s) for s in shape.split(',')])
+    centers = rng.uniform(0, shape, size=(max(num_boxes // 20, 1), 3))
+    sizes = rng.uniform(4, 30, size=(len(centers), 1))
+
+    cluster = rng.randint(0, len(centers), num_boxes)
+    size = sizes[cluster] * rng.uniform(0.8, 1.2, size=(num_boxes, 3))
+    center = centers[cluster] + rng.normal(scale=0.2, size=(num_boxes, 3)) * size
+    scores = rng.uniform(0, 1, size=(num_boxes, 1))
+
+    return np.concatenate([scores, center, size], 1).astype(np.float32)
+
+
+def benchmark_nms(args):
+    for num_boxes in args.num_boxes:
+        dets = synthetic_boxes(num_boxes, args.shape, args.seed)
+        tensor = torch.from_numpy(dets)
+
+        ms = time_module(lambda x: torch_nms(x, args.thresh), tensor, repeat=args.repeat, warmup=1)
+        _, reference = torch_nms(tensor, args.thresh)
+        reference = set(np.asarray(reference).tolist())
+        print(f'[nms] {num_boxes} boxes, torch_nms: {ms:.1f} ms, kept {len(reference)}')
+
+        for device in ['cpu'] + (['cuda'] if args.device.startswith('cuda') else []):
+            x = tensor.to(device)
+            ms = time_module(lambda x: tensor_nms(x[:, 1:7], x[:, 0], args.thresh), x, repeat=args.repeat, warmup=1)
+            keep = tensor_nms(x[:, 1:7], x[:, 0], args.thresh)
+            print(f'[nms] {num_boxes} boxes, tensor_nms on {device}: {ms:.1f} ms, kept {len(keep)}, '
+                  f'same keep as torch_nms: {set(keep.tolist()) == reference}')
+
+        for method in NMS_METHODS:
+            ms = time_module(lambda x: sweep_nms(x, args.thresh, method), tensor, repeat=args.repeat, warmup=1)
+            _, keep = sweep_nms(tensor, args.thresh, method)
+            line = f'[nms] {num_boxes} boxes, sweep {method}: {ms:.1f} ms, kept {len(keep)}'
+            if method == 'hard':
+                line += f', same keep as torch_nms: {set(keep.tolist()) == reference}'
+            print(line)
+
+
+def dense_max_overlap(overlap):
+    """
+    The reductions of make_one_rpn_target on a dense [anchors, truths] overlap matrix
+    """
+    overlap = np.asarray(overlap)
+    argmax_overlap = np.argmax(overlap, 1)
+    max_overlap = overlap[np.arange(len(overlap)), argmax_overlap]
+
+    best_index, best_truth = np.where(overlap == overlap.max(0))
+    best_assign = np.full(len(overlap), -1)
+    best_assign[best_index] = best_truth
+
+    return max_overlap, argmax_overlap, best_assign >= 0, best_assign
+
+
+def benchmark_overlap(args):
+    for shape in [args.shape] + ([args.slab] if args.slab else []):
+        benchmark_overlap_shape(args, shape)
+
+
+def benchmark_overlap_shape(args, shape):
+    d, h, w = [int(s) for s in shape.split(',')]
+    stride = net_config['stride']
+    window = make_rpn_windows(torch.empty(1, 1, d // stride, h // stride, w // stride), net_config)
+    rng = np.random.RandomState(args.seed)
+    devices = ['cpu'] + (['cuda'] if args.device.startswith('cuda') else [])
+
+    for num_truths in args.num_truths:
+        truth_box = np.concatenate([rng.uniform(0, [d, h, w], size=(num_truths, 3)),
+                                    rng.uniform(4, 40, size=(num_truths, 3))], 1)
+
+        start = time.time()
+        for _ in range(args.repeat):
+            dense = torch_overlap(window, truth_box)
+        dense_ms = (time.time() - start) / args.repeat * 1000
+        reference = dense_max_overlap(dense)
+        print(f'[overlap] {shape}, {len(window)} anchors x {num_truths} truths, dense: {dense_ms:.1f} ms')
+
+        for device in devices:
+            anchors = torch.tensor(window, device=device)
+            sparse = lambda x: sparse_max_overlap(*sparse_box_overlap(x, truth_box), len(window), num_truths)
+            ms = time_module(sparse, anchors, repeat=args.repeat, warmup=1)
+            results = [r.cpu().numpy() for r in sparse(anchors)]
+
+            same = np.allclose(results[0], reference[0], atol=1e-6) and \
+                all((r == ref).all() for r, ref in zip(results[1:], reference[1:]))
+            print(f'[overlap] {shape}, {len(window)} anchors x {num_truths} truths, sparse on {device}: '
+                  f'{ms:.1f} ms, same labels as dense: {same}')
+
+
+def benchmark_targets(args):
+    d, h, w = [int(s) for s in args.shape.split(',')]
+    stride = net_config['stride']
+    fs = torch.empty(1, 1, d // stride, h // stride, w // stride)
+    inputs = torch.zeros(args.batch_size, 1, d, h, w, device=args.device)
+    rng = np.random.RandomState(args.seed)
+    truth_boxes = [np.concatenate([rng.uniform(0, [d, h, w], size=(args.num_truths, 3)),
+                                   rng.uniform(4, 40, size=(args.num_truths, 3))], 1)
+                   for _ in range(args.batch_size)]
+    truth_labels = [np.ones(args.num_truths) for _ in range(args.batch_size)]
+
+    def loop(inputs):
+        window = make_rpn_windows(fs, net_config)
+        outputs = [make_one_rpn_target(net_config, 'train', x, window, box, label)
+                   for x, box, label in zip(inputs, truth_boxes, truth_labels)]
+        return [torch.stack(o) for o in zip(*outputs)]
+
+    generator = torch.Generator(inputs.device).manual_seed(args.seed)
+
+    def batched(inputs):
+        window = make_rpn_windows(fs, net_config, device=inputs.device)
+        return make_rpn_target(net_config, 'train', inputs, window, truth_boxes, truth_labels, generator)
+
+    for name, fn in [('before', loop), ('after', batched)]:
+        ms = time_module(fn, inputs, repeat=args.repeat, warmup=1)
+        label, _, label_weight, _, _ = fn(inputs)
+        print(f'[targets] {name}: {ms:.1f} ms per iteration, {int((label != 0).sum())} positive and '
+              f'{int(((label == 0) & (label_weight != 0)).sum())} sampled negative anchors')
+
+
+def benchmark_pool(args):
+    from system.config import SystemConfig
+    from system.worker_pool import InferenceWorkerPool
+
+    throughput = {}
+    for num_workers in args.workers:
+        pool = InferenceWorkerPool(SystemConfig(), num_workers=num_workers).start()
+        while any(w['status'] == 'loading' for w in pool.stats()):
+            time.sleep(1)
+        if pool.status != 'ready':
+            print(f'[pool] {num_workers} workers: no replica could load the model')
+            pool.shutdown()
+            continue
+
+        start = time.time()
+        futures = [pool.submit('predict', args.images[i % len(args.images)], f'benchmark_{i}')
+                   for i in range(args.requests)]
+        for future in futures:
+            future.result()
+        throughput[num_workers] = args.requests / (time.time() - start)
+        pool.shutdown()
+
+        scaling = throughput[num_workers] / throughput[min(throughput)] * min(throughput)
+        print(f'[pool] {num_workers} workers, {pool.threads_per_worker} threads each: '
+              f'{throughput[num_workers]:.2f} scans/s, {scaling:.2f} effective workers')
+
+
+def benchmark_memory(args):
+    from net.feature_net import CHECKPOINT_STAGES, FeatureNet
+
+    net = FeatureNet(in_channels=1, out_channels=128).to(args.device)
+    net.train()
+    generator = torch.Generator().manual_seed(args.seed)
+    is_cuda = args.device.startswith('cuda')
+
+    print('[memory] stages             | crop | batch | peak MB | ms/iter | crops/s')
+    for stages in args.stages:
+        net.checkpoint_stages = set(CHECKPOINT_STAGES if stages == 'all' else
+                                    [] if stages == 'none' else stages.split(','))
+        for crop_size in args.crop_sizes:
+            for batch_size in args.batch_sizes:
+                inputs = torch.randn(batch_size, 1, crop_size, crop_size, crop_size,
+                                     generator=generator).to(args.device)
+
+                def step():
+                    features, out2 = net(inputs)
+                    loss = sum(f.float().mean() for f in features[1:]) + out2.float().mean()
+                    loss.backward()
+                    net.zero_grad(set_to_none=True)
+
+                # time_module runs under no_grad, training steps are timed here
+                row = f'[memory] {stages:<18} | {crop_size:>4} | {batch_size:>5} |'
+                try:
+                    if is_cuda:
+                        torch.cuda.empty_cache()
+                        torch.cuda.reset_peak_memory_stats(args.device)
+                    step()
+                    if is_cuda:
+                        torch.cuda.synchronize()
+                    start = time.time()
+                    for _ in range(args.repeat):
+                        step()
+                    if is_cuda:
+                        torch.cuda.synchronize()
+                    ms = (time.time() - start) / args.repeat * 1000
+                except torch.cuda.OutOfMemoryError:
+                    net.zero_grad(set_to_none=True)
+                    print(f'{row}     OOM |         |')
+                    continue
+
+                peak = torch.cuda.max_memory_allocated(args.device) / 2 ** 20 if is_cuda else float('nan')
+                print(f'{row} {peak:>7.0f} | {ms:>7.1f} | {batch_size / ms * 1000:>7.2f}')
+
+
+def benchmark_attention(args):
+    from net.transformer import ATTENTION_IMPLS, build_transformer
+
+    transformer = build_transformer(dict(net_config, attention_window_size=args.window_size)).to(args.device)
+    transformer.eval()
+    generator = torch.Generator().manual_seed(args.seed)
+    is_cuda = args.device.startswith('cuda')
+
+    print('[attention] impl   | grid | tokens | peak MB | ms | max abs diff vs mha')
+    for grid in args.grids:
+        shape = (1, net_config['hidden_dim'], grid, grid, grid)
+        src = torch.randn(*shape, generator=generator).to(args.device)
+        pos = torch.randn(*shape, generator=generator).to(args.device)
+
+        reference = None
+        for impl in ATTENTION_IMPLS:
+            transformer.set_attention_impl(impl)
+            row = f'[attention] {impl:<6} | {grid:>4} | {grid ** 3:>6} |'
+            try:
+                if is_cuda:
+                    torch.cuda.empty_cache()
+                    torch.cuda.reset_peak_memory_stats(args.device)
+                ms = time_module(lambda x: transformer(x, pos), src, repeat=args.repeat, warmup=1)
+                with torch.no_grad():
+                    out = transformer(src, pos)
+            except torch.cuda.OutOfMemoryError:
+                print(f'{row}     OOM |')
+                continue
+
+            peak = torch.cuda.max_memory_allocated(args.device) / 2 ** 20 if is_cuda else float('nan')
+            if impl == 'mha':
+                reference = out
+            diff = 'n/a' if reference is None else f'{(out - reference).abs().max().item():.2e}'
+            print(f'{row} {peak:>7.0f} | {ms:.1f} | {diff}')
+
+    transformer.set_attention_impl(net_config['attention_impl'])
+
+
+def main():
+    args = parser.parse_args()
+    if args.command == 'nms':
+        benchmark_nms(args)
+        return
+    if args.command == 'overlap':
+        benchmark_overlap(args)
+        return
+    if args.command == 'targets':
+        benchmark_targets(args)
+        return
+    if args.command == 'pool':
+        benchmark_pool(args)
+        return
+    if args.command == 'memory':
+        benchmark_memory(args)
+        return
+    if args.command == 'attention':
+        benchmark_attention(args)
+        return
+
+    net = load_model(args.weight, args.device)
+    inputs = synthetic_volume(args.shape, args.seed).to(args.device)
+
+    if args.command == 'precision':
+        benchmark_precision(args, net, inputs)
+    if args.command == 'fuse':
+        benchmark_fuse(args, net, inputs)
+
+
+if __name__ == '__main__':
+    main()
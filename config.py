@@ -72,10 +72,19 @@ net_config = {
     'rpn_train_nms_overlap_threshold': 0.1,
     'rpn_test_nms_pre_score_threshold': 0.5,
     'rpn_test_nms_overlap_threshold': 0.1,
+    # max boxes per image entering / leaving rpn nms, None for no limit
+    'rpn_train_pre_nms_top_n': 2000,
+    'rpn_train_post_nms_top_n': 300,
+    'rpn_test_pre_nms_top_n': 6000,
+    'rpn_test_post_nms_top_n': 1000,
+    # seed of the on-device anchor sampling of rpn targets
+    'rpn_target_seed': SEED,
 
     # false positive reduction network configuration
     'num_class': 2,
     'rcnn_crop_size': (7, 7, 7),  # can be set smaller, should not affect much
+    'rcnn_crop_mode': 'pool',  # 'pool': roi max pooling, 'align': trilinear roi align
+    'rcnn_chunk_size': 128,  # max proposals cropped and fed to rcnn head at once, None for all
     'rcnn_train_fg_thresh_low': 0.5,
     'rcnn_train_bg_thresh_high': 0.1,
     'rcnn_train_batch_size': 64,
@@ -97,6 +106,30 @@ net_config = {
     'return_intermediate_dec': True,
     'position_embedding': 'sine',
     'num_queries': 512,
+    # max number of feature shapes for which query embeddings and
+    # positional encodings are cached
+    'shape_cache_size': 8,
+    # attention of the transformer: 'sdpa' for fused scaled dot product attention over
+    # chunks of attention_chunk_size queries, 'window' for local attention within
+    # attention_window_size windows of the feature grid, 'mha' for nn.MultiheadAttention
+    'attention_impl': 'sdpa',
+    'attention_chunk_size': 4096,
+    'attention_window_size': [4, 4, 4],
+    # sequence chunk of the pure PyTorch selective scan used when Mamba runs off CUDA
+    'mamba_scan_chunk_size': 64,
+    # FeatureNet stages whose activations are recomputed in the backward pass instead of
+    # kept, any of 'forw', 'mamba', 'transformer', 'scale', 'back'. Trades compute for
+    # memory to train larger crops or batches, BatchNorm running stats of recomputed
+    # blocks are updated twice per step
+    'checkpoint_stages': [],
+
+    # tiled full-resolution inference, sizes should be multiples of max_stride
+    'tile_size': [128, 128, 128],
+    'tile_overlap': 32,
+    'tile_batch_size': 2,
+
+    # None for fp32, or 'bfloat16' to autocast the backbone and heads at inference time
+    'inference_dtype': None,
 }
 
 
@@ -30,6 +30,9 @@ FROC_minX = 0.125 # Mininum value of x-axis of FROC curve
 FROC_maxX = 8 # Maximum value of x-axis of FROC curve
 bLogPlot = True
 
+# average false positives per scan at which the FROC score (average sensitivity) is read
+FROC_points = [0.125, 0.25, 0.5, 1, 2, 4, 8]
+
 def generateBootstrapSet(scanToCandidatesDict, FROCImList):
     '''
     Generates bootstrapped version of set
@@ -548,6 +551,39 @@ def noduleCADEvaluation(annotations_filename,annotations_excluded_filename,serie
     else:
         return None, None
         
+def sensitivityAtFPs(fps, sens, points=FROC_points):
+    '''
+    sensitivity of the FROC curve at each average false positives per scan of points,
+    taken at the nearest curve point not below it like evaluateCAD, or the last one
+    '''
+    sensitivities = []
+    for th in points:
+        if max(fps - th) < 0:
+            idx = -1
+        else:
+            idx = np.where((fps - th) == (fps - th)[(fps - th) >= 0].min())[0][-1]
+        sensitivities.append(sens[idx])
+    return sensitivities
+
+
+def noduleFROCScore(annotations_filename,annotations_excluded_filename,seriesuids_filename,results_filename,outputDir):
+    '''
+    function to evaluate a CAD algorithm with the FROC score
+    @return: sensitivities at FROC_points and their average (the FROC score),
+             (None, None) if the evaluation produced no FROC curve
+    '''
+    (allNodules, seriesUIDs) = collect(annotations_filename, annotations_excluded_filename, seriesuids_filename)
+
+    result = evaluateCAD(seriesUIDs, results_filename, outputDir, allNodules,
+                os.path.splitext(os.path.basename(results_filename))[0],
+                maxNumberOfCADMarks=100, performBootstrapping=False)
+
+    if not result or len(result[0]) == 0:
+        return None, None
+    sensitivities = sensitivityAtFPs(np.asarray(result[0]), np.asarray(result[1]))
+    return sensitivities, float(np.mean(sensitivities))
+
+
 if __name__ == '__main__':
 
     annotations_filename          = sys.argv[1]
@@ -0,0 +1,119 @@
+import argparse
+import os
+import sys
+
+import torch
+
+from config import net_config, train_config
+from net.main_net import build_model
+from net.export import export_weights, export_torchscript, export_onnx, CompiledBackbone, OnnxBackbone, OnnxRcnnHead, \
+    check_parity
+
+parser = argparse.ArgumentParser(description='Export TiCNet for inference')
+parser.add_argument("--weight", type=str, default=train_config['initial_checkpoint'],
+                    help="path to model weights to be exported")
+parser.add_argument("--format", type=str, default='torchscript', choices=['torchscript', 'onnx', 'weights'],
+                    help="export format, onnx is exported on cpu for ONNX Runtime, "
+                         "weights writes an inference-only state_dict loaded memory-mapped by ModelInference")
+parser.add_argument("--out-dir", type=str, default=None,
+                    help="directory to save the exported model, "
+                         "models/compiled, models/onnx or models depending on the format")
+parser.add_argument("--shapes", type=str, nargs='+',
+                    default=['128,128,128', ','.join(str(s) for s in net_config['tile_size'])],
+                    help="static input shape buckets D,H,W")
+parser.add_argument("--batch-sizes", type=int, nargs='+',
+                    default=sorted({1, net_config['tile_batch_size']}),
+                    help="batch sizes traced for every shape bucket")
+parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                    help="device the exported model runs on")
+parser.add_argument("--benchmark", type=int, default=5,
+                    help="number of runs to compare eager vs exported latency, 0 to skip")
+parser.add_argument("--opset", type=int, default=17,
+                    help="ONNX opset version")
+parser.add_argument("--threads", type=int, default=os.cpu_count(),
+                    help="ONNX Runtime intra-op threads used by the parity check")
+parser.add_argument("--check", action='store_true',
+                    help="load the exported model back and compare it against PyTorch on synthetic volumes, "
+                         "the onnx check is skipped when onnxruntime is not installed")
+
+
+OUT_DIRS = {
+    'torchscript': os.path.join('models', 'compiled'),
+    'onnx': os.path.join('models', 'onnx'),
+    'weights': 'models',
+}
+
+
+def load_model(weight, device):
+    model = build_model(net_config)
+    if weight:
+        print(f'Loading model from {weight}...')
+        checkpoint = torch.load(weight, map_location='cpu')
+        model.load_state_dict(checkpoint.get('state_dict', checkpoint))
+    else:
+        print('No model weight file specified, exporting random weights.')
+    model = model.to(device)
+    model.use_rcnn = True
+    model.set_mode('eval')
+    return model
+
+
+def main():
+    args = parser.parse_args()
+    if args.out_dir is None:
+        args.out_dir = OUT_DIRS[args.format]
+
+    if args.format == 'weights':
+        if not args.weight:
+            print('No model weight file specified.')
+            sys.exit(1)
+        out_path = os.path.join(args.out_dir, 'inference_weights.pth')
+        state_dict = export_weights(args.weight, out_path)
+        size = sum(v.numel() * v.element_size() for v in state_dict.values()) / 1024 / 1024
+        print(f'Exported {len(state_dict)} tensors ({size:.1f} MB) to {out_path}')
+        return
+
+    if args.format == 'onnx':
+        args.device = 'cpu'
+    model = load_model(args.weight, args.device)
+
+    shapes = []
+    for shape in dict.fromkeys(args.shapes):
+        d, h, w = [int(s) for s in shape.split(',')]
+        for b in args.batch_sizes:
+            shapes.append([b, 1, d, h, w])
+
+    if args.format == 'torchscript':
+        manifest = export_torchscript(model, shapes, args.out_dir, device=args.device,
+                                      weight=args.weight, benchmark=args.benchmark)
+    elif args.format == 'onnx':
+        manifest = export_onnx(model, shapes, args.out_dir, device=args.device,
+                               weight=args.weight, opset_version=args.opset)
+
+    if not manifest['buckets']:
+        print('No bucket was exported.')
+        sys.exit(1)
+
+    print(f'Exported {len(manifest["buckets"])} buckets to {args.out_dir}')
+
+    if not args.check:
+        return
+
+    if args.format == 'torchscript':
+        backbone, rcnn_head = CompiledBackbone.load(args.out_dir, args.device), None
+    else:
+        try:
+            import onnxruntime  # noqa: F401
+        except ImportError:
+            print('onnxruntime is not installed, skipping the parity check.')
+            return
+        backbone = OnnxBackbone.load(args.out_dir, args.threads)
+        rcnn_head = OnnxRcnnHead.load(args.out_dir, args.threads)
+
+    for res in check_parity(model, backbone, backbone.shapes(), rcnn_head):
+        print('[parity] ' + ', '.join(f'{k}: {v:.2e}' if isinstance(v, float) else f'{k}: {v}'
+                                      for k, v in res.items()))
+
+
+if __name__ == '__main__':
+    main()
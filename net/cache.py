@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class ShapeCache(object):
+    """
+    Bounded LRU cache for tensors which only depend on the input shape,
+    e.g. transformer query embeddings and sine positional encodings.
+
+    Entries are keyed by (shape, device, dtype), the least recently used one
+    is evicted once max_entries is reached, since full-volume eval changes the
+    feature shape on every scan.
+    """
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        # cached tensors and the lock are not copied along with the model
+        return {'max_entries': self.max_entries}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_entries'])
+
+    def get(self, shape, device, dtype, build):
+        """
+        Return the cached tensor for (shape, device, dtype), call build() to
+        create it on a miss.
+        """
+        # int(): under torch.jit.trace the sizes are tensors, which hash by identity
+        key = (tuple(int(s) if isinstance(s, torch.Tensor) else s for s in shape), str(torch.device(device)), dtype)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        value = build()
+
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.entries),
+            'hit_rate': float(self.hits) / total if total else 0.0,
+        }
+
+
+def collect_cache_stats(model):
+    """
+    Hit/miss counters of every ShapeCache in model, keyed by module name.
+    """
+    stats = {}
+    for name, module in model.named_modules():
+        cache = getattr(module, 'shape_cache', None)
+        if isinstance(cache, ShapeCache):
+            stats[name] = cache.stats()
+
+    return stats
@@ -0,0 +1,328 @@
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+
+class RpnBackbone(nn.Module):
+    """
+    FeatureNet + RpnHead of a MainNet, the static-shape part of the detector
+    which is exported ahead of time. Post-processing (nms, rcnn) stays in python.
+
+    return
+    fs: last feature map, only its shape is used to build the anchors
+    feat_4: stride-4 feature map used by the rcnn crops
+    logits, deltas: outputs of RpnHead
+    """
+
+    def __init__(self, net):
+        super(RpnBackbone, self).__init__()
+        self.feature_net = net.feature_net
+        self.rpn = net.rpn
+
+    def forward(self, inputs):
+        features, feat_4 = self.feature_net(inputs)
+        fs = features[-1]
+        logits, deltas = self.rpn(fs)
+
+        return fs, feat_4, logits, deltas
+
+
+def bucket_name(shape):
+    return 'x'.join(str(int(s)) for s in shape)
+
+
+def warm_shape_caches(backbone, example):
+    """
+    Run backbone once in eager mode, so that the query embeddings and positional
+    encodings of the example shape are cached: the tracer then freezes them as
+    constants instead of recording how they are built (a seeded randn, which
+    would be drawn again on every call of the traced graph).
+    """
+    with torch.no_grad():
+        backbone(example)
+
+
+def time_module(module, inputs, repeat=5, warmup=2):
+    """
+    Average latency of module(inputs) in milliseconds
+    """
+    with torch.no_grad():
+        for _ in range(warmup):
+            module(inputs)
+        if inputs.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeat):
+            module(inputs)
+        if inputs.is_cuda:
+            torch.cuda.synchronize()
+
+    return (time.time() - start) / repeat * 1000
+
+
+def export_weights(weight, out_path):
+    """
+    Write an inference-only copy of a training checkpoint: the state_dict as
+    contiguous cpu tensors, without the optimizer state saved by train.py.
+
+    The file is saved in the zipfile format so it can be loaded with
+    torch.load(mmap=True, weights_only=True), workers on the same host then
+    share one page-cache copy of the weights.
+    """
+    checkpoint = torch.load(weight, map_location='cpu')
+    state_dict = checkpoint.get('state_dict', checkpoint)
+    state_dict = {k: v.detach().cpu().contiguous() for k, v in state_dict.items()}
+
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    torch.save({'state_dict': state_dict, 'epoch': checkpoint.get('epoch'), 'weight': weight}, out_path)
+
+    return state_dict
+
+
+def export_torchscript(net, shapes, out_dir, device='cpu', weight=None, benchmark=0):
+    """
+    Trace RpnBackbone once for every static shape bucket and save them to out_dir,
+    together with a manifest.json listing the buckets.
+
+    shapes: list of [b, 1, D, H, W] input shapes, e.g. a 128^3 crop and the tile batch
+    benchmark: if > 0, time eager vs traced for that many runs per bucket
+
+    return
+    manifest: dict written to out_dir/manifest.json
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    net = net.to(device)
+    net.eval()
+    backbone = RpnBackbone(net).eval()
+
+    manifest = {'format': 'torchscript', 'weight': weight, 'buckets': {}}
+    for shape in shapes:
+        name = bucket_name(shape)
+        example = torch.randn(*shape, device=device)
+        warm_shape_caches(backbone, example)
+        # a second input makes the trace checker catch ops the tracer cannot
+        # see (e.g. fused CUDA kernels), which would be frozen as constants
+        check = torch.randn(*shape, device=device)
+
+        try:
+            with torch.no_grad():
+                traced = torch.jit.trace(backbone, example, check_inputs=[(check,)])
+                traced = torch.jit.freeze(traced)
+        except Exception as e:
+            print(f'[export] skip bucket {name}: {e}')
+            continue
+
+        path = os.path.join(out_dir, 'backbone_%s.pt' % name)
+        traced.save(path)
+        bucket = {'shape': list(shape), 'file': os.path.basename(path)}
+
+        if benchmark > 0:
+            bucket['eager_ms'] = time_module(backbone, example, repeat=benchmark)
+            bucket['compiled_ms'] = time_module(traced, example, repeat=benchmark)
+            print(f'[export] {name}: eager {bucket["eager_ms"]:.1f} ms, '
+                  f'compiled {bucket["compiled_ms"]:.1f} ms, '
+                  f'speedup {bucket["eager_ms"] / bucket["compiled_ms"]:.2f}x')
+
+        manifest['buckets'][name] = bucket
+
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+class CompiledBackbone(object):
+    """
+    Runs the exported RpnBackbone for inputs whose shape matches one of the
+    buckets, returns None otherwise so that MainNet falls back to eager mode.
+    """
+
+    def __init__(self, modules, weight=None):
+        self.modules = modules
+        self.weight = weight
+
+    @classmethod
+    def load(cls, out_dir, device='cpu'):
+        with open(os.path.join(out_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+
+        modules = {}
+        for name, bucket in manifest['buckets'].items():
+            module = torch.jit.load(os.path.join(out_dir, bucket['file']), map_location=device)
+            modules[tuple(bucket['shape'])] = module.eval()
+
+        return cls(modules, manifest.get('weight'))
+
+    def shapes(self):
+        return list(self.modules.keys())
+
+    def __call__(self, inputs):
+        module = self.modules.get(tuple(inputs.shape))
+        if module is None:
+            return None
+
+        return module(inputs)
+
+
+def export_onnx(net, shapes, out_dir, device='cpu', weight=None, opset_version=17):
+    """
+    Export RpnBackbone to ONNX once for every static shape bucket, and RcnnHead
+    once with a dynamic number of rois, together with a manifest.json.
+
+    Export on cpu, so that Mamba goes through the pure PyTorch selective scan
+    which the exporter can trace.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    net = net.to(device)
+    net.eval()
+    backbone = RpnBackbone(net).eval()
+
+    manifest = {'format': 'onnx', 'weight': weight, 'buckets': {}}
+    for shape in shapes:
+        name = bucket_name(shape)
+        path = os.path.join(out_dir, 'backbone_%s.onnx' % name)
+        example = torch.randn(*shape, device=device)
+        warm_shape_caches(backbone, example)
+        try:
+            with torch.no_grad():
+                torch.onnx.export(backbone, example, path,
+                                  input_names=['inputs'],
+                                  output_names=['fs', 'feat_4', 'logits', 'deltas'],
+                                  opset_version=opset_version)
+        except Exception as e:
+            print(f'[export] skip bucket {name}: {e}')
+            continue
+        manifest['buckets'][name] = {'shape': list(shape), 'file': os.path.basename(path)}
+
+    crop_size = tuple(net.cfg['rcnn_crop_size'])
+    in_channels = net.rcnn_head.fc1.in_features // int(np.prod(crop_size))
+    path = os.path.join(out_dir, 'rcnn_head.onnx')
+    with torch.no_grad():
+        torch.onnx.export(net.rcnn_head, torch.randn((2, in_channels) + crop_size, device=device), path,
+                          input_names=['crops'], output_names=['logits', 'deltas'],
+                          dynamic_axes={'crops': {0: 'n'}, 'logits': {0: 'n'}, 'deltas': {0: 'n'}},
+                          opset_version=opset_version)
+    manifest['rcnn_head'] = {'file': os.path.basename(path)}
+
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+def _make_session(path, intra_op_threads):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = 1
+
+    return ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+
+class OnnxBackbone(object):
+    """
+    Runs the exported RpnBackbone under ONNX Runtime on cpu, returns torch tensors
+    on the device of the inputs. Returns None for shapes without a bucket.
+    """
+
+    def __init__(self, sessions, weight=None):
+        self.sessions = sessions
+        self.weight = weight
+
+    @classmethod
+    def load(cls, out_dir, intra_op_threads=None):
+        with open(os.path.join(out_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+
+        intra_op_threads = intra_op_threads or os.cpu_count()
+        sessions = {}
+        for name, bucket in manifest['buckets'].items():
+            sessions[tuple(bucket['shape'])] = _make_session(
+                os.path.join(out_dir, bucket['file']), intra_op_threads)
+
+        return cls(sessions, manifest.get('weight'))
+
+    def shapes(self):
+        return list(self.sessions.keys())
+
+    def __call__(self, inputs):
+        session = self.sessions.get(tuple(inputs.shape))
+        if session is None:
+            return None
+
+        outputs = session.run(None, {'inputs': inputs.detach().cpu().float().numpy()})
+        return tuple(torch.from_numpy(o).to(inputs.device) for o in outputs)
+
+
+class OnnxRcnnHead(object):
+    """
+    Runs the exported RcnnHead under ONNX Runtime on cpu, same call as RcnnHead.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    @classmethod
+    def load(cls, out_dir, intra_op_threads=None):
+        with open(os.path.join(out_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+
+        intra_op_threads = intra_op_threads or os.cpu_count()
+        return cls(_make_session(os.path.join(out_dir, manifest['rcnn_head']['file']), intra_op_threads))
+
+    def __call__(self, crops):
+        logits, deltas = self.session.run(None, {'crops': crops.detach().cpu().float().numpy()})
+        return torch.from_numpy(logits).to(crops.device), torch.from_numpy(deltas).to(crops.device)
+
+
+def check_parity(net, backbone_runner, shapes, rcnn_runner=None, seed=0):
+    """
+    Compare an exported backend against the PyTorch path of net on synthetic volumes.
+
+    return
+    report: list of dicts with the max abs difference of every backbone output,
+            of the rcnn head outputs and the number of detections of both paths
+    """
+    net.eval()
+    device = next(net.parameters()).device
+    generator = torch.Generator().manual_seed(seed)
+    report = []
+
+    for shape in shapes:
+        inputs = torch.randn(*shape, generator=generator).to(device)
+        with torch.no_grad():
+            reference = RpnBackbone(net)(inputs)
+            outputs = backbone_runner(inputs)
+            if outputs is None:
+                continue
+
+            res = {'shape': list(shape)}
+            for key, ref, out in zip(['fs', 'feat_4', 'logits', 'deltas'], reference, outputs):
+                res[key] = float((ref.float() - out.float()).abs().max())
+
+            if rcnn_runner is not None:
+                crops = torch.randn((4, net.rcnn_head.fc1.in_features), generator=generator).to(device)
+                crops = crops.view((4, -1) + tuple(net.cfg['rcnn_crop_size']))
+                for key, ref, out in zip(['rcnn_logits', 'rcnn_deltas'], net.rcnn_head(crops), rcnn_runner(crops)):
+                    res[key] = float((ref.float() - out.float()).abs().max())
+
+            runners = net.backbone_runner, net.rcnn_runner
+            net.backbone_runner, net.rcnn_runner = None, None
+            net.forward(inputs, [None] * len(inputs), [None] * len(inputs))
+            res['torch_detections'] = len(net.detections)
+
+            net.backbone_runner, net.rcnn_runner = backbone_runner, rcnn_runner
+            net.forward(inputs, [None] * len(inputs), [None] * len(inputs))
+            res['backend_detections'] = len(net.detections)
+            net.backbone_runner, net.rcnn_runner = runners
+
+        report.append(res)
+
+    return report
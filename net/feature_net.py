@@ -1,13 +1,22 @@
 from config import net_config as config
+from torch.utils.checkpoint import checkpoint
 
 from .module import *
 from .multi_scale import conv_2nV1, conv_3nV1
 from .transformer import build_transformer
 from .position_encoding import build_position_encoding
-from mamba_ssm import Mamba 
+from .mamba_scan import MambaScan, mamba_scan_forward
+
+try:
+    from mamba_ssm import Mamba
+except ImportError:
+    print('Warning: mamba_ssm import failed! Falling back to the pure PyTorch selective scan')
+    Mamba = MambaScan
 
 bn_momentum = train_config['bn_momentum']
 
+CHECKPOINT_STAGES = ['forw', 'mamba', 'transformer', 'scale', 'back']
+
 
 class ResBlock3d(nn.Module):
     def __init__(self, n_in, n_out, stride=1, ):
@@ -121,6 +130,11 @@ class FeatureNet(nn.Module):
             nn.BatchNorm3d(64),
             nn.ReLU(inplace=True))
 
+        self.mamba_scan_chunk_size = config['mamba_scan_chunk_size']
+        self.checkpoint_stages = set(config['checkpoint_stages'] or [])
+        for stage in self.checkpoint_stages:
+            if stage not in CHECKPOINT_STAGES:
+                raise ValueError('FeatureNet(): invalid checkpoint stage = %s?' % stage)
         self.ln_enc1 = nn.LayerNorm(32)
         self.mamba_enc1 = Mamba(
             d_model=32,
@@ -175,46 +189,59 @@ class FeatureNet(nn.Module):
         # 应用LayerNorm
         feature_flat = ln(feature_flat)
         
-        # 通过Mamba模块
-        feature_enhanced = mamba(feature_flat)
+        # 通过Mamba模块，融合CUDA kernel只能在GPU上运行，其他设备使用分块的PyTorch选择性扫描
+        if feature_flat.is_cuda:
+            feature_enhanced = mamba(feature_flat)
+        else:
+            feature_enhanced = mamba_scan_forward(mamba, feature_flat, self.mamba_scan_chunk_size)
         
         # 恢复原始形状: [B, D*H*W, C] -> [B, C, D*H*W] -> [B, C, D, H, W]
         feature_out = feature_enhanced.transpose(-1, -2).view(B, C, *img_dims)
         
         return feature_out
 
+    def run_stage(self, stage, module, *args):
+        """
+        module(*args), with activation checkpointing when stage is in
+        checkpoint_stages: only the inputs are kept and the block is run
+        again in the backward pass.
+        """
+        if stage in self.checkpoint_stages and self.training and torch.is_grad_enabled():
+            return checkpoint(module, *args, use_reentrant=False)
+        return module(*args)
+
     def forward(self, x):
         out = self.preBlock(x)  # 24, 1/2
         out_pool = out
-        out1 = self.forw1(out_pool)  # 32
-        out1 = self.apply_mamba(out1, self.ln_enc1, self.mamba_enc1)  # FASS增强
+        out1 = self.run_stage('forw', self.forw1, out_pool)  # 32
+        out1 = self.run_stage('mamba', self.apply_mamba, out1, self.ln_enc1, self.mamba_enc1)  # FASS增强
         
         out1_pool, _ = self.maxpool2(out1)
-        out2 = self.forw2(out1_pool)  # 64
-        out2 = self.apply_mamba(out2, self.ln_enc2, self.mamba_enc2)  # FASS增强
+        out2 = self.run_stage('forw', self.forw2, out1_pool)  # 64
+        out2 = self.run_stage('mamba', self.apply_mamba, out2, self.ln_enc2, self.mamba_enc2)  # FASS增强
         
         out2_pool, _ = self.maxpool3(out2)
-        out3 = self.forw3(out2_pool)  # 64
-        out3 = self.apply_mamba(out3, self.ln_enc3, self.mamba_enc3)  # FASS增强
+        out3 = self.run_stage('forw', self.forw3, out2_pool)  # 64
+        out3 = self.run_stage('mamba', self.apply_mamba, out3, self.ln_enc3, self.mamba_enc3)  # FASS增强
         
         out3_pool, _ = self.maxpool4(out3)
-        out4 = self.forw4(out3_pool)  # 64
-        out4 = self.apply_mamba(out4, self.ln_enc4, self.mamba_enc4)  # FASS增强
+        out4 = self.run_stage('forw', self.forw4, out3_pool)  # 64
+        out4 = self.run_stage('mamba', self.apply_mamba, out4, self.ln_enc4, self.mamba_enc4)  # FASS增强
 
         pe = self.position_embedding(out4)
-        out4_tr = self.transformer(out4, pe) # 64
+        out4_tr = self.run_stage('transformer', self.transformer, out4, pe) # 64
 
-        out2_scale = self.scale1(out1, out2, out3) # 64
-        out3_scale = self.scale2(out2, out3, out4) # 64
-        out4_scale = self.scale3(out3, out4) # 64
+        out2_scale = self.run_stage('scale', self.scale1, out1, out2, out3) # 64
+        out3_scale = self.run_stage('scale', self.scale2, out2, out3, out4) # 64
+        out4_scale = self.run_stage('scale', self.scale3, out3, out4) # 64
 
-        comb3 = self.back3(torch.cat((out4_tr, out4_scale), 1))  # 128
+        comb3 = self.run_stage('back', self.back3, torch.cat((out4_tr, out4_scale), 1))  # 128
         
         rev2 = self.path1(comb3)  # 128
-        comb2 = self.back2(torch.cat((rev2, out3_scale), 1))  # 192 -> 64
+        comb2 = self.run_stage('back', self.back2, torch.cat((rev2, out3_scale), 1))  # 192 -> 64
         
         rev1 = self.path2(comb2)  # 64
-        comb1 = self.back1(torch.cat((rev1, out2_scale), 1)) 
+        comb1 = self.run_stage('back', self.back1, torch.cat((rev1, out2_scale), 1)) 
 
         return [x, rev2, comb1], out2
 
@@ -0,0 +1,114 @@
+import torch
+from torch import nn
+
+from .feature_net import ResBlock3d
+from .multi_scale import conv_2nV1, conv_3nV1
+
+
+# BatchNorm of the blocks that do not call conv and bn in a nn.Sequential, and the
+# convs whose (summed) outputs it normalizes. Entries missing from a block (e.g. the
+# stage 2/3 layers of the other conv_2nV1.main) are skipped.
+FOLD_TABLE = {
+    ResBlock3d: {
+        'bn1': ['conv1'],
+        'bn2': ['conv2'],
+    },
+    conv_2nV1: {
+        'bnh_0': ['h2h_0'],
+        'bnl_0': ['l2l_0'],
+        'bnh_1': ['h2h_1', 'l2h_1'],
+        'bnl_1': ['l2l_1', 'h2l_1'],
+        'bnh_2': ['h2h_2', 'l2h_2'],
+        'bnh_3': ['h2h_3'],
+        'bnl_2': ['h2l_2', 'l2l_2'],
+        'bnl_3': ['l2l_3'],
+    },
+    conv_3nV1: {
+        'bnh_0': ['h2h_0'],
+        'bnm_0': ['m2m_0'],
+        'bnl_0': ['l2l_0'],
+        'bnh_1': ['h2h_1', 'm2h_1'],
+        'bnm_1': ['h2m_1', 'm2m_1', 'l2m_1'],
+        'bnl_1': ['m2l_1', 'l2l_1'],
+        'bnm_2': ['h2m_2', 'm2m_2', 'l2m_2'],
+        'bnm_3': ['m2m_3'],
+    },
+}
+
+CONVS = (nn.Conv3d, nn.ConvTranspose3d)
+DROPOUTS = (nn.Dropout, nn.Dropout2d, nn.Dropout3d)
+
+
+@torch.no_grad()
+def fold_bn(convs, bn):
+    """
+    Fold an eval-mode BatchNorm3d into the convs whose summed output it normalizes:
+    bn(sum(conv_i(x_i))) = sum(conv_i'(x_i)), every conv is scaled by the bn scale
+    and the bn shift is added to the bias of the first one.
+    """
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.affine:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        shift = shift + bn.bias
+
+    for k, conv in enumerate(convs):
+        # out channels are dim 0 of a Conv3d weight and dim 1 of a ConvTranspose3d weight
+        shape = [1] * conv.weight.dim()
+        shape[1 if isinstance(conv, nn.ConvTranspose3d) else 0] = -1
+        conv.weight = nn.Parameter(conv.weight * scale.view(shape))
+
+        bias = conv.bias * scale if conv.bias is not None else torch.zeros_like(scale)
+        conv.bias = nn.Parameter(bias + shift if k == 0 else bias)
+
+
+def _fold_sequential(module):
+    children = list(module.named_children())
+    for (_, conv), (name, bn) in zip(children[:-1], children[1:]):
+        if isinstance(conv, CONVS) and isinstance(bn, nn.BatchNorm3d):
+            fold_bn([conv], bn)
+            setattr(module, name, nn.Identity())
+
+
+def _inplace_relu(module):
+    # a ReLU of a nn.Sequential after a conv / bn / linear only sees a fresh tensor,
+    # ReLUs called on a block input (e.g. Atten_Conv_Block.relu) are left alone
+    computed = False
+    for child in module.children():
+        if isinstance(child, nn.ReLU) and computed:
+            child.inplace = True
+        computed = computed or isinstance(child, CONVS + (nn.BatchNorm3d, nn.Linear))
+
+
+def fuse_for_inference(net):
+    """
+    Inference-only rewrite of net, in place:
+        - BatchNorm3d folded into the preceding Conv3d / ConvTranspose3d of nn.Sequential
+          blocks and, following FOLD_TABLE, of ResBlock3d, conv_2nV1 and conv_3nV1,
+          the folded bn are replaced by nn.Identity
+        - dropout replaced by nn.Identity, attention dropout set to 0
+        - ReLUs of nn.Sequential blocks made in-place where their input is not reused
+
+    The model can no longer be trained or loaded from a checkpoint afterwards.
+    """
+    net.eval()
+    for module in list(net.modules()):
+        table = FOLD_TABLE.get(type(module), {})
+        for bn_name, conv_names in table.items():
+            bn = getattr(module, bn_name, None)
+            if isinstance(bn, nn.BatchNorm3d):
+                fold_bn([getattr(module, name) for name in conv_names], bn)
+                setattr(module, bn_name, nn.Identity())
+
+        if isinstance(module, nn.Sequential):
+            _fold_sequential(module)
+            _inplace_relu(module)
+        elif isinstance(module, nn.MultiheadAttention):
+            module.dropout = 0.0
+
+        for name, child in list(module.named_children()):
+            if isinstance(child, DROPOUTS):
+                setattr(module, name, nn.Identity())
+
+    return net
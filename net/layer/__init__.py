@@ -5,3 +5,4 @@ from net.layer.rcnn_target import *
 from net.layer.rpn_loss import *
 from net.layer.util import *
 from net.layer.rpn_target import *
+from net.layer.roi_crop import *
@@ -10,7 +10,7 @@ def rcnn_loss(logits, deltas, labels, targets):
     batch_size, num_class = logits.size(0), logits.size(1)
 
     # Weighted cross entropy for imbalance class distribution
-    weight = torch.ones(num_class).cuda()
+    weight = torch.ones(num_class, device=logits.device)
     total = len(labels)
     for i in range(num_class):
         num_pos = float((labels == i).sum())
@@ -32,7 +32,7 @@ def rcnn_loss(logits, deltas, labels, targets):
 
     if num_pos > 0:
         # one hot encode
-        select = Variable(torch.zeros((batch_size, num_class))).cuda()
+        select = Variable(torch.zeros((batch_size, num_class), device=logits.device))
         select.scatter_(1, labels.view(-1, 1), 1)
         select[:, 0] = 0
         select = select.view(batch_size, num_class, 1).expand((batch_size, num_class, 6)).contiguous().bool()
@@ -49,7 +49,7 @@ def rcnn_loss(logits, deltas, labels, targets):
 
 
     else:
-        rcnn_reg_loss = Variable(torch.cuda.FloatTensor(1).zero_()).sum()
+        rcnn_reg_loss = Variable(torch.zeros(1, device=logits.device)).sum()
 
     return rcnn_cls_loss, rcnn_reg_loss
 
@@ -65,9 +65,10 @@ def rcnn_iou_loss(rpn_proposals, truth_box):
         for nodule_rpn in slice_rpn: 
                
             for nodule_box in truth_box[slice_idx]:
-                if box_ciou(nodule_rpn, torch.from_numpy(nodule_box).cuda()) < 0:
+                nodule_box = torch.from_numpy(nodule_box).to(nodule_rpn.device)
+                if box_ciou(nodule_rpn, nodule_box) < 0:
                     print("Unavailable box.")
-                iou_score = box_ciou(nodule_rpn, torch.from_numpy(nodule_box).cuda())
+                iou_score = box_ciou(nodule_rpn, nodule_box)
                 iou_loss += iou_score
                 
     return iou_loss
@@ -1,4 +1,5 @@
-from net.layer.util import box_transform, box_transform_inv, clip_boxes
+from net.layer.util import box_transform, box_transform_inv, clip_boxes, \
+    torch_box_transform_inv, torch_clip_boxes, batched_tensor_nms
 import torch.nn.functional as F
 import numpy as np
 import torch
@@ -19,8 +20,21 @@ def rcnn_decode(window, delta, weight):
     return  box_transform_inv(window, delta, weight)
 
 
-def rcnn_nms(cfg, mode, inputs, proposals, logits, deltas):
+def rcnn_postprocess(cfg, mode, inputs, proposals, logits, deltas, ensemble=False):
+    """
+    Single post-processing pass over the rcnn outputs: softmax and box decoding
+    run once for all proposals, nms and the ensemble read from those buffers.
+
+    proposals: [n, 8] tensor of [b, p, z, y, x, d, h, w] the rcnn head ran on
+    ensemble: also return the rpn proposals re-scored with the rcnn probability
 
+    return
+    detections: [m, 9] tensor of [b, p, z, y, x, d, h, w, class] by image, then by
+                class, then by descending probability
+    keeps: indices into proposals of the detections
+    ensemble_proposals: [n, 8] copy of proposals whose p is the mean of the rpn and
+                        rcnn probabilities, None unless ensemble
+    """
     if mode in ['train',]:
         nms_pre_score_threshold = cfg['rcnn_train_nms_pre_score_threshold']
         nms_overlap_threshold   = cfg['rcnn_train_nms_overlap_threshold']
@@ -36,99 +50,50 @@ def rcnn_nms(cfg, mode, inputs, proposals, logits, deltas):
         raise ValueError('rcnn_nms(): invalid mode = %s?'%mode)
 
 
-    batch_size, _, depth, height, width = inputs.size() #original image width
     num_class = cfg['num_class']
 
-    # probs     = np_sigmoid(logits.cpu().data.numpy())
-    probs = F.softmax(logits, dim=1).cpu().data.numpy()
-    deltas = deltas.cpu().data.numpy().reshape(-1, num_class, 6)
-    proposals = proposals.cpu().data.numpy()
+    # everything stays on the device of logits, the host only sees the kept indices
+    probs = F.softmax(logits.detach().float(), dim=1)
+    deltas = deltas.detach().float().view(-1, num_class, 6)
+    proposals = proposals.detach().float()
+    batch_index = proposals[:, 0].long()
 
-    #non-max suppression
-    detections = []
-    # segments = []
-    keeps = []
-    
-    for b in range(batch_size):
-        detection = [np.empty((0, 9), np.float32),]
-
-        index = np.where(proposals[:,0] == b)[0]
-        if len(index)>0:
-            prob  = probs[index]
-            delta = deltas[index]
-            proposal = proposals[index]
-            # cats = np.argmax(prob, 1)
-
-            for j in range(1, num_class): #skip background
-                idx = np.where(prob[:, j] > nms_pre_score_threshold)[0]
-                # idx = np.where(cats == j)[0]
-                if len(idx)>0:
-                    p = prob[idx, j].reshape(-1, 1)
-                    d = delta[idx, j]
-                    box = rcnn_decode(proposal[idx, 2:8], d, cfg['box_reg_weight'])
-                    box = clip_boxes(box, inputs.shape[2:])
-                    # box = clip_boxes(box, width, height)
-
-                    # keep = filter_boxes(box, min_size = nms_min_size)
-                    # num  = len(keep)
-                    # if num>0:
-                        # box  = box[keep]
-                        # p    = p[keep]
-                    js = np.expand_dims(np.array([j] * len(p)), axis=-1)
-                    output = np.concatenate((p, box, js), 1)
-
-                    if len(output) > 0:
-                        output = torch.from_numpy(output).float()
-                        output, keep = torch_nms(output, nms_overlap_threshold)
-
-                    num = len(output)
-
-                    if num > 0:
-                        det = np.zeros((num, 9),np.float32)
-                        det[:, 0] = b
-                        det[:, 1:] = output
-                        detection.append(det)
-                        # segments.append(m[keep.numpy()])
-                        keeps.extend(index[idx[keep.numpy()]].tolist())
-
-        detection = np.vstack(detection)
-
-        detections.append(detection)
-
-    detections = Variable(torch.from_numpy(np.vstack(detections))).cuda()
-    # segments = np.vstack(segments)
-    return detections, keeps
+    # decode the boxes of every foreground class at once, [n, num_class - 1, 6]
+    windows = proposals[:, None, 2:8].expand(-1, num_class - 1, -1).reshape(-1, 6)
+    boxes = torch_box_transform_inv(windows, deltas[:, 1:].reshape(-1, 6), cfg['box_reg_weight'])
+    boxes = torch_clip_boxes(boxes, inputs.shape[2:]).view(-1, num_class - 1, 6)
 
+    #non-max suppression
+    detections = [proposals.new_zeros((0, 9))]
+    keeps = [batch_index.new_zeros((0,))]
+    orders = [batch_index.new_zeros((0,))]
 
-def get_probability(cfg, mode, inputs, proposals, logits, deltas):
-    if mode in ['train',]:
-        nms_pre_score_threshold = cfg['rcnn_train_nms_pre_score_threshold']
-        nms_overlap_threshold   = cfg['rcnn_train_nms_overlap_threshold']
+    for j in range(1, num_class): #skip background
+        idx = torch.nonzero(probs[:, j] > nms_pre_score_threshold).view(-1)
+        p = probs[idx, j]
+        box = boxes[idx, j - 1]
 
-    elif mode in ['valid', 'test','eval']:
-        nms_pre_score_threshold = cfg['rcnn_test_nms_pre_score_threshold']
-        nms_overlap_threshold   = cfg['rcnn_test_nms_overlap_threshold']
-    else:
-        raise ValueError('rcnn_nms(): invalid mode = %s?'%mode)
+        keep = batched_tensor_nms(box, p, batch_index[idx], nms_overlap_threshold)
+        js = torch.full((len(keep), 1), j, dtype=box.dtype, device=box.device)
+        detections.append(torch.cat((batch_index[idx[keep], None].float(), p[keep, None], box[keep], js), 1))
+        keeps.append(idx[keep])
+        orders.append(batch_index[idx[keep]] * num_class + j)
 
-    num_class = cfg['num_class']
-    probs = F.softmax(logits, dim=1).cpu().data.numpy()
-    # deltas = torch.from_numpy(deltas).cpu().data.numpy().reshape(-1, num_class, 6)
-    deltas = deltas.cpu().data.numpy().reshape(-1, num_class, 6)
-    proposals = proposals.cpu().data.numpy()
+    # same order as before: by image, then by class, then by descending probability
+    order = torch.sort(torch.cat(orders), stable=True)[1]
+    detections = torch.cat(detections)[order]
+    keeps = torch.cat(keeps)[order].tolist()
 
-    for j in range(1, num_class):  # skip background
-        idx = np.where(probs[:, j] > nms_pre_score_threshold)[0]
-        if len(idx) > 0:
-            p = probs[idx, j].reshape(-1, 1)
-            d = deltas[idx, j]
-            box = rcnn_decode(proposals [idx, 2:8], d, cfg['box_reg_weight'])
-            box = clip_boxes(box, inputs.shape[2:])
-            js = np.expand_dims(np.array([j] * len(p)), axis=-1)
-            output = np.concatenate((p, box, js), 1)
+    ensemble_proposals = None
+    if ensemble:
+        # probability of the last foreground class, as the ensemble always used
+        ensemble_proposals = proposals.clone()
+        ensemble_proposals[:, 1] = proposals[:, 1] * 0.5 + probs[:, -1] * 0.5
 
-    return torch.from_numpy(output).cuda().float()
+    return detections, keeps, ensemble_proposals
 
 
+def rcnn_nms(cfg, mode, inputs, proposals, logits, deltas):
+    detections, keeps, _ = rcnn_postprocess(cfg, mode, inputs, proposals, logits, deltas)
 
- 
+    return detections, keeps
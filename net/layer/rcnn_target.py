@@ -1,5 +1,6 @@
 import copy
 from net.layer.rcnn_nms import rcnn_encode
+from net.layer.util import torch_box_overlap, torch_box_transform
 import time
 import random
 import numpy as np
@@ -28,10 +29,11 @@ def add_truth_box_to_proposal(cfg, proposal, b, truth_box, truth_label, score=1)
 
 
 def make_one_rcnn_target(cfg, input, proposal, truth_box, truth_label):
-    sampled_proposal = torch.zeros((0, 8)).float().cuda()
-    sampled_label = torch.zeros((0, 1)).long().cuda()
+    device = input.device
+    sampled_proposal = torch.zeros((0, 8)).float().to(device)
+    sampled_label = torch.zeros((0, 1)).long().to(device)
     sampled_assign = np.zeros((0, 1), dtype=np.int32) - 1
-    sampled_target = torch.zeros((0, 6)).float().cuda()
+    sampled_target = torch.zeros((0, 6)).float().to(device)
 
     # Even if there is no ground truth box in this batch
     if len(proposal) == 0:
@@ -45,8 +47,8 @@ def make_one_rcnn_target(cfg, input, proposal, truth_box, truth_label):
             np.random.choice(bg_length, size=num_bg, replace=bg_length<num_bg)
         ]
         sampled_proposal = proposal[bg_index]
-        sampled_proposal = torch.from_numpy(sampled_proposal).cuda()
-        sampled_label = torch.zeros((num_bg)).long().cuda()
+        sampled_proposal = torch.from_numpy(sampled_proposal).to(device)
+        sampled_label = torch.zeros((num_bg)).long().to(device)
 
         return sampled_proposal, sampled_label, sampled_assign, sampled_target 
 
@@ -139,55 +141,141 @@ def make_one_rcnn_target(cfg, input, proposal, truth_box, truth_label):
         target_box = sampled_proposal[:num_fg,:][:, 2:8]
         sampled_target = rcnn_encode(target_box, target_truth_box, cfg['box_reg_weight'])
 
-    sampled_target   = Variable(torch.from_numpy(sampled_target)).float().cuda()
-    sampled_label    = Variable(torch.from_numpy(sampled_label)).long().cuda()
-    sampled_proposal = Variable(torch.from_numpy(sampled_proposal)).cuda()
+    sampled_target   = Variable(torch.from_numpy(sampled_target)).float().to(device)
+    sampled_label    = Variable(torch.from_numpy(sampled_label)).long().to(device)
+    sampled_proposal = Variable(torch.from_numpy(sampled_proposal)).to(device)
 
     return sampled_proposal, sampled_label, sampled_assign, sampled_target
 
 
-def make_rcnn_target(cfg, mode, inputs, proposals, truth_boxes, truth_labels):
-    truth_boxes = copy.deepcopy(truth_boxes)
-    truth_labels = copy.deepcopy(truth_labels)
+def _sample_per_image(index, group, quota, batch_size, generator=None):
+    """
+    Sample quota[b] of the candidate indices of every image b, without replacement,
+    or with replacement when an image has fewer candidates than its quota.
+
+    index: candidate indices, group: image of every candidate
+
+    return
+    index, group: sampled indices and their image, grouped by image
+    """
+    device = index.device
+
+    # random order within every image, then the first quota[b] of image b
+    order = torch.argsort(torch.rand(len(index), generator=generator, device=device), descending=True)
+    order = order[torch.argsort(group[order], stable=True)]
+    index, group = index[order], group[order]
+
+    count = torch.bincount(group, minlength=batch_size)
+    start = torch.cumsum(count, 0) - count
+    replace = count < quota
+    rank = torch.arange(len(index), device=device) - start[group]
+    keep = (rank < quota[group]) & ~replace[group]
+
+    draw_quota = torch.where(replace & (count > 0), quota, torch.zeros_like(quota))
+    draw_group = torch.repeat_interleave(torch.arange(batch_size, device=device), draw_quota)
+    draw = torch.rand(len(draw_group), generator=generator, device=device) * count[draw_group]
+    draw = start[draw_group] + torch.min(draw.long(), count[draw_group] - 1)
+
+    index = torch.cat([index[keep], index[draw]])
+    group = torch.cat([group[keep], draw_group])
+    order = torch.argsort(group, stable=True)
+
+    return index[order], group[order]
+
+
+def make_rcnn_target(cfg, mode, inputs, proposals, truth_boxes, truth_labels, generator=None):
+    """
+    Sample the rcnn training proposals of the whole batch with tensor ops on the
+    device of inputs, following make_one_rcnn_target image by image: at most
+    rcnn_train_fg_fraction * rcnn_train_batch_size foreground proposals, and
+    background proposals up to rcnn_train_batch_size.
+
+    proposals: [n, 8] tensor of [b, p, z, y, x, d, h, w] from rpn_nms
+    generator: torch.Generator on the device of inputs used for the sampling,
+               the default generator of the device if None
+
+    return
+    sampled_proposals: [m, 8] grouped by image, foreground first within an image
+    sampled_labels: [m] class label, 0 for the background
+    sampled_assigns: [m] index of the matched truth box within its image, -1 for the background
+    sampled_targets: [num_fg, 6] regression terms of the foreground proposals
+    """
+    device = inputs.device
     batch_size = len(inputs)
+    num = cfg['rcnn_train_batch_size']
+    num_fg = int(np.round(cfg['rcnn_train_fg_fraction'] * cfg['rcnn_train_batch_size']))
+
+    # ground truth boxes with a positive label of all images, uploaded at once
+    truth_box, truth_label, truth_group = [], [], []
     for b in range(batch_size):
         index = np.where(truth_labels[b] > 0)[0]
-        truth_boxes [b] = truth_boxes [b][index]
-        truth_labels[b] = truth_labels[b][index]
-
-    proposals = proposals.cpu().data.numpy()
-    sampled_proposals = []
-    sampled_labels = []
-    sampled_assigns = []
-    sampled_targets = []
+        truth_box.append(np.asarray(truth_boxes[b], np.float32).reshape(-1, 6)[index])
+        truth_label.append(np.asarray(truth_labels[b])[index])
+        truth_group.append(np.full(len(index), b))
+    truth_box = torch.from_numpy(np.concatenate(truth_box)).to(device)
+    truth_label = torch.from_numpy(np.concatenate(truth_label)).long().to(device)
+    truth_group = torch.from_numpy(np.concatenate(truth_group)).long().to(device)
+    num_truths = torch.bincount(truth_group, minlength=batch_size)
+    first = torch.cumsum(num_truths, 0) - num_truths
+
+    # Add ground truth box to proposal, so that even if the RPN branch fails to find something,
+    # we can still get classification branch to work
+    truth = torch.cat([truth_group[:, None].float(), torch.full_like(truth_group[:, None], score).float(),
+                       truth_box], 1)
+    if len(proposals) == 0:
+        proposals = torch.zeros((0, 8), device=device)
+    proposal = torch.cat([proposals.float(), truth], 0)
+    proposal = proposal[torch.argsort(proposal[:, 0], stable=True)]
+    group = proposal[:, 0].long()
+
+    # Determine positive or negative purely based on threshold, against the
+    # ground truth boxes of the same image
+    if len(truth_box):
+        overlap = torch_box_overlap(proposal[:, 2:8], truth_box)
+        overlap = torch.where(group[:, None] == truth_group[None, :], overlap, -torch.ones_like(overlap))
+        max_overlap, argmax_overlap = overlap.max(1)
+    else:
+        max_overlap = -torch.ones(len(proposal), device=device)
+        argmax_overlap = torch.zeros(len(proposal), dtype=torch.long, device=device)
+
+    # proposals of images without ground truth box are all background
+    has_truth = num_truths > 0
+    fg = (max_overlap >= cfg['rcnn_train_fg_thresh_low']) & has_truth[group]
+    bg = max_overlap < cfg['rcnn_train_bg_thresh_high']
+    fg_count = torch.bincount(group[fg], minlength=batch_size)
+    bg_count = torch.bincount(group[bg], minlength=batch_size)
+
+    # no bgs and no fgs: any proposal of the image as background
+    neither = (fg_count == 0) & (bg_count == 0)
+    bg = bg | neither[group]
+    bg_count = torch.bincount(group[bg], minlength=batch_size)
+
+    # sampling for class balance, with replacement only when an image with
+    # ground truth boxes has too few backgrounds
+    fg_quota = fg_count.clamp(max=num_fg)
+    bg_quota = torch.where(bg_count > 0, num - fg_quota, torch.zeros_like(fg_quota))
+    bg_quota = torch.where(has_truth, bg_quota, bg_count.clamp(max=num))
+
+    fg_index, fg_group = _sample_per_image(torch.nonzero(fg).flatten(), group[fg], fg_quota, batch_size, generator)
+    bg_index, bg_group = _sample_per_image(torch.nonzero(bg).flatten(), group[bg], bg_quota, batch_size, generator)
+
+    # selecting both fg and bg, foreground first within every image
+    index = torch.cat([fg_index, bg_index])
+    is_fg = torch.arange(len(index), device=device) < len(fg_index)
+    order = torch.argsort(torch.cat([fg_group, bg_group]) * 2 + (~is_fg).long(), stable=True)
+    index, is_fg = index[order], is_fg[order]
+
+    sampled_proposals = proposal[index]
+    assign = argmax_overlap[index][is_fg]
+
+    # label, background labels are 0 and assignments -1
+    sampled_labels = torch.zeros(len(index), dtype=torch.long, device=device)
+    sampled_labels[is_fg] = truth_label[assign]
+    sampled_assigns = torch.full((len(index),), -1, dtype=torch.long, device=device)
+    sampled_assigns[is_fg] = assign - first[group[index][is_fg]]
 
-    batch_size = len(truth_boxes)
-    for b in range(batch_size):
-        input = inputs[b]
-        truth_box = truth_boxes[b]
-        truth_label = truth_labels[b]
-
-        if len(proposals) == 0:
-            proposal = np.zeros((0, 8),np.float32)
-        else:
-            proposal = proposals[proposals[:,0] == b]
-
-        # Add ground truth box to proposal, so that even if the RPN branch fails to find something,
-        # we can still get classification branch to work
-        proposal = add_truth_box_to_proposal(cfg, proposal, b, truth_box, truth_label)
-
-        sampled_proposal, sampled_label, sampled_assign, sampled_target = \
-           make_one_rcnn_target(cfg, input, proposal, truth_box, truth_label)
-
-        sampled_proposals.append(sampled_proposal)
-        sampled_labels.append(sampled_label)
-        sampled_assigns.append(sampled_assign)
-        sampled_targets.append(sampled_target)
-
-    sampled_proposals = torch.cat(sampled_proposals, 0)
-    sampled_labels    = torch.cat(sampled_labels, 0)
-    sampled_targets   = torch.cat(sampled_targets, 0)
-    sampled_assigns   = np.hstack(sampled_assigns)
+    # bounding box regression terms
+    sampled_targets = torch_box_transform(sampled_proposals[is_fg, 2:8], truth_box[assign], cfg['box_reg_weight'])
 
     return sampled_proposals, sampled_labels, sampled_assigns, sampled_targets
 
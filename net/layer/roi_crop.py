@@ -0,0 +1,144 @@
+import torch
+import torch.nn.functional as F
+
+
+def roi_corners(proposals, scale, image_size):
+    """
+    Clamp proposals to the feature map, all on the device of proposals.
+
+    proposals: [n, b, p, z, y, x, d, h, w], in the coordinates of the input image
+    scale: stride of the feature map
+    image_size: [D, H, W] of the input image
+
+    return
+    c0, c1: [n, 3] long tensors, corners on the feature map, c1 is exclusive
+            and every roi keeps at least one voxel along each axis
+    """
+    center = proposals[:, 2:5]
+    side_length = proposals[:, 5:8]
+    c0 = center - side_length / 2  # left bottom corner
+    c1 = c0 + side_length  # right upper corner
+    c0 = (c0 / scale).floor().long()
+    c1 = (c1 / scale).ceil().long()
+
+    maximum = torch.tensor([int(s / scale) for s in image_size],
+                           dtype=torch.long, device=proposals.device)
+    c0 = torch.min(c0.clamp(min=0), maximum - 1)
+    c1 = torch.max(torch.min(c1, maximum), c0 + 1)
+
+    return c0, c1
+
+
+def _adaptive_bins(c0, c1, out_size):
+    """
+    Voxel indices covered by every output bin of adaptive pooling, same bin
+    boundaries as F.adaptive_max_pool3d.
+
+    return
+    index: [n, 3] list of [n, out, k] long tensors, bins shorter than k repeat
+           their last voxel, which does not change a max
+    """
+    length = c1 - c0
+    index = []
+    for axis in range(3):
+        o = out_size[axis]
+        i = torch.arange(o, device=c0.device)
+        L = length[:, axis:axis + 1]
+        start = (i * L) // o
+        end = ((i + 1) * L + o - 1) // o
+        k = int((end - start).max().item())
+        offset = torch.arange(k, device=c0.device)
+        idx = torch.min(start.unsqueeze(-1) + offset, end.unsqueeze(-1) - 1)
+        index.append(c0[:, axis].view(-1, 1, 1) + idx)
+
+    return index
+
+
+def _roi_pool(f, proposals, out_size, scale, image_size):
+    n = len(proposals)
+    c0, c1 = roi_corners(proposals, scale, image_size)
+    z, y, x = _adaptive_bins(c0, c1, out_size)
+
+    b = proposals[:, 0].long().view(n, 1, 1, 1, 1, 1, 1)
+    z = z.view(n, out_size[0], -1, 1, 1, 1, 1)
+    y = y.view(n, 1, 1, out_size[1], -1, 1, 1)
+    x = x.view(n, 1, 1, 1, 1, out_size[2], -1)
+
+    # [n, oz, kz, oy, ky, ox, kx, c]
+    crops = f[b, :, z, y, x]
+    crops = crops.amax(dim=(2, 4, 6))
+
+    return crops.permute(0, 4, 1, 2, 3).contiguous()
+
+
+def _roi_align(f, proposals, out_size, scale, image_size, sampling_ratio):
+    s = sampling_ratio
+    _, C, D, H, W = f.shape
+    size = torch.tensor([D, H, W], dtype=f.dtype, device=f.device)
+    crops = f.new_zeros((len(proposals), C) + tuple(out_size))
+
+    start = (proposals[:, 2:5] - proposals[:, 5:8] / 2) / scale - 0.5
+    bin_size = proposals[:, 5:8] / scale / torch.tensor(out_size, dtype=f.dtype, device=f.device)
+
+    for b in proposals[:, 0].long().unique().tolist():
+        index = torch.nonzero(proposals[:, 0].long() == b).view(-1)
+        n = len(index)
+
+        grid = []
+        for axis in range(3):
+            o = out_size[axis]
+            t = (torch.arange(o, dtype=f.dtype, device=f.device).view(-1, 1)
+                 + (torch.arange(s, dtype=f.dtype, device=f.device) + 0.5) / s).view(-1)
+            pts = start[index, axis:axis + 1] + t * bin_size[index, axis:axis + 1]
+            # normalize to [-1, 1] for align_corners=True
+            pts = 2 * pts / (size[axis] - 1).clamp(min=1) - 1
+            grid.append(pts)
+
+        oz, oy, ox = [o * s for o in out_size]
+        gz = grid[0].view(n, oz, 1, 1).expand(n, oz, oy, ox)
+        gy = grid[1].view(n, 1, oy, 1).expand(n, oz, oy, ox)
+        gx = grid[2].view(n, 1, 1, ox).expand(n, oz, oy, ox)
+        grid = torch.stack((gx, gy, gz), -1).view(1, n * oz, oy, ox, 3)
+
+        sample = F.grid_sample(f[b:b + 1], grid, mode='bilinear', align_corners=True)
+        sample = sample.view(C, n, out_size[0], s, out_size[1], s, out_size[2], s)
+        crops[index] = sample.mean(dim=(3, 5, 7)).transpose(0, 1)
+
+    return crops
+
+
+def roi_crop(f, proposals, out_size, scale, image_size, mode='pool', chunk_size=None, sampling_ratio=2):
+    """
+    Batched 3D roi crop, replaces the per-proposal crop + adaptive_max_pool3d loop.
+
+    f: feature map [B, C, D, H, W]
+    proposals: [n, 8] tensor of [b, p, z, y, x, d, h, w] in image coordinates
+    out_size: output size (d, h, w), e.g. rcnn_crop_size
+    scale: stride of f with respect to the input image
+    image_size: [D, H, W] of the input image
+    mode: 'pool', exact roi max pooling, same output as adaptive_max_pool3d on the
+          clamped crop; 'align', trilinear roi align averaged over sampling_ratio^3
+          points per bin
+    chunk_size: if set, proposals are cropped chunk_size at a time to bound memory
+
+    return
+    crops: [n, C, out_d, out_h, out_w]
+    """
+    out_size = tuple(int(o) for o in out_size)
+    if len(proposals) == 0:
+        return f.new_zeros((0, f.shape[1]) + out_size)
+
+    proposals = proposals.to(f.device)
+    chunk_size = chunk_size or len(proposals)
+
+    crops = []
+    for i in range(0, len(proposals), chunk_size):
+        p = proposals[i:i + chunk_size]
+        if mode == 'pool':
+            crops.append(_roi_pool(f, p, out_size, scale, image_size))
+        elif mode == 'align':
+            crops.append(_roi_align(f, p.to(f.dtype), out_size, scale, image_size, sampling_ratio))
+        else:
+            raise ValueError('roi_crop(): invalid mode = %s?' % mode)
+
+    return torch.cat(crops, 0)
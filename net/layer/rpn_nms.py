@@ -1,8 +1,9 @@
-import itertools
+import functools
 import numpy as np
 from torch.autograd import Variable
 import torch
-from net.layer.util import box_transform, box_transform_inv, clip_boxes
+from net.layer.util import box_transform, box_transform_inv, clip_boxes, \
+    torch_box_transform_inv, torch_clip_boxes, batched_tensor_nms, to_float_tensor
 
 try:
     from utils.pybox import *
@@ -12,87 +13,135 @@ except ImportError:
     from utils.util import py_box_overlap as torch_overlap
 
 
-def make_rpn_windows(f, cfg):
+@functools.lru_cache(maxsize=16)
+def _rpn_windows(feature_shape, stride, anchors):
+    D, H, W = feature_shape
+    anchors = np.asarray(anchors)
+    offset = (float(stride) - 1) / 2
+    oz = offset + stride * np.arange(D)
+    oh = offset + stride * np.arange(H)
+    ow = offset + stride * np.arange(W)
+
+    # same row order as itertools.product(oz, oh, ow, anchors)
+    windows = np.empty((D, H, W, len(anchors), 6))
+    windows[..., 0] = oz[:, None, None, None]
+    windows[..., 1] = oh[None, :, None, None]
+    windows[..., 2] = ow[None, None, :, None]
+    windows[..., 3:] = anchors
+
+    # shared by every caller of the cache, an in-place edit would corrupt all later forwards
+    windows = windows.reshape(-1, 6)
+    windows.flags.writeable = False
+    return windows
+
+
+@functools.lru_cache(maxsize=16)
+def _rpn_windows_tensor(feature_shape, stride, anchors, device):
+    return to_float_tensor(_rpn_windows(feature_shape, stride, anchors), device)
+
+
+def make_rpn_windows(f, cfg, device=None):
     """
     Generating anchor boxes at each voxel on the feature map,
     the center of the anchor box on each voxel corresponds to center
     on the original input image.
 
+    Windows only depend on (feature shape, stride, anchors) and are kept in a
+    process-wide LRU cache, so the returned array is shared and read-only, the
+    cached tensors must not be modified in place either.
+
+    device: if set, return a float32 tensor on that device instead, also cached
+
     return
     windows: list of anchor boxes, [z, y, x, d, h, w]
     """
+    feature_shape = tuple(int(s) for s in f.shape[2:])
+    anchors = tuple(tuple(float(v) for v in a) for a in cfg['anchors'])
     stride = cfg['stride']  # /2
-    anchors = np.asarray(cfg['anchors'])
-    offset = (float(stride) - 1) / 2
-    _, _, D, H, W = f.shape
-    oz = np.arange(offset, offset + stride * (D - 1) + 1, stride)
-    oh = np.arange(offset, offset + stride * (H - 1) + 1, stride)
-    ow = np.arange(offset, offset + stride * (W - 1) + 1, stride)
 
-    windows = []
-    for z, y, x, a in itertools.product(oz, oh, ow, anchors):
-        windows.append([z, y, x, a[0], a[1], a[2]])
-    windows = np.array(windows)
+    if device is not None:
+        return _rpn_windows_tensor(feature_shape, stride, anchors, str(torch.device(device)))
 
-    return windows
+    return _rpn_windows(feature_shape, stride, anchors)
+
+
+def rpn_nms(cfg, mode, inputs, window, logits_flat, deltas_flat, stats=None):
+    """
+    Threshold, decode, clip and nms the rpn outputs of all images at once,
+    on the device of logits_flat.
 
+    At most pre_nms_top_n boxes per image enter nms and at most post_nms_top_n
+    leave it, so the cost of nms and of the rcnn stage is bounded whatever the scan.
 
-def rpn_nms(cfg, mode, inputs, window, logits_flat, deltas_flat):
+    window: anchor boxes from make_rpn_windows, numpy array or tensor
+    stats: optional list, one dict per image with the number of boxes seen by
+           every stage is appended to it
+
+    return
+    proposals: [n, 8] tensor of [b, p, z, y, x, d, h, w], grouped by image,
+               by descending probability within an image
+    """
     if mode in ['train', ]:
         nms_pre_score_threshold = cfg['rpn_train_nms_pre_score_threshold']
         nms_overlap_threshold = cfg['rpn_train_nms_overlap_threshold']
+        pre_nms_top_n = cfg['rpn_train_pre_nms_top_n']
+        post_nms_top_n = cfg['rpn_train_post_nms_top_n']
 
     elif mode in ['eval', 'valid', 'test', ]:
         nms_pre_score_threshold = cfg['rpn_test_nms_pre_score_threshold']
         nms_overlap_threshold = cfg['rpn_test_nms_overlap_threshold']
+        pre_nms_top_n = cfg['rpn_test_pre_nms_top_n']
+        post_nms_top_n = cfg['rpn_test_post_nms_top_n']
 
     else:
         raise ValueError('rpn_nms(): invalid mode = %s?' % mode)
 
-    logits = torch.sigmoid(logits_flat).data.cpu().numpy()
-    deltas = deltas_flat.data.cpu().numpy()
-    batch_size, _, depth, height, width = inputs.size()
-
-    proposals = []
-    for b in range(batch_size):
-        proposal = [np.empty((0, 8), np.float32), ]
-
-        ps = logits[b, :, 0].reshape(-1, 1)
-        ds = deltas[b, :, :]
-
-        # Only those anchor boxes larger than a pre-defined threshold
-        # will be chosen for nms computation
-        index = np.where(ps[:, 0] > nms_pre_score_threshold)[0]
-        if len(index) > 0:
-            p = ps[index]
-            d = ds[index]
-            w = window[index]
-            box = rpn_decode(w, d, cfg['box_reg_weight'])
-            box = clip_boxes(box, inputs.shape[2:])
-
-            output = np.concatenate((p, box), 1)
-
-            output = torch.from_numpy(output)
-            output, keep = torch_nms(output, nms_overlap_threshold)
-
-            prop = np.zeros((len(output), 8), np.float32)
-            prop[:, 0] = b
-            prop[:, 1:8] = output
-
-            proposal.append(prop)
-
-        proposal = np.vstack(proposal)
-        proposals.append(proposal)
-
-    proposals = np.vstack(proposals)
-
-    # Just in case if there is no proposal, we still return a Tensor,
-    # torch.from_numpy() cannot take input with 0 dim
-    if len(proposals) != 0:
-        proposals = Variable(torch.from_numpy(proposals)).cuda()
-        return proposals
+    device = logits_flat.device
+    batch_size, num_window = logits_flat.shape[:2]
+    window = to_float_tensor(window, device)
+    probs = torch.sigmoid(logits_flat[:, :, 0].detach().float())
+
+    # Only those anchor boxes larger than a pre-defined threshold
+    # will be chosen for nms computation, at most pre_nms_top_n per image
+    # (partial sort, the top-k of the thresholded boxes is the thresholded top-k)
+    above_threshold = (probs > nms_pre_score_threshold).sum(1)
+    if pre_nms_top_n and pre_nms_top_n < num_window:
+        top_probs, top_index = torch.topk(probs, pre_nms_top_n, dim=1, sorted=False)
+        batch_index, k = torch.nonzero(top_probs > nms_pre_score_threshold, as_tuple=True)
+        index = top_index[batch_index, k]
     else:
-        return Variable(torch.rand([0, 8])).cuda()
+        batch_index, index = torch.nonzero(probs > nms_pre_score_threshold, as_tuple=True)
+
+    p = probs[batch_index, index]
+    box = torch_box_transform_inv(window[index], deltas_flat[batch_index, index].detach().float(),
+                                  cfg['box_reg_weight'])
+    box = torch_clip_boxes(box, inputs.shape[2:])
+
+    keep = batched_tensor_nms(box, p, batch_index, nms_overlap_threshold)
+    post_nms = batch_index[keep]
+    if post_nms_top_n:
+        # keep is grouped by image, rank within the image from the first index of its group
+        rank = torch.arange(len(keep), device=device) - torch.searchsorted(post_nms, post_nms)
+        keep = keep[rank < post_nms_top_n]
+    proposals = torch.cat((batch_index[keep, None].float(), p[keep, None], box[keep]), 1)
+
+    if stats is not None:
+        counts = torch.stack([
+            above_threshold,
+            torch.bincount(batch_index, minlength=batch_size),
+            torch.bincount(post_nms, minlength=batch_size),
+            torch.bincount(batch_index[keep], minlength=batch_size),
+        ]).tolist()
+        for b in range(batch_size):
+            stats.append({
+                'anchors': num_window,
+                'above_threshold': counts[0][b],
+                'pre_nms': counts[1][b],
+                'post_nms': counts[2][b],
+                'proposals': counts[3][b],
+            })
+
+    return proposals
 
 
 def rpn_encode(window, truth_box, weight):
@@ -3,6 +3,8 @@ import torch
 import random
 from torch.autograd import Variable
 from net.layer.rpn_nms import rpn_encode
+from net.layer.util import torch_box_transform, to_float_tensor
+from net.lib.box.overlap.sparse_overlap import sparse_box_overlap, sparse_max_overlap
 
 try:
     from utils.pybox import *
@@ -45,16 +47,16 @@ def make_one_rpn_target(cfg, mode, input, window, truth_box, truth_label):
 
         _, depth, height, width = input.size()
 
-        # Get sure background anchor boxes
-        overlap = torch_overlap(window, truth_box)
+        # Get sure background anchor boxes, only the anchor/truth pairs that
+        # intersect are computed, most anchors are nowhere near a nodule
+        i, j, overlap = sparse_box_overlap(window, truth_box)
+        max_overlap, argmax_overlap, best, best_assign = \
+            sparse_max_overlap(i, j, overlap, num_window, num_truth_box)
 
-        # For each anchor box, get the index of the ground truth box that
-        # has the largest IoU with it
-        argmax_overlap = np.argmax(overlap, 1)
-
-        # For each anchor box, get the IoU of the ground truth box that
-        # has the largest IoU with it
-        max_overlap = overlap[np.arange(num_window), argmax_overlap]
+        # For each anchor box, the index and the IoU of the ground truth box
+        # that has the largest IoU with it
+        max_overlap = max_overlap.cpu().numpy()
+        argmax_overlap = argmax_overlap.cpu().numpy()
 
         # The anchor box is a sure background, if its largest IoU is less than
         # a threshold
@@ -72,15 +74,11 @@ def make_one_rpn_target(cfg, mode, input, window, truth_box, truth_label):
         # In case no anchor box that overlaps with the ground truth box meets the threshold, 
         # for each ground truth box, we include anchor box that has the highest IoU with it, 
         # include multiple maxs if there exists more than one anchor box
-        argmax_overlap = np.argmax(overlap, 0)
-        max_overlap = overlap[argmax_overlap, np.arange(num_truth_box)]
-        argmax_overlap, a = np.where(overlap == max_overlap)
-
-        fg_index = argmax_overlap
+        fg_index = np.where(best.cpu().numpy())[0]
 
         label[fg_index] = 1
         label_weight[fg_index] = 1
-        label_assign[fg_index] = a
+        label_assign[fg_index] = best_assign.cpu().numpy()[fg_index]
 
         # In case one ground truth box within one batch has way too many positive anchors, 
         # which may affect the sample in the loss fucntion,
@@ -136,40 +134,102 @@ def make_one_rpn_target(cfg, mode, input, window, truth_box, truth_label):
             bg_index = bg_index[idx]
             label_weight[bg_index] = 1.0 / len(bg_index)
 
-    label = Variable(torch.from_numpy(label)).cuda()
-    label_assign = Variable(torch.from_numpy(label_assign)).cuda()
-    label_weight = Variable(torch.from_numpy(label_weight)).cuda()
-    target = Variable(torch.from_numpy(target)).cuda()
-    target_weight = Variable(torch.from_numpy(target_weight)).cuda()
+    device = input.device
+    label = Variable(torch.from_numpy(label)).to(device)
+    label_assign = Variable(torch.from_numpy(label_assign)).to(device)
+    label_weight = Variable(torch.from_numpy(label_weight)).to(device)
+    target = Variable(torch.from_numpy(target)).to(device)
+    target_weight = Variable(torch.from_numpy(target_weight)).to(device)
     return label, label_assign, label_weight, target, target_weight
 
 
-def make_rpn_target(cfg, mode, inputs, window, truth_boxes, truth_labels):
-    rpn_labels = []
-    rpn_label_assigns = []
-    rpn_label_weights = []
-    rpn_targets = []
-    rpn_targets_weights = []
+def make_rpn_target(cfg, mode, inputs, window, truth_boxes, truth_labels, generator=None):
+    """
+    Generate region proposal targets for the whole batch at once, with tensor ops
+    on the device of inputs. Labels follow make_one_rpn_target image by image,
+    the random anchor sampling is drawn from generator instead of python's random.
+
+    window: anchor boxes from make_rpn_windows, numpy array or tensor
+    truth_boxes, truth_labels: per image numpy arrays, see make_one_rpn_target
+    generator: torch.Generator on the device of inputs used to sample the positive
+               and negative anchors, the default generator of the device if None
 
+    return torch tensors of [batch, num_window] ([batch, num_window, 6] for the targets)
+    """
+    device = inputs.device
     batch_size = len(inputs)
-    for b in range(batch_size):
-        input = inputs[b]
-        truth_box = truth_boxes[b]
-        truth_label = truth_labels[b]
-
-        rpn_label, rpn_label_assign, rpn_label_weight, rpn_target, rpn_targets_weight = \
-            make_one_rpn_target(cfg, mode, input, window, truth_box, truth_label)
-
-        rpn_labels.append(rpn_label.view(1, -1))
-        rpn_label_assigns.append(rpn_label_assign.view(1, -1))
-        rpn_label_weights.append(rpn_label_weight.view(1, -1))
-        rpn_targets.append(rpn_target.view(1, -1, 6))
-        rpn_targets_weights.append(rpn_targets_weight.view(1, -1))
-
-    rpn_labels = torch.cat(rpn_labels, 0)
-    rpn_label_assigns = torch.cat(rpn_label_assigns, 0)
-    rpn_label_weights = torch.cat(rpn_label_weights, 0)
-    rpn_targets = torch.cat(rpn_targets, 0)
-    rpn_targets_weights = torch.cat(rpn_targets_weights, 0)
-
-    return rpn_labels, rpn_label_assigns, rpn_label_weights, rpn_targets, rpn_targets_weights
+    window = to_float_tensor(window, device)
+    num_window = len(window)
+    num_neg = cfg['num_neg']
+
+    label = torch.zeros((batch_size, num_window), device=device)
+    label_assign = torch.full((batch_size, num_window), -1, dtype=torch.long, device=device)
+    label_weight = torch.ones((batch_size, num_window), device=device)
+    target = torch.zeros((batch_size, num_window, 6), device=device)
+
+    # all truth boxes of the batch, uploaded at once, with the image they belong to
+    num_truths = [0 if box is None else len(box) for box in truth_boxes]
+    if sum(num_truths):
+        truth_box = torch.from_numpy(np.concatenate(
+            [np.asarray(box, np.float32).reshape(-1, 6) for box in truth_boxes if box is not None])).to(device)
+        truth_label = torch.from_numpy(np.concatenate(
+            [np.asarray(l).reshape(-1) for l, n in zip(truth_labels, num_truths) if n])).to(device)
+        num_truths = torch.tensor(num_truths, device=device)
+        truth_group = torch.repeat_interleave(torch.arange(batch_size, device=device), num_truths)
+        first = (torch.cumsum(num_truths, 0) - num_truths)[:, None]
+        has_truth = (num_truths > 0)[:, None]
+
+        # one row of anchors per image, anchor i against truth j lives in row truth_group[j]
+        i, j, overlap = sparse_box_overlap(window, truth_box)
+        i = truth_group[j] * num_window + i
+        anchor_group = torch.arange(batch_size, device=device).repeat_interleave(num_window)
+        max_overlap, argmax_overlap, best, best_assign = sparse_max_overlap(
+            i, j, overlap, batch_size * num_window, len(truth_box), anchor_group, truth_group)
+        max_overlap = max_overlap.view(batch_size, num_window)
+        best = best.view(batch_size, num_window)
+
+        # Sure background below bg_thresh_high, sure foreground from fg_thresh_low
+        # or with the largest IoU of a ground truth box, images without ground
+        # truth box keep every anchor as background
+        label_weight = torch.where(has_truth, (max_overlap < cfg['rpn_train_bg_thresh_high']).float(), label_weight)
+        fg = (max_overlap >= cfg['rpn_train_fg_thresh_low']) | best
+        argmax_overlap = torch.where(max_overlap > 0, argmax_overlap.view(batch_size, num_window) - first, 0)
+        label_assign = torch.where(has_truth, argmax_overlap, label_assign)
+        label_assign = torch.where(best, best_assign.view(batch_size, num_window) - first, label_assign)
+
+        # Only one random positive anchor per image is kept, see make_one_rpn_target
+        keys = torch.rand((batch_size, num_window), generator=generator, device=device)
+        pick = torch.where(fg, keys, -1.).argmax(1)
+        label_weight[fg] = 0
+        rows = torch.nonzero(fg.any(1)).flatten()
+        cols = pick[rows]
+        assign = first[rows, 0] + label_assign[rows, cols]
+        label[rows, cols] = 1
+        # This should by no means be used, left just in case
+        label_weight[rows, cols] = (truth_label[assign] >= 0).float()
+
+        # Prepare regression terms for each positive anchor
+        target[rows, cols] = torch_box_transform(window[cols], truth_box[assign], cfg['box_reg_weight'])
+
+    if mode in ['train']:
+        fg = (label_weight != 0) & (label != 0)
+        bg = (label_weight != 0) & (label == 0)
+
+        # Random sample num_neg negative anchor boxes first
+        # This is very strange, but it works well in practice
+        # It makes the use of hard negative example mining loss, not
+        # actually hard negative example mining.
+        keys = torch.rand((batch_size, num_window), generator=generator, device=device)
+        keys, idx = torch.where(bg, keys, -1.).topk(min(num_neg, num_window), 1)
+        sampled = keys >= 0
+
+        # Calculate weight for class balance
+        num_fg = fg.sum(1).clamp(min=1).float()
+        num_bg = sampled.sum(1).clamp(min=1).float()
+        label_weight[bg] = 0
+        rows = torch.nonzero(sampled)[:, 0]
+        label_weight[rows, idx[sampled]] = (num_fg / num_bg)[rows]
+
+    target_weight = torch.where(label != 0, label_weight, torch.zeros_like(label_weight))
+
+    return label, label_assign.int(), label_weight, target, target_weight
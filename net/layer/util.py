@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 
 def box_transform(windows, targets, weight):
@@ -78,4 +79,158 @@ def clip_boxes(boxes, img_size):
     boxes[:, 1] = np.clip(boxes[:, 1], 0, height - 1)
     boxes[:, 2] = np.clip(boxes[:, 2], 0, width  - 1)
 
-    return boxes
\ No newline at end of file
+    return boxes
+
+
+def torch_box_transform(windows, targets, weight):
+    """
+    Tensor version of box_transform, runs on the device of windows
+    windows: [num_window, z, y, x, D, H, W]
+    targets: [num_target, z, y, x, D, H, W]
+    """
+    weight = torch.as_tensor(weight, dtype=windows.dtype, device=windows.device)
+    targets = targets.to(windows.dtype)
+
+    center = (targets[:, :3] - windows[:, :3]) / windows[:, 3:]
+    size = torch.log(targets[:, 3:] / windows[:, 3:])
+
+    return torch.cat((center, size), 1) * weight
+
+
+def to_float_tensor(array, device):
+    """
+    float32 tensor on device of a numpy array or tensor, numpy arrays are copied
+    so read-only arrays (e.g. the cached rpn windows) can be passed
+    """
+    if isinstance(array, np.ndarray):
+        return torch.tensor(array, dtype=torch.float32, device=device)
+    return array.to(device).float()
+
+
+def torch_box_transform_inv(windows, deltas, weight):
+    """
+    Tensor version of box_transform_inv, runs on the device of windows
+    windows: [num_window, z, y, x, D, H, W]
+    deltas: [num_window, dz, dy, dx, dd, dh, dw]
+    """
+    weight = torch.as_tensor(weight, dtype=deltas.dtype, device=deltas.device)
+    deltas = deltas / weight
+    windows = windows.to(deltas.dtype)
+
+    center = deltas[:, :3] * windows[:, 3:] + windows[:, :3]
+    size = torch.exp(deltas[:, 3:]) * windows[:, 3:]
+
+    return torch.cat((center, size), 1)
+
+
+def torch_clip_boxes(boxes, img_size):
+    """
+    Tensor version of clip_boxes, returns a new tensor, boxes follow [z, y, x, d, h, w]
+    """
+    maximum = torch.tensor([s - 1 for s in img_size], dtype=boxes.dtype, device=boxes.device)
+    center = torch.max(torch.min(boxes[:, :3], maximum), torch.zeros_like(maximum))
+
+    return torch.cat((center, boxes[:, 3:]), 1)
+
+
+def torch_box_overlap(boxes1, boxes2):
+    """
+    Pairwise 3D IoU of [z, y, x, d, h, w] boxes, [len(boxes1), len(boxes2)]
+    """
+    lo1, hi1 = boxes1[:, None, :3] - boxes1[:, None, 3:] / 2., boxes1[:, None, :3] + boxes1[:, None, 3:] / 2.
+    lo2, hi2 = boxes2[None, :, :3] - boxes2[None, :, 3:] / 2., boxes2[None, :, :3] + boxes2[None, :, 3:] / 2.
+    intersect = (torch.min(hi1, hi2) - torch.max(lo1, lo2)).clamp(min=0).prod(2)
+    areas1 = boxes1[:, 3:].prod(1)
+    areas2 = boxes2[:, 3:].prod(1)
+
+    return intersect / (areas1[:, None] + areas2[None, :] - intersect)
+
+
+def _greedy_nms_cpu(boxes, thresh):
+    """
+    Greedy pass of tensor_nms on cpu, boxes sorted by descending score. Like py_nms
+    only the kept boxes are compared with the remaining ones, in numpy; the box
+    columns are compacted as boxes get suppressed instead of gathered every step.
+    """
+    boxes = boxes.detach().numpy()
+    lo = [np.ascontiguousarray(c) for c in (boxes[:, :3] - boxes[:, 3:] / 2.).T]
+    hi = [np.ascontiguousarray(c) for c in (boxes[:, :3] + boxes[:, 3:] / 2.).T]
+    areas = boxes[:, 3:].prod(1)
+
+    keep = []
+    remaining = np.arange(len(boxes))
+    while len(remaining) > 0:
+        keep.append(remaining[0])
+        intersect = np.maximum(np.minimum(hi[0][0], hi[0][1:]) - np.maximum(lo[0][0], lo[0][1:]), 0)
+        for k in (1, 2):
+            intersect *= np.maximum(np.minimum(hi[k][0], hi[k][1:]) - np.maximum(lo[k][0], lo[k][1:]), 0)
+        overlap = intersect / (areas[0] + areas[1:] - intersect)
+
+        left = ~(overlap > thresh)
+        remaining, areas = remaining[1:][left], areas[1:][left]
+        lo = [c[1:][left] for c in lo]
+        hi = [c[1:][left] for c in hi]
+
+    return torch.from_numpy(np.array(keep, dtype=np.int64))
+
+
+def tensor_nms(boxes, scores, thresh, block_size=512):
+    """
+    Greedy nms on the device of boxes, same rule as torch_nms / py_nms: a box is
+    suppressed by a kept box of higher score when their overlap is > thresh.
+
+    On cuda, overlaps are computed block_size rows at a time against all higher
+    scoring boxes, so memory is O(block_size * n), and nothing is copied to the host.
+    On cpu the greedy pass only visits the kept boxes (see _greedy_nms_cpu), a
+    per-box loop of tensor ops would be several times slower than py_nms.
+
+    boxes: [n, 6] z, y, x, d, h, w
+    scores: [n]
+
+    return
+    keep: indices of the kept boxes, by descending score
+    """
+    n = len(boxes)
+    if n == 0:
+        return torch.zeros((0,), dtype=torch.long, device=boxes.device)
+
+    order = torch.argsort(scores, descending=True)
+    boxes = boxes[order]
+    if not boxes.is_cuda:
+        return order[_greedy_nms_cpu(boxes, thresh)]
+
+    keep = torch.ones(n, dtype=torch.bool, device=boxes.device)
+
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        suppress = torch_box_overlap(boxes[start:end], boxes[:end]) > thresh
+
+        # suppressed by a kept box of an earlier block
+        keep[start:end] &= ~(suppress[:, :start] & keep[:start]).any(1)
+
+        # greedy within the block, only higher scoring boxes suppress lower ones
+        suppress = suppress[:, start:end]
+        for i in range(end - start - 1):
+            keep[start + i + 1:end] &= ~(suppress[i, i + 1:] & keep[start + i])
+
+    return order[keep]
+
+
+def batched_tensor_nms(boxes, scores, groups, thresh):
+    """
+    tensor_nms run independently for every group (e.g. image index) in one call,
+    boxes of different groups are shifted apart so that they never overlap.
+
+    return
+    keep: indices of the kept boxes, sorted by group then by descending score
+    """
+    if len(boxes) == 0:
+        return torch.zeros((0,), dtype=torch.long, device=boxes.device)
+
+    span = boxes[:, 0].abs().max() + boxes[:, 3].max() + 1
+    shifted = boxes.clone()
+    shifted[:, 0] = shifted[:, 0] + groups.to(boxes.dtype) * span
+    keep = tensor_nms(shifted, scores, thresh)
+
+    return keep[torch.sort(groups[keep], stable=True)[1]]
+
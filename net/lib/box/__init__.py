@@ -1,2 +1,6 @@
-from nms.torch_nms import torch_nms
-from overlap.torch_overlap import torch_overlap
\ No newline at end of file
+try:
+    from net.lib.box.nms.torch_nms import torch_nms
+    from net.lib.box.overlap.torch_overlap import torch_overlap
+except ImportError:
+    # the C extensions are not built, only the pure python modules are available
+    pass
@@ -0,0 +1 @@
+from net.lib.box.nms.sweep_nms import sweep_nms, NMS_METHODS
@@ -0,0 +1,146 @@
+import numpy as np
+import torch
+
+
+NMS_METHODS = ['hard', 'soft_linear', 'soft_gaussian', 'wbf']
+
+
+def _corners(boxes):
+    """
+    boxes: [n, 6] numpy array of [z, y, x, d, h, w]
+
+    return
+    lo, hi: [n, 3] box corners
+    areas: [n] box volumes
+    """
+    return boxes[:, :3] - boxes[:, 3:] / 2., boxes[:, :3] + boxes[:, 3:] / 2., np.prod(boxes[:, 3:], axis=1)
+
+
+def _overlap(lo, hi, areas, i, rest):
+    """
+    IoU of box i with the boxes rest, same formula as py_nms
+    """
+    intersect = np.prod(np.maximum(0.0, np.minimum(hi[i], hi[rest]) - np.maximum(lo[i], lo[rest])), axis=1)
+    return intersect / (areas[i] + areas[rest] - intersect)
+
+
+def _hard_nms(scores, boxes, thresh):
+    """
+    Greedy sweep like py_nms: every kept box is only compared with the boxes not
+    suppressed yet, so dense clusters shrink as fast as they are suppressed. The box
+    columns are compacted along with the remaining boxes.
+
+    return
+    keep: kept boxes by descending score
+    leader: for every box, the kept box that suppressed it (itself when kept)
+    """
+    remaining = np.argsort(-scores, kind='stable')
+    lo, hi, areas = _corners(boxes[remaining])
+    lo, hi = [np.ascontiguousarray(c) for c in lo.T], [np.ascontiguousarray(c) for c in hi.T]
+
+    keep, leader = [], np.arange(len(scores))
+    while len(remaining) > 0:
+        k = remaining[0]
+        keep.append(k)
+        intersect = np.ones(len(remaining) - 1)
+        for c in range(3):
+            intersect *= np.maximum(0.0, np.minimum(hi[c][0], hi[c][1:]) - np.maximum(lo[c][0], lo[c][1:]))
+        suppressed = intersect / (areas[0] + areas[1:] - intersect) > thresh
+
+        leader[remaining[1:][suppressed]] = k
+        left = ~suppressed
+        remaining, areas = remaining[1:][left], areas[1:][left]
+        lo = [c[1:][left] for c in lo]
+        hi = [c[1:][left] for c in hi]
+
+    return np.array(keep, np.int64), leader
+
+
+def _soft_nms(scores, boxes, thresh, method, sigma, score_thresh):
+    """
+    Soft-NMS sweep: the highest scoring remaining box is kept and the scores of the
+    other remaining boxes are decayed by their overlap with it. Scores only decrease,
+    so boxes below score_thresh are dropped for good as soon as they fall below it.
+    The columns are compacted once at least half of the boxes are dropped.
+    """
+    remaining = np.nonzero(scores >= score_thresh)[0]
+    decayed = scores.astype(np.float64).copy()
+    live = decayed[remaining]
+    alive = np.ones(len(remaining), bool)
+    lo, hi, areas = _corners(boxes[remaining])
+    lo, hi = [np.ascontiguousarray(c) for c in lo.T], [np.ascontiguousarray(c) for c in hi.T]
+
+    keep = []
+    while alive.any():
+        b = np.argmax(np.where(alive, live, -np.inf))
+        keep.append(remaining[b])
+        decayed[remaining[b]] = live[b]
+        alive[b] = False
+
+        intersect = np.maximum(0.0, np.minimum(hi[0][b], hi[0]) - np.maximum(lo[0][b], lo[0]))
+        for c in (1, 2):
+            intersect *= np.maximum(0.0, np.minimum(hi[c][b], hi[c]) - np.maximum(lo[c][b], lo[c]))
+        overlap = intersect / (areas[b] + areas - intersect)
+        if method == 'soft_linear':
+            live *= np.where(overlap > thresh, 1 - overlap, 1.0)
+        else:
+            live *= np.exp(-overlap ** 2 / sigma)
+        alive &= live >= score_thresh
+
+        if np.count_nonzero(alive) * 2 < len(alive):
+            remaining, live, areas = remaining[alive], live[alive], areas[alive]
+            lo = [c[alive] for c in lo]
+            hi = [c[alive] for c in hi]
+            alive = np.ones(len(remaining), bool)
+
+    return np.array(keep, np.int64), decayed
+
+
+def sweep_nms(dets, thresh, method='hard', sigma=0.5, score_thresh=0.001):
+    """
+    Hard, soft and fused 3D nms, same inputs and outputs as torch_nms.
+
+    dets: [n, 7 + k] numpy array or cpu tensor of [p, z, y, x, d, h, w, ...],
+          extra columns (e.g. class) are carried over
+    method:
+        'hard': greedy nms, a box is suppressed by a kept box of higher score
+                when their overlap is > thresh, same result as torch_nms / py_nms
+        'soft_linear', 'soft_gaussian': Soft-NMS, overlapping boxes are kept with a
+                decayed score (1 - iou for iou > thresh, or exp(-iou^2 / sigma)),
+                boxes whose score falls below score_thresh are dropped
+        'wbf': weighted box fusion, every box kept by hard nms is replaced by the
+               score-weighted average of itself and the boxes it suppressed
+
+    return
+    dets: kept (or fused / re-scored) boxes by descending score
+    keep: their indices into the input dets
+    """
+    if method not in NMS_METHODS:
+        raise ValueError('sweep_nms(): invalid method = %s?' % method)
+
+    is_tensor = isinstance(dets, torch.Tensor)
+    array = dets.detach().cpu().numpy() if is_tensor else np.asarray(dets)
+    if len(array) == 0:
+        keep = np.zeros((0,), np.int64)
+        return (dets[:0], torch.from_numpy(keep)) if is_tensor else (array[:0], keep)
+
+    scores = array[:, 0]
+    boxes = array[:, 1:7].astype(np.float64)
+
+    if method in ['hard', 'wbf']:
+        keep, leader = _hard_nms(scores, boxes, thresh)
+        out = array[keep].copy()
+        if method == 'wbf':
+            weight = np.zeros(len(array))
+            fused = np.zeros((len(array), 6))
+            np.add.at(weight, leader, scores)
+            np.add.at(fused, leader, scores[:, None] * boxes)
+            out[:, 1:7] = fused[keep] / np.maximum(weight[keep], 1e-12)[:, None]
+    else:
+        keep, decayed = _soft_nms(scores, boxes, thresh, method, sigma, score_thresh)
+        out = array[keep].copy()
+        out[:, 0] = decayed[keep]
+
+    if is_tensor:
+        return torch.from_numpy(out).to(dets.dtype), torch.from_numpy(keep)
+    return out, keep
@@ -0,0 +1 @@
+from net.lib.box.overlap.sparse_overlap import sparse_box_overlap, sparse_max_overlap
@@ -0,0 +1,132 @@
+import numpy as np
+import torch
+
+
+def _as_tensor(boxes, device=None):
+    if isinstance(boxes, np.ndarray):
+        # copied, the rpn windows are a read-only cached array
+        boxes = torch.tensor(boxes)
+    return boxes.to(device) if device is not None else boxes
+
+
+def _expand(starts, counts):
+    """
+    starts + arange(count) for every (start, count), concatenated, and the index of
+    the (start, count) each value comes from
+    """
+    owner = torch.repeat_interleave(torch.arange(len(counts), device=counts.device), counts)
+    offset = torch.arange(len(owner), device=counts.device) - \
+        torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+    return starts[owner] + offset, owner
+
+
+def sparse_box_overlap(boxes1, boxes2):
+    """
+    Overlap (IoU) of the box pairs that actually intersect, without building the
+    dense [len(boxes1), len(boxes2)] matrix.
+
+    boxes1 are bucketed once into a 3D grid whose cells are as large as the largest
+    box of boxes1 on every axis, then for every box of boxes2 only the boxes1 in the
+    cells within reach ((size2 + max size1) / 2 on each axis) are candidates: every
+    (z, y) row of cells within reach is one range of the boxes1 sorted by cell. The
+    exact IoU is computed for the candidates. Meant for many anchors (boxes1) against
+    a few truth boxes (boxes2); a thin crop no longer makes every anchor a candidate.
+
+    boxes1, boxes2: numpy arrays or tensors of [z, y, x, d, h, w], the result is on
+    the device of boxes1
+
+    return
+    i, j: indices into boxes1 and boxes2 of every pair with overlap > 0, sorted by i, then j
+    overlap: IoU of the pairs, same formula as py_box_overlap
+    """
+    boxes1 = _as_tensor(boxes1)
+    boxes2 = _as_tensor(boxes2, boxes1.device).to(boxes1.dtype)
+    device = boxes1.device
+
+    if len(boxes1) == 0 or len(boxes2) == 0:
+        empty = torch.zeros((0,), dtype=torch.long, device=device)
+        return empty, empty, torch.zeros((0,), dtype=boxes1.dtype, device=device)
+
+    max_size = boxes1[:, 3:].max(0).values
+    cell = max_size.clamp(min=1)
+    origin = boxes1[:, :3].min(0).values
+    cells1 = torch.floor((boxes1[:, :3] - origin) / cell).long()
+    num_cells = cells1.max(0).values + 1
+    _, ny, nx = num_cells.tolist()
+    key, order = torch.sort((cells1[:, 0] * ny + cells1[:, 1]) * nx + cells1[:, 2], stable=True)
+
+    # one voxel of slack so that rounding never drops an intersecting pair,
+    # the exact test below decides
+    reach = (boxes2[:, 3:] + max_size) / 2. + 1
+    lo = torch.floor((boxes2[:, :3] - reach - origin) / cell).long().clamp(min=0)
+    hi = torch.minimum(torch.floor((boxes2[:, :3] + reach - origin) / cell).long(), num_cells - 1)
+    span = (hi - lo + 1).clamp(min=0)
+
+    # one row per (box2, z cell, y cell) within reach, covering the x cells within reach
+    row, j = _expand(torch.zeros_like(span[:, 0]), span[:, 0] * span[:, 1])
+    zc = lo[j, 0] + torch.div(row, span[j, 1].clamp(min=1), rounding_mode='floor')
+    yc = lo[j, 1] + row % span[j, 1].clamp(min=1)
+    first = torch.searchsorted(key, (zc * ny + yc) * nx + lo[j, 2], right=False)
+    last = torch.searchsorted(key, (zc * ny + yc) * nx + hi[j, 2], right=True)
+
+    position, row = _expand(first, (last - first).clamp(min=0))
+    i, j = order[position], j[row]
+
+    b1, b2 = boxes1[i], boxes2[j]
+    start = torch.maximum(b1[:, :3] - b1[:, 3:] / 2., b2[:, :3] - b2[:, 3:] / 2.)
+    end = torch.minimum(b1[:, :3] + b1[:, 3:] / 2., b2[:, :3] + b2[:, 3:] / 2.)
+    inter = (end - start).clamp(min=0)
+    intersect = inter[:, 2] * inter[:, 1] * inter[:, 0]
+    areas1 = b1[:, 3] * b1[:, 4] * b1[:, 5]
+    areas2 = b2[:, 3] * b2[:, 4] * b2[:, 5]
+    overlap = intersect / (areas1 + areas2 - intersect)
+
+    valid = overlap > 0
+    i, j, overlap = i[valid], j[valid], overlap[valid]
+
+    order = torch.argsort(i * len(boxes2) + j)
+    return i[order], j[order], overlap[order]
+
+
+def sparse_max_overlap(i, j, overlap, num_boxes1, num_boxes2, group1=None, group2=None):
+    """
+    The argmax reductions of the dense overlap matrix used by rpn target assignment,
+    computed from the pairs of sparse_box_overlap with the same results, ties included.
+
+    return
+    max_overlap, argmax_overlap: for every box of boxes1, its largest overlap and the
+        first box of boxes2 reaching it (0 when boxes1 overlaps nothing), like
+        overlap.max(1) / np.argmax(overlap, 1)
+    best: bool mask over boxes1 of the boxes that have the largest overlap of at least
+        one box of boxes2, like np.where(overlap == overlap.max(0))[0]. A box of
+        boxes2 overlapping nothing has a largest overlap of 0, which every box of
+        boxes1 not overlapping it reaches.
+    best_assign: for the best boxes, the last box of boxes2 they are the best of
+
+    group1, group2: optional group (e.g. image) of every box of boxes1 and boxes2, pairs
+    only exist within a group and the ties at 0 above only involve boxes of the same group
+    """
+    device = overlap.device
+    max_overlap = torch.zeros(num_boxes1, dtype=overlap.dtype, device=device)
+    max_overlap.scatter_reduce_(0, i, overlap, reduce='amax')
+    argmax_overlap = torch.full((num_boxes1,), num_boxes2, dtype=torch.long, device=device)
+    is_max = overlap == max_overlap[i]
+    argmax_overlap.scatter_reduce_(0, i[is_max], j[is_max], reduce='amin')
+    argmax_overlap[argmax_overlap == num_boxes2] = 0
+
+    col_max = torch.zeros(num_boxes2, dtype=overlap.dtype, device=device)
+    col_max.scatter_reduce_(0, j, overlap, reduce='amax')
+    best_assign = torch.full((num_boxes1,), -1, dtype=torch.long, device=device)
+    is_best = overlap == col_max[j]
+    best_assign.scatter_reduce_(0, i[is_best], j[is_best], reduce='amax')
+
+    # boxes2 without any overlap: the boxes1 not overlapping them tie at 0
+    for t in torch.nonzero(col_max == 0).flatten().tolist():
+        if group1 is None:
+            free = torch.ones(num_boxes1, dtype=torch.bool, device=device)
+        else:
+            free = group1 == group2[t]
+        free[i[j == t]] = False
+        best_assign[free] = torch.clamp(best_assign[free], min=t)
+
+    return max_overlap, argmax_overlap, best_assign >= 0, best_assign
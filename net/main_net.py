@@ -1,9 +1,11 @@
 
 from .feature_net import build_feature_net
 from .layer import *
+from .tile import make_tiles, shift_tile_boxes, merge_tile_boxes
+from .cache import collect_cache_stats
 from config import net_config as config
 
-import copy
+from typing import NamedTuple
 from torch.nn.parallel import data_parallel
 from scipy.stats import norm
 
@@ -70,42 +72,33 @@ class CropRoi(nn.Module):
         self.cfg = cfg
         self.rcnn_crop_size = cfg['rcnn_crop_size']
         self.scale = cfg['stride']
+        self.mode = cfg['rcnn_crop_mode']
         self.DEPTH, self.HEIGHT, self.WIDTH = cfg['crop_size']
 
     def forward(self, f, inputs, proposals):
         self.DEPTH, self.HEIGHT, self.WIDTH = inputs.shape[2:]
 
-        crops = []
-        for p in proposals:
-            b = int(p[0])
-            center = p[2:5]
-            side_length = p[5:8]
-            c0 = center - side_length / 2  # left bottom corner
-            c1 = c0 + side_length  # right upper corner
-            c0 = (c0 / self.scale).floor().long()
-            c1 = (c1 / self.scale).ceil().long()
-            minimum = torch.LongTensor([[0, 0, 0]]).cuda()
-            maximum = torch.LongTensor(
-                np.array([[self.DEPTH, self.HEIGHT, self.WIDTH]]) / self.scale).cuda()
-
-            c0 = torch.cat((c0.unsqueeze(0).cuda(), minimum), 0)
-            c1 = torch.cat((c1.unsqueeze(0).cuda(), maximum), 0)
-            c0, _ = torch.max(c0, 0)
-            c1, _ = torch.min(c1, 0)
-
-            # Slice 0 dim, should never happen
-            if np.any((c1 - c0).cpu().data.numpy() < 1):
-                print(p)
-                print('c0:', c0, ', c1:', c1)
-            crop = f[b, :, c0[0]:c1[0], c0[1]:c1[1], c0[2]:c1[2]]
-            crop = F.adaptive_max_pool3d(crop, self.rcnn_crop_size)
-            crops.append(crop)
-
-        crops = torch.stack(crops)
+        crops = roi_crop(f, proposals, self.rcnn_crop_size, self.scale,
+                         inputs.shape[2:], mode=self.mode)
 
         return crops
 
 
+class InferenceResult(NamedTuple):
+    """
+    Outputs of MainNet.infer, in the coordinates of its inputs
+
+    rpn_proposals: [n, 8] tensor of [b, p, z, y, x, d, h, w]
+    detections: [m, 9] tensor of [b, p, z, y, x, d, h, w, class], the rpn proposals without rcnn
+    ensemble_proposals: [n, 8] rpn proposals re-scored with the rcnn probability
+    proposal_stats: one dict per image with the number of boxes seen by every stage
+    """
+    rpn_proposals: torch.Tensor
+    detections: torch.Tensor
+    ensemble_proposals: torch.Tensor
+    proposal_stats: tuple
+
+
 class MainNet(nn.Module):
     def __init__(self, config, mode='train'):
         super(MainNet, self).__init__()
@@ -120,20 +113,53 @@ class MainNet(nn.Module):
         self.rcnn_crop = CropRoi(config)
 
         self.feature_size = None
+        # optional ahead-of-time compiled FeatureNet + RpnHead and RcnnHead, see net/export.py
+        self.backbone_runner = None
+        self.rcnn_runner = None
+        # reduced precision for the backbone and heads at inference time, box decoding and nms stay in fp32
+        self.inference_dtype = getattr(torch, config['inference_dtype']) if config['inference_dtype'] else None
+        # seeded generator of the rpn target sampling, created on the device of the inputs
+        self.target_generator = None
+
+    def autocast(self, device):
+        """
+            Autocast context for the backbone and heads, enabled at inference time
+            when inference_dtype is set, e.g. torch.bfloat16 on cpu or gpu.
+        """
+        enabled = self.inference_dtype is not None and not self.training
+        return torch.autocast(device_type=torch.device(device).type,
+                              dtype=self.inference_dtype or torch.bfloat16, enabled=enabled)
 
-    def forward(self, inputs, truth_boxes, truth_labels):
+    def run_backbone(self, inputs):
         """
-            inputs: [6, 1, 64, 64, 64]
-            use origin img/down_4 as another cls feature map
+            FeatureNet + RpnHead, through backbone_runner at inference time when
+            it supports the input shape, eagerly otherwise.
         """
+        if self.backbone_runner is not None and not self.training:
+            outputs = self.backbone_runner(inputs)
+            if outputs is not None:
+                return outputs
 
         features, feat_4 = self.feature_net(inputs)
         # features, feat_4 = data_parallel(self.feature_net, inputs)
 
         fs = features[-1]
-        self.rpn_logits_flat, self.rpn_deltas_flat = self.rpn(fs)
+        rpn_logits, rpn_deltas = self.rpn(fs)
         # self.rpn_logits_flat, self.rpn_deltas_flat = data_parallel(self.rpn, fs)
 
+        return fs, feat_4, rpn_logits, rpn_deltas
+
+    def forward(self, inputs, truth_boxes, truth_labels):
+        """
+            inputs: [6, 1, 64, 64, 64]
+            use origin img/down_4 as another cls feature map
+        """
+
+        with self.autocast(inputs.device):
+            fs, feat_4, self.rpn_logits_flat, self.rpn_deltas_flat = self.run_backbone(inputs)
+        self.rpn_logits_flat = self.rpn_logits_flat.float()
+        self.rpn_deltas_flat = self.rpn_deltas_flat.float()
+
         b, D, H, W, _, num_class = self.rpn_logits_flat.shape
 
         self.rpn_logits_flat = self.rpn_logits_flat.view(b, -1, 1)
@@ -146,42 +172,173 @@ class MainNet(nn.Module):
             self.feature_size = feature_size
 
         self.rpn_proposals = []
+        # per image number of boxes seen by every proposal stage
+        self.proposal_stats = []
 
         if self.use_rcnn or self.mode in ['eval', 'test']:
-            self.rpn_proposals = rpn_nms(self.cfg, self.mode, inputs, self.rpn_window,
-                                         self.rpn_logits_flat, self.rpn_deltas_flat)
+            # cached device copy of the anchors, post-processing stays on the device
+            rpn_window = make_rpn_windows(fs, self.cfg, device=self.rpn_logits_flat.device)
+            self.rpn_proposals = rpn_nms(self.cfg, self.mode, inputs, rpn_window,
+                                         self.rpn_logits_flat, self.rpn_deltas_flat, self.proposal_stats)
 
         if self.mode in ['train', 'valid']:
 
+            if self.target_generator is None or self.target_generator.device != inputs.device:
+                self.target_generator = torch.Generator(inputs.device).manual_seed(self.cfg['rpn_target_seed'])
+
             self.rpn_labels, self.rpn_label_assigns, self.rpn_label_weights, self.rpn_targets, self.rpn_target_weights = \
-                make_rpn_target(self.cfg, self.mode, inputs, self.rpn_window, truth_boxes, truth_labels)
+                make_rpn_target(self.cfg, self.mode, inputs, make_rpn_windows(fs, self.cfg, device=inputs.device),
+                                truth_boxes, truth_labels, self.target_generator)
 
             if self.use_rcnn:
                 self.rpn_proposals, self.rcnn_labels, self.rcnn_assigns, self.rcnn_targets = \
-                    make_rcnn_target(self.cfg, self.mode, inputs, self.rpn_proposals,truth_boxes, truth_labels)
+                    make_rcnn_target(self.cfg, self.mode, inputs, self.rpn_proposals, truth_boxes, truth_labels,
+                                     self.target_generator)
 
-        # rcnn proposals
-        self.detections = copy.deepcopy(self.rpn_proposals)
-        self.ensemble_proposals = copy.deepcopy(self.rpn_proposals)
+        # without rcnn the detections and the ensemble are the rpn proposals
+        # themselves, the outputs are shared and must not be modified in place
+        self.detections = self.rpn_proposals
+        self.ensemble_proposals = self.rpn_proposals
 
         if self.use_rcnn:
             if len(self.rpn_proposals) > 0:
                 # rcnn on down_4
-                rcnn_crops = self.rcnn_crop(feat_4, inputs, self.rpn_proposals)
-                self.rcnn_logits, self.rcnn_deltas = self.rcnn_head(rcnn_crops)
+                self.rcnn_logits, self.rcnn_deltas = self.rcnn_forward(feat_4, inputs, self.rpn_proposals)
                 # self.rcnn_logits, self.rcnn_deltas = data_parallel(self.rcnn_head, rcnn_crops)
-                self.detections, self.keeps = rcnn_nms(self.cfg, self.mode, inputs, self.rpn_proposals,
-                                                       self.rcnn_logits, self.rcnn_deltas)
+                # one decode pass for the rcnn detections and the ensemble
+                self.detections, self.keeps, ensemble_proposals = rcnn_postprocess(
+                    self.cfg, self.mode, inputs, self.rpn_proposals, self.rcnn_logits, self.rcnn_deltas,
+                    ensemble=self.mode in ['eval'])
+                if ensemble_proposals is not None:
+                    self.ensemble_proposals = ensemble_proposals
+                counts = torch.bincount(self.detections[:, 0].long(), minlength=b).tolist()
+                for stats, count in zip(self.proposal_stats, counts):
+                    stats['detections'] = count
+
+    def rcnn_forward(self, f, inputs, proposals):
+        """
+            Crop rois and run the rcnn head, rcnn_chunk_size proposals at a time,
+            so memory of the crops and fc1 stays bounded when proposal counts spike.
+        """
+        chunk_size = self.cfg['rcnn_chunk_size'] or len(proposals)
+        head = self.rcnn_runner if self.rcnn_runner is not None and not self.training else self.rcnn_head
+
+        logits, deltas = [], []
+        with self.autocast(f.device):
+            for i in range(0, len(proposals), chunk_size):
+                crops = self.rcnn_crop(f, inputs, proposals[i:i + chunk_size])
+                logit, delta = head(crops)
+                logits.append(logit)
+                deltas.append(delta)
 
-            if self.mode in ['eval']:
-                # Ensemble
-                fpr_res = get_probability(self.cfg, self.mode, inputs, self.rpn_proposals, self.rcnn_logits, self.rcnn_deltas)
-                self.ensemble_proposals[:, 1] = self.ensemble_proposals[:, 1] * 0.5 + fpr_res[:, 0] * 0.5
+        return torch.cat(logits, 0).float(), torch.cat(deltas, 0).float()
+
+    def infer(self, inputs, tiled=False, tile_size=None, tile_overlap=None, tile_batch_size=None):
+        """
+            Inference without gradients which returns an InferenceResult and keeps no
+            per-request state on the module, so concurrent threads can share one model.
+            Test thresholds are used whatever the mode, call set_mode('eval') once
+            before sharing the model.
+
+            inputs: [b, 1, D, H, W]
+            tiled: run on overlapping tiles of tile_size, see forward_tiled
+        """
+        with torch.no_grad():
+            if tiled:
+                return self._infer_tiled(inputs, tile_size, tile_overlap, tile_batch_size)
+
+            return self._infer_batch(inputs)
+
+    def _infer_batch(self, inputs, mode='eval'):
+        with self.autocast(inputs.device):
+            fs, feat_4, rpn_logits, rpn_deltas = self.run_backbone(inputs)
+        b = len(inputs)
+        rpn_logits = rpn_logits.float().view(b, -1, 1)
+        rpn_deltas = rpn_deltas.float().view(b, -1, 6)
+
+        proposal_stats = []
+        rpn_window = make_rpn_windows(fs, self.cfg, device=rpn_logits.device)
+        rpn_proposals = rpn_nms(self.cfg, mode, inputs, rpn_window, rpn_logits, rpn_deltas, proposal_stats)
+
+        detections, ensemble_proposals = rpn_proposals, rpn_proposals
+        if getattr(self, 'use_rcnn', False) and len(rpn_proposals) > 0:
+            rcnn_logits, rcnn_deltas = self.rcnn_forward(feat_4, inputs, rpn_proposals)
+            detections, _, ensemble = rcnn_postprocess(
+                self.cfg, mode, inputs, rpn_proposals, rcnn_logits, rcnn_deltas, ensemble=mode in ['eval'])
+            ensemble_proposals = rpn_proposals if ensemble is None else ensemble
+            counts = torch.bincount(detections[:, 0].long(), minlength=b).tolist()
+            for stats, count in zip(proposal_stats, counts):
+                stats['detections'] = count
+
+        return InferenceResult(rpn_proposals, detections, ensemble_proposals, tuple(proposal_stats))
+
+    def _infer_tiled(self, inputs, tile_size=None, tile_overlap=None, tile_batch_size=None, mode='eval'):
+        tile_size = tile_size or self.cfg['tile_size']
+        tile_overlap = self.cfg['tile_overlap'] if tile_overlap is None else tile_overlap
+        tile_batch_size = tile_batch_size or self.cfg['tile_batch_size']
+        device = next(self.parameters()).device
+
+        batch_size = len(inputs)
+        tile_size, origins = make_tiles(inputs.shape[2:], tile_size, tile_overlap, self.cfg['max_stride'])
+        jobs = [(b, origin) for b in range(batch_size) for origin in origins]
+        d, h, w = tile_size
+
+        rpn_proposals, detections, ensemble_proposals = [], [], []
+        proposal_stats = [{} for _ in range(batch_size)]
+        for i in range(0, len(jobs), tile_batch_size):
+            job = jobs[i:i + tile_batch_size]
+            batch_index = [b for b, _ in job]
+            tile_origins = [origin for _, origin in job]
+            tiles = torch.stack([inputs[b, :, z:z + d, y:y + h, x:x + w] for b, (z, y, x) in job]).to(device)
+
+            result = self._infer_batch(tiles, mode)
+            for b, stats in zip(batch_index, result.proposal_stats):
+                for key, value in stats.items():
+                    proposal_stats[b][key] = proposal_stats[b].get(key, 0) + value
+
+            rpn_proposals.append(shift_tile_boxes(
+                result.rpn_proposals.cpu().numpy(), batch_index, tile_origins))
+            detections.append(shift_tile_boxes(
+                result.detections.cpu().numpy(), batch_index, tile_origins))
+            ensemble_proposals.append(shift_tile_boxes(
+                result.ensemble_proposals.cpu().numpy(), batch_index, tile_origins))
+            del tiles, result
+
+        rpn_proposals = merge_tile_boxes(
+            rpn_proposals, batch_size, self.cfg['rpn_test_nms_overlap_threshold'])
+        detections = merge_tile_boxes(
+            detections, batch_size, self.cfg['rcnn_test_nms_overlap_threshold'])
+        ensemble_proposals = merge_tile_boxes(
+            ensemble_proposals, batch_size, self.cfg['rcnn_test_nms_overlap_threshold'])
+
+        return InferenceResult(torch.from_numpy(rpn_proposals).to(inputs.device),
+                               torch.from_numpy(detections).to(inputs.device),
+                               torch.from_numpy(ensemble_proposals).to(inputs.device),
+                               tuple(proposal_stats))
+
+    def forward_tiled(self, inputs, tile_size=None, tile_overlap=None, tile_batch_size=None):
+        """
+            Full-resolution inference on overlapping sub-volumes.
+
+            inputs: [b, 1, D, H, W], each side padded to a multiple of max_stride.
+            Can be kept on cpu, only tile_batch_size tiles are moved to the model
+            device at a time, so peak memory does not depend on the scan size.
+            Results are stored in rpn_proposals, detections and ensemble_proposals
+            in the coordinates of inputs, same as forward.
+        """
+        assert self.mode in ['eval', 'test'], 'forward_tiled(): invalid mode = %s?' % self.mode
+        result = self._infer_tiled(inputs, tile_size, tile_overlap, tile_batch_size, self.mode)
+
+        self.rpn_proposals = result.rpn_proposals
+        self.detections = result.detections
+        self.ensemble_proposals = result.ensemble_proposals
+        self.proposal_stats = list(result.proposal_stats)
 
     def loss(self):
 
+        device = self.rpn_logits_flat.device
         self.rcnn_cls_loss, self.rcnn_reg_loss, self.iou_loss = \
-            torch.zeros(1).cuda(), torch.zeros(1).cuda(), torch.zeros(1).cuda()
+            torch.zeros(1, device=device), torch.zeros(1, device=device), torch.zeros(1, device=device)
 
         self.rpn_cls_loss, self.rpn_reg_loss = rpn_loss(
             logits=self.rpn_logits_flat, 
@@ -206,6 +363,12 @@ class MainNet(nn.Module):
 
         return self.total_loss
 
+    def cache_stats(self):
+        """
+        Hit rate of the shape-keyed caches in the transformer and positional encoding
+        """
+        return collect_cache_stats(self)
+
     def set_mode(self, mode):
         assert mode in ['train', 'valid', 'eval', 'test']
         self.mode = mode
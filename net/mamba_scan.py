@@ -0,0 +1,129 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def selective_scan(u, delta, A, B, C, D=None, z=None, delta_bias=None, delta_softplus=False, chunk_size=64):
+    """
+    Pure PyTorch selective scan, same arguments as mamba_ssm selective_scan_fn,
+    runs on any device.
+
+    u, delta: [b, d, l]
+    A: [d, n]
+    B, C: [b, n, l]
+    D: [d]
+    z: [b, d, l], gate applied as y * silu(z)
+
+    The recurrence h_t = exp(delta_t * A) * h_{t-1} + delta_t * B_t * u_t is evaluated
+    chunk_size steps at a time. Inside a chunk all steps are computed at once from a
+    masked decay matrix exp(cumsum_t - cumsum_s), only the last state is carried over
+    to the next chunk, so memory is O(b * d * chunk_size^2 * n) whatever the length.
+    """
+    dtype_in = u.dtype
+    u = u.float()
+    delta = delta.float()
+    if delta_bias is not None:
+        delta = delta + delta_bias[..., None].float()
+    if delta_softplus:
+        delta = F.softplus(delta)
+
+    batch, dim, length = u.shape
+    A = A.float()
+    B = B.float()
+    C = C.float()
+
+    h = u.new_zeros(batch, dim, A.shape[1])
+    ys = []
+    for start in range(0, length, chunk_size):
+        end = min(start + chunk_size, length)
+        dt = delta[:, :, start:end]
+
+        # [b, d, l, n]
+        delta_A = dt.unsqueeze(-1) * A[:, None, :]
+        delta_B_u = (dt * u[:, :, start:end]).unsqueeze(-1) * B[:, :, start:end].transpose(1, 2).unsqueeze(1)
+        cum = delta_A.cumsum(2)
+
+        # decay[t, s] = exp(cum_t - cum_s) for s <= t, [b, d, l, l, n]
+        mask = torch.ones(end - start, end - start, dtype=torch.bool, device=u.device).tril()
+        decay = cum.unsqueeze(3) - cum.unsqueeze(2)
+        decay = decay.masked_fill(~mask[:, :, None], float('-inf')).exp()
+
+        hs = torch.einsum('bdtsn,bdsn->bdtn', decay, delta_B_u) + cum.exp() * h.unsqueeze(2)
+        ys.append(torch.einsum('bdtn,bnt->bdt', hs, C[:, :, start:end]))
+        h = hs[:, :, -1]
+
+    y = torch.cat(ys, -1)
+    if D is not None:
+        y = y + u * D.float()[:, None]
+    if z is not None:
+        y = y * F.silu(z.float())
+
+    return y.to(dtype_in)
+
+
+def mamba_scan_forward(mamba, hidden_states, chunk_size=64):
+    """
+    Forward of a mamba_ssm Mamba (or MambaScan) block without the fused CUDA kernels,
+    uses the parameters of mamba as they are.
+
+    hidden_states: [b, l, d_model]
+    """
+    length = hidden_states.shape[1]
+
+    xz = mamba.in_proj(hidden_states).transpose(1, 2)
+    A = -torch.exp(mamba.A_log.float())
+    x, z = xz.chunk(2, dim=1)
+    x = F.silu(mamba.conv1d(x)[..., :length])
+
+    x_dbl = mamba.x_proj(x.transpose(1, 2))
+    dt, B, C = torch.split(x_dbl, [mamba.dt_rank, mamba.d_state, mamba.d_state], dim=-1)
+    dt = F.linear(dt, mamba.dt_proj.weight).transpose(1, 2)
+    B = B.transpose(1, 2)
+    C = C.transpose(1, 2)
+
+    y = selective_scan(x, dt, A, B, C, mamba.D, z=z,
+                       delta_bias=mamba.dt_proj.bias, delta_softplus=True, chunk_size=chunk_size)
+
+    return mamba.out_proj(y.transpose(1, 2))
+
+
+class MambaScan(nn.Module):
+    """
+    Drop-in replacement of mamba_ssm.Mamba for hosts without mamba_ssm or CUDA,
+    same parameter names and initialization so checkpoints load either way.
+    """
+
+    def __init__(self, d_model, d_state=16, d_conv=4, expand=2, dt_rank="auto",
+                 dt_min=0.001, dt_max=0.1, dt_init_floor=1e-4, conv_bias=True, bias=False,
+                 chunk_size=64):
+        super(MambaScan, self).__init__()
+        self.d_model = d_model
+        self.d_state = d_state
+        self.d_conv = d_conv
+        self.expand = expand
+        self.d_inner = int(expand * d_model)
+        self.dt_rank = math.ceil(d_model / 16) if dt_rank == "auto" else dt_rank
+        self.chunk_size = chunk_size
+
+        self.in_proj = nn.Linear(d_model, self.d_inner * 2, bias=bias)
+        self.conv1d = nn.Conv1d(self.d_inner, self.d_inner, kernel_size=d_conv,
+                                groups=self.d_inner, padding=d_conv - 1, bias=conv_bias)
+        self.x_proj = nn.Linear(self.d_inner, self.dt_rank + d_state * 2, bias=False)
+        self.dt_proj = nn.Linear(self.dt_rank, self.d_inner, bias=True)
+
+        dt_init_std = self.dt_rank ** -0.5
+        nn.init.uniform_(self.dt_proj.weight, -dt_init_std, dt_init_std)
+        dt = torch.exp(torch.rand(self.d_inner) * (math.log(dt_max) - math.log(dt_min))
+                       + math.log(dt_min)).clamp(min=dt_init_floor)
+        # inverse of softplus
+        with torch.no_grad():
+            self.dt_proj.bias.copy_(dt + torch.log(-torch.expm1(-dt)))
+
+        A = torch.arange(1, d_state + 1, dtype=torch.float32).repeat(self.d_inner, 1)
+        self.A_log = nn.Parameter(torch.log(A))
+        self.D = nn.Parameter(torch.ones(self.d_inner))
+        self.out_proj = nn.Linear(self.d_inner, d_model, bias=bias)
+
+    def forward(self, hidden_states):
+        return mamba_scan_forward(self, hidden_states, self.chunk_size)
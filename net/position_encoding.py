@@ -1,6 +1,7 @@
 import math
 import torch
 from torch import nn
+from .cache import ShapeCache
 
 
 class PositionEmbeddingSine(nn.Module):
@@ -9,7 +10,7 @@ class PositionEmbeddingSine(nn.Module):
     used by the Attention is all you need paper, generalized to work on images.
     """
 
-    def __init__(self, num_pos_feats=1024, temperature=10000, normalize=False, scale=None):
+    def __init__(self, num_pos_feats=1024, temperature=10000, normalize=False, scale=None, cache_size=8):
         super().__init__()
         self.num_pos_feats = num_pos_feats
         self.temperature = temperature
@@ -22,12 +23,24 @@ class PositionEmbeddingSine(nn.Module):
 
         self.channel_conv = nn.Conv3d(
             num_pos_feats * 3, num_pos_feats * 2, kernel_size=1)
+        # the sine grid only depends on the feature shape, only channel_conv is learned
+        self.shape_cache = ShapeCache(cache_size)
 
     def forward(self, tensor_list):
         x = tensor_list
         bs, c, d, h, w = x.shape
 
-        mask = torch.ones(bs, d, h, w).to(x.device)
+        pos = self.shape_cache.get(
+            (d, h, w), x.device, x.dtype,
+            lambda: self.build_sine_grid(d, h, w, x.device).to(x.dtype))
+        pos = self.channel_conv(pos.expand(bs, -1, -1, -1, -1))
+        return pos
+
+    def build_sine_grid(self, d, h, w, device):
+        """
+        Sine/cosine grid of shape [1, num_pos_feats * 3, d, h, w]
+        """
+        mask = torch.ones(1, d, h, w, device=device)
         y_embed = mask.cumsum(1, dtype=torch.float32)
         x_embed = mask.cumsum(2, dtype=torch.float32)
         z_embed = mask.cumsum(3, dtype=torch.float32)
@@ -38,7 +51,7 @@ class PositionEmbeddingSine(nn.Module):
             z_embed = z_embed / (z_embed[:, :, :, -1:] + eps) * self.scale
 
         dim_t = torch.arange(self.num_pos_feats,
-                             dtype=torch.float32, device=x.device)
+                             dtype=torch.float32, device=device)
         dim_t = self.temperature ** (2 * (dim_t // 2) / self.num_pos_feats)
 
         pos_x = x_embed[:, :, :, :, None] / dim_t
@@ -52,8 +65,7 @@ class PositionEmbeddingSine(nn.Module):
         ), pos_z[:, :, :, :, 1::2].cos()), dim=5).flatten(4)
 
         pos = torch.cat((pos_y, pos_x, pos_z), dim=4).permute(0, 4, 1, 2, 3)
-        pos = self.channel_conv(pos)
-        return pos
+        return pos.contiguous()
 
 
 class PositionEmbeddingLearned(nn.Module):
@@ -89,7 +101,8 @@ def build_position_encoding(cfg):
     N_steps = cfg['hidden_dim'] // 2
     if cfg['position_embedding'] in ('v2', 'sine'):
         # TODO find a better way of exposing other arguments
-        position_embedding = PositionEmbeddingSine(N_steps, normalize=True)
+        position_embedding = PositionEmbeddingSine(
+            N_steps, normalize=True, cache_size=cfg['shape_cache_size'])
     elif cfg['position_embedding'] in ('v3', 'learned'):
         position_embedding = PositionEmbeddingLearned(N_steps)
     else:
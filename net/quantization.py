@@ -0,0 +1,138 @@
+import io
+
+import torch
+from torch import nn
+from torch.ao import quantization as tq
+from torch.ao.nn import intrinsic as nni
+
+
+QUANTIZATION_MODES = ['dynamic', 'static']
+
+
+def fuse_conv_bn(net):
+    """
+    Fold eval-mode BatchNorm3d (and a following ReLU when it is not shared)
+    into the preceding Conv3d, in place.
+
+    Only consecutive children of a nn.Sequential and the conv/bn pairs of
+    ResBlock3d are fused, ResBlock3d.relu is applied twice and stays separate.
+    """
+    from .feature_net import ResBlock3d
+
+    net.eval()
+    for module in list(net.modules()):
+        if isinstance(module, ResBlock3d):
+            tq.fuse_modules(module, [['conv1', 'bn1'], ['conv2', 'bn2']], inplace=True)
+        elif isinstance(module, nn.Sequential):
+            names = [name for name, _ in module.named_children()]
+            children = list(module.children())
+            groups = []
+            i = 0
+            while i < len(children) - 1:
+                if isinstance(children[i], nn.Conv3d) and isinstance(children[i + 1], nn.BatchNorm3d):
+                    group = names[i:i + 2]
+                    if i + 2 < len(children) and isinstance(children[i + 2], nn.ReLU):
+                        group.append(names[i + 2])
+                    groups.append(group)
+                    i += len(group)
+                else:
+                    i += 1
+            if groups:
+                tq.fuse_modules(module, groups, inplace=True)
+
+    return net
+
+
+def _wrap_convs(module, qconfig):
+    """
+    Put every (fused) Conv3d of module between a QuantStub and a DeQuantStub,
+    so the convolutions run in int8 while residual adds, attention and Mamba
+    stay in float.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, (nn.Conv3d, nni.ConvReLU3d)):
+            wrapper = tq.QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            _wrap_convs(child, qconfig)
+
+
+def quantize_static(net, calibrate=None, backend='fbgemm'):
+    """
+    Static post-training quantization of the Conv3d/BN blocks of FeatureNet and RpnHead.
+
+    calibrate: callable(net) running a few representative inputs through the
+               observed model. Without it the default quantization parameters are
+               kept, which is only useful to rebuild the structure before loading
+               a quantized state_dict.
+    """
+    torch.backends.quantized.engine = backend
+    qconfig = tq.get_default_qconfig(backend)
+
+    net.eval()
+    for module in [net.feature_net, net.rpn]:
+        fuse_conv_bn(module)
+        _wrap_convs(module, qconfig)
+
+    tq.prepare(net, inplace=True)
+    if calibrate is not None:
+        with torch.no_grad():
+            calibrate(net)
+    tq.convert(net, inplace=True)
+
+    return net
+
+
+def quantize_dynamic_linear(net):
+    """
+    Dynamic int8 quantization of the nn.Linear layers: RcnnHead, the Mamba projections
+    and the transformer feed-forward layers.
+
+    Mamba.dt_proj is skipped, its weight is used directly by the selective scan.
+    """
+    qconfig_spec = {}
+    for name, module in net.named_modules():
+        if type(module) is nn.Linear and not name.endswith('dt_proj'):
+            qconfig_spec[name] = tq.default_dynamic_qconfig
+
+    return tq.quantize_dynamic(net, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+def quantize_model(net, mode, calibrate=None):
+    """
+    mode: 'dynamic', Linear layers only; 'static', Conv3d/BN blocks statically
+          quantized with calibrate, plus the dynamic Linear layers.
+
+    Quantized models run on cpu only.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError('quantize_model(): invalid mode = %s?' % mode)
+
+    net = net.cpu()
+    net.eval()
+    if mode == 'static':
+        quantize_static(net, calibrate)
+    quantize_dynamic_linear(net)
+
+    return net
+
+
+def model_size_mb(net):
+    """
+    Size of the serialized state_dict of net in MB
+    """
+    buffer = io.BytesIO()
+    torch.save(net.state_dict(), buffer)
+
+    return buffer.getbuffer().nbytes / 1024 / 1024
+
+
+def load_quantized(net, checkpoint):
+    """
+    Rebuild the quantized structure of a float net and load a checkpoint saved by quantize.py
+    """
+    quantize_model(net, checkpoint['mode'])
+    net.load_state_dict(checkpoint['state_dict'])
+
+    return net
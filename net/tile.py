@@ -0,0 +1,96 @@
+import numpy as np
+import torch
+
+try:
+    from utils.pybox import *
+except ImportError:
+    print('Warning: C++ module import failed! This should only happen in deployment')
+    from utils.util import py_nms as torch_nms
+    from utils.util import py_box_overlap as torch_overlap
+
+
+def make_tile_starts(length, tile, overlap):
+    """
+    Start offsets of overlapping tiles along one axis.
+
+    length: padded length of the axis, a multiple of max_stride
+    tile: tile length along the axis, a multiple of max_stride
+    overlap: number of voxels shared by two neighbouring tiles
+
+    return
+    starts: list of tile start offsets, the last tile is aligned to the end of the axis
+    """
+    tile = min(tile, length)
+    step = max(tile - overlap, 1)
+    starts = list(range(0, length - tile + 1, step))
+    if starts[-1] + tile < length:
+        starts.append(length - tile)
+
+    return starts
+
+
+def make_tiles(image_size, tile_size, overlap, max_stride):
+    """
+    Split a volume of image_size into overlapping sub-volumes.
+
+    Tile size and overlap are rounded down to multiples of max_stride, so every tile
+    origin falls on the feature map grid and anchors stay aligned across tiles.
+
+    return
+    tile_size: [d, h, w] actual tile size
+    origins: list of [z, y, x] tile origins
+    """
+    tile_size = [max(max_stride, int(t) // max_stride * max_stride) for t in tile_size]
+    tile_size = [min(t, s) for t, s in zip(tile_size, image_size)]
+    overlap = int(overlap) // max_stride * max_stride
+
+    starts = [make_tile_starts(s, t, min(overlap, t - max_stride))
+              for s, t in zip(image_size, tile_size)]
+    origins = [[z, y, x] for z in starts[0] for y in starts[1] for x in starts[2]]
+
+    return tile_size, origins
+
+
+def shift_tile_boxes(boxes, batch_index, origins):
+    """
+    Shift boxes predicted on a batch of tiles back to the coordinates of the full volume.
+
+    boxes: numpy array of [tile_b, p, z, y, x, d, h, w, ...]
+    batch_index: image index in the original batch of each tile
+    origins: [z, y, x] origin of each tile
+
+    boxes may share memory with the outputs of MainNet, a shifted copy is returned
+    """
+    if len(boxes) == 0:
+        return boxes
+
+    boxes = boxes.copy()
+    tile_index = boxes[:, 0].astype(np.int64)
+    boxes[:, 2:5] += np.asarray(origins, dtype=np.float32)[tile_index]
+    boxes[:, 0] = np.asarray(batch_index, dtype=np.float32)[tile_index]
+
+    return boxes
+
+
+def merge_tile_boxes(boxes, batch_size, nms_overlap_threshold):
+    """
+    Merge the seams between tiles, boxes from neighbouring tiles which
+    cover the same object are suppressed by nms within each image.
+
+    boxes: list of numpy arrays of [b, p, z, y, x, d, h, w, ...], one for each tile batch
+    """
+    boxes = [box for box in boxes if len(box) > 0]
+    if len(boxes) == 0:
+        return np.zeros((0, 8), np.float32)
+    boxes = np.vstack(boxes)
+
+    merged = [np.zeros((0, boxes.shape[1]), np.float32)]
+    for b in range(batch_size):
+        box = boxes[boxes[:, 0] == b]
+        if len(box) == 0:
+            continue
+
+        _, keep = torch_nms(torch.from_numpy(np.ascontiguousarray(box[:, 1:8])), nms_overlap_threshold)
+        merged.append(box[np.asarray(keep, dtype=np.int64)])
+
+    return np.vstack(merged)
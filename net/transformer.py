@@ -1,10 +1,13 @@
 import copy
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
 from config import train_config as cfg
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
+from .cache import ShapeCache
+
+ATTENTION_IMPLS = ['mha', 'sdpa', 'window']
 
 
 class Transformer(nn.Module):
@@ -20,7 +23,11 @@ class Transformer(nn.Module):
         dropout: float = 0.1,
         activation: str = "relu", 
         normalize_before: bool = False,
-        return_intermediate_dec: bool = False
+        return_intermediate_dec: bool = False,
+        cache_size: int = 8,
+        attention_impl: str = 'sdpa',
+        attention_chunk_size: Optional[int] = None,
+        attention_window_size: Optional[List[int]] = None
     ):
         super().__init__()
         self.d_model = d_model
@@ -31,7 +38,9 @@ class Transformer(nn.Module):
             dim_feedforward,
             dropout, 
             activation, 
-            normalize_before
+            normalize_before,
+            attention_chunk_size,
+            attention_window_size
         )
         encoder_norm = nn.LayerNorm(d_model) if normalize_before else None
         self.encoder = TransformerEncoder(
@@ -46,7 +55,9 @@ class Transformer(nn.Module):
             dim_feedforward,
             dropout, 
             activation, 
-            normalize_before
+            normalize_before,
+            attention_chunk_size,
+            attention_window_size
         )
         decoder_norm = nn.LayerNorm(d_model)
         self.decoder = TransformerDecoder(
@@ -59,29 +70,62 @@ class Transformer(nn.Module):
         self.query_embed = nn.Embedding(num_queries, d_model)
         self.d_model = d_model
         self.nhead = nhead
+        # query embeddings and padding masks only depend on the feature shape
+        self.shape_cache = ShapeCache(cache_size)
+        self.set_attention_impl(attention_impl)
+
+    def set_attention_impl(self, attention_impl):
+        """
+        Switch the attention of every encoder and decoder layer, the weights are shared
+        by all implementations:
+            'mha': nn.MultiheadAttention, materializes the full attention matrices
+            'sdpa': fused scaled dot product attention over query chunks, same result as 'mha'
+            'window': local attention within 3D windows of the feature grid, same result
+                      as 'mha' when one window covers the whole grid
+        """
+        if attention_impl not in ATTENTION_IMPLS:
+            raise ValueError('Transformer(): invalid attention_impl = %s?' % attention_impl)
+        self.attention_impl = attention_impl
+        for layer in list(self.encoder.layers) + list(self.decoder.layers):
+            layer.attention_impl = attention_impl
 
     def _reset_parameters(self):
         for p in self.parameters():
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
+    def _build_query_embed(self, num_queries, device):
+        # Same N(0, 1) init as nn.Embedding, seeded by the number of queries
+        # so that every call and every process sees the same embedding
+        generator = torch.Generator().manual_seed(num_queries)
+        query_embed = torch.randn(num_queries, self.d_model, generator=generator)
+        return query_embed.to(device)
+
     def forward(self, src, pos_embed):
         # flatten NxCxHxW to HWxNxC
-        bs, c, d, h, w = src.shape
-        self.query_embed = nn.Embedding(d * h * w, self.d_model)
-        query_embed = self.query_embed.weight.to(src.device)
+        # python ints, so that tracing freezes the shape-dependent embeddings as constants
+        bs, c, d, h, w = [int(s) for s in src.shape]
+        query_embed = self.shape_cache.get(
+            ('query', d, h, w), src.device, torch.float32,
+            lambda: self._build_query_embed(d * h * w, src.device))
 
         src = src.flatten(2).permute(2, 0, 1)
         pos_embed = pos_embed.flatten(2).permute(2, 0, 1)
         query_embed = query_embed.unsqueeze(
-            1).repeat(1, bs, 1)  # [100, 2, 256]
-        mask = torch.zeros(bs, d * h * w).to(src.device)
+            1).expand(-1, bs, -1)  # [100, 2, 256]
+        # the padding mask is all zeros, only nn.MultiheadAttention is given it so
+        # that the fused attention kernels are not disabled by a mask
+        mask = None
+        if self.attention_impl == 'mha':
+            mask = self.shape_cache.get(
+                ('mask', bs, d, h, w), src.device, torch.float32,
+                lambda: torch.zeros(bs, d * h * w, device=src.device))
 
         tgt = torch.zeros_like(query_embed)
         memory = self.encoder(src, src_key_padding_mask=mask,
-                              pos=pos_embed)  # [4096, 2, 256]
+                              pos=pos_embed, grid=(d, h, w))  # [4096, 2, 256]
         hs = self.decoder(tgt, memory, memory_key_padding_mask=mask,
-                          pos=pos_embed, query_pos=query_embed)[-1]
+                          pos=pos_embed, query_pos=query_embed, grid=(d, h, w))[-1]
         return hs.view(bs, c, d, h, w)
 
 
@@ -96,12 +140,13 @@ class TransformerEncoder(nn.Module):
     def forward(self, src,
                 mask: Optional[Tensor] = None,
                 src_key_padding_mask: Optional[Tensor] = None,
-                pos: Optional[Tensor] = None):
+                pos: Optional[Tensor] = None,
+                grid: Optional[Tuple[int, int, int]] = None):
         output = src
 
         for layer in self.layers:
             output = layer(output, src_mask=mask,
-                           src_key_padding_mask=src_key_padding_mask, pos=pos)
+                           src_key_padding_mask=src_key_padding_mask, pos=pos, grid=grid)
 
         if self.norm is not None:
             output = self.norm(output)
@@ -124,7 +169,8 @@ class TransformerDecoder(nn.Module):
                 tgt_key_padding_mask: Optional[Tensor] = None,
                 memory_key_padding_mask: Optional[Tensor] = None,
                 pos: Optional[Tensor] = None,
-                query_pos: Optional[Tensor] = None):
+                query_pos: Optional[Tensor] = None,
+                grid: Optional[Tuple[int, int, int]] = None):
         output = tgt
 
         intermediate = []
@@ -134,7 +180,7 @@ class TransformerDecoder(nn.Module):
                            memory_mask=memory_mask,
                            tgt_key_padding_mask=tgt_key_padding_mask,
                            memory_key_padding_mask=memory_key_padding_mask,
-                           pos=pos, query_pos=query_pos)
+                           pos=pos, query_pos=query_pos, grid=grid)
             if self.return_intermediate:
                 intermediate.append(self.norm(output))
 
@@ -153,7 +199,8 @@ class TransformerDecoder(nn.Module):
 class TransformerEncoderLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False,
+                 attention_chunk_size=None, attention_window_size=None):
         super().__init__()
         self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
         # Implementation of Feedforward model
@@ -168,19 +215,27 @@ class TransformerEncoderLayer(nn.Module):
 
         self.activation = _get_activation_fn(activation)
         self.normalize_before = normalize_before
+        self.attention_impl = 'sdpa'
+        self.attention_chunk_size = attention_chunk_size
+        self.attention_window_size = attention_window_size
 
     def with_pos_embed(self, tensor, pos: Optional[Tensor]):
         return tensor if pos is None else tensor + pos
 
+    def attend(self, attn, query, key, value, attn_mask, key_padding_mask, grid):
+        return multihead_attention(attn, query, key, value, key_padding_mask, attn_mask,
+                                   self.attention_impl, self.attention_chunk_size,
+                                   self.attention_window_size, grid)
+
     def forward_post(self,
                      src,
                      src_mask: Optional[Tensor] = None,
                      src_key_padding_mask: Optional[Tensor] = None,
-                     pos: Optional[Tensor] = None):
+                     pos: Optional[Tensor] = None,
+                     grid: Optional[Tuple[int, int, int]] = None):
         q = k = self.with_pos_embed(src, pos)
 
-        src2 = self.self_attn(q, k, value=src, attn_mask=src_mask,
-                              key_padding_mask=src_key_padding_mask)[0]
+        src2 = self.attend(self.self_attn, q, k, src, src_mask, src_key_padding_mask, grid)
         src = src + self.dropout1(src2)
         src = self.norm1(src)
         src2 = self.linear2(self.dropout(self.activation(self.linear1(src))))
@@ -191,11 +246,11 @@ class TransformerEncoderLayer(nn.Module):
     def forward_pre(self, src,
                     src_mask: Optional[Tensor] = None,
                     src_key_padding_mask: Optional[Tensor] = None,
-                    pos: Optional[Tensor] = None):
+                    pos: Optional[Tensor] = None,
+                    grid: Optional[Tuple[int, int, int]] = None):
         src2 = self.norm1(src)
         q = k = self.with_pos_embed(src2, pos)
-        src2 = self.self_attn(q, k, value=src2, attn_mask=src_mask,
-                              key_padding_mask=src_key_padding_mask)[0]
+        src2 = self.attend(self.self_attn, q, k, src2, src_mask, src_key_padding_mask, grid)
         src = src + self.dropout1(src2)
         src2 = self.norm2(src)
         src2 = self.linear2(self.dropout(self.activation(self.linear1(src2))))
@@ -205,16 +260,18 @@ class TransformerEncoderLayer(nn.Module):
     def forward(self, src,
                 src_mask: Optional[Tensor] = None,
                 src_key_padding_mask: Optional[Tensor] = None,
-                pos: Optional[Tensor] = None):
+                pos: Optional[Tensor] = None,
+                grid: Optional[Tuple[int, int, int]] = None):
         if self.normalize_before:
-            return self.forward_pre(src, src_mask, src_key_padding_mask, pos)
-        return self.forward_post(src, src_mask, src_key_padding_mask, pos)
+            return self.forward_pre(src, src_mask, src_key_padding_mask, pos, grid)
+        return self.forward_post(src, src_mask, src_key_padding_mask, pos, grid)
 
 
 class TransformerDecoderLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False,
+                 attention_chunk_size=None, attention_window_size=None):
         super().__init__()
         self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
         self.multihead_attn = nn.MultiheadAttention(
@@ -233,26 +290,33 @@ class TransformerDecoderLayer(nn.Module):
 
         self.activation = _get_activation_fn(activation)
         self.normalize_before = normalize_before
+        self.attention_impl = 'sdpa'
+        self.attention_chunk_size = attention_chunk_size
+        self.attention_window_size = attention_window_size
 
     def with_pos_embed(self, tensor, pos: Optional[Tensor]):
         return tensor if pos is None else tensor + pos
 
+    def attend(self, attn, query, key, value, attn_mask, key_padding_mask, grid):
+        return multihead_attention(attn, query, key, value, key_padding_mask, attn_mask,
+                                   self.attention_impl, self.attention_chunk_size,
+                                   self.attention_window_size, grid)
+
     def forward_post(self, tgt, memory,
                      tgt_mask: Optional[Tensor] = None,
                      memory_mask: Optional[Tensor] = None,
                      tgt_key_padding_mask: Optional[Tensor] = None,
                      memory_key_padding_mask: Optional[Tensor] = None,
                      pos: Optional[Tensor] = None,
-                     query_pos: Optional[Tensor] = None):
+                     query_pos: Optional[Tensor] = None,
+                     grid: Optional[Tuple[int, int, int]] = None):
         q = k = self.with_pos_embed(tgt, query_pos)
-        tgt2 = self.self_attn(q, k, value=tgt, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)[0]
+        tgt2 = self.attend(self.self_attn, q, k, tgt, tgt_mask, tgt_key_padding_mask, grid)
         tgt = tgt + self.dropout1(tgt2)
         tgt = self.norm1(tgt)
-        tgt2 = self.multihead_attn(query=self.with_pos_embed(tgt, query_pos),
-                                   key=self.with_pos_embed(memory, pos),
-                                   value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)[0]
+        tgt2 = self.attend(self.multihead_attn, self.with_pos_embed(tgt, query_pos),
+                           self.with_pos_embed(memory, pos), memory,
+                           memory_mask, memory_key_padding_mask, grid)
         tgt = tgt + self.dropout2(tgt2)
         tgt = self.norm2(tgt)
         tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt))))
@@ -266,17 +330,16 @@ class TransformerDecoderLayer(nn.Module):
                     tgt_key_padding_mask: Optional[Tensor] = None,
                     memory_key_padding_mask: Optional[Tensor] = None,
                     pos: Optional[Tensor] = None,
-                    query_pos: Optional[Tensor] = None):
+                    query_pos: Optional[Tensor] = None,
+                    grid: Optional[Tuple[int, int, int]] = None):
         tgt2 = self.norm1(tgt)
         q = k = self.with_pos_embed(tgt2, query_pos)
-        tgt2 = self.self_attn(q, k, value=tgt2, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)[0]
+        tgt2 = self.attend(self.self_attn, q, k, tgt2, tgt_mask, tgt_key_padding_mask, grid)
         tgt = tgt + self.dropout1(tgt2)
         tgt2 = self.norm2(tgt)
-        tgt2 = self.multihead_attn(query=self.with_pos_embed(tgt2, query_pos),
-                                   key=self.with_pos_embed(memory, pos),
-                                   value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)[0]
+        tgt2 = self.attend(self.multihead_attn, self.with_pos_embed(tgt2, query_pos),
+                           self.with_pos_embed(memory, pos), memory,
+                           memory_mask, memory_key_padding_mask, grid)
         tgt = tgt + self.dropout2(tgt2)
         tgt2 = self.norm3(tgt)
         tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt2))))
@@ -289,12 +352,129 @@ class TransformerDecoderLayer(nn.Module):
                 tgt_key_padding_mask: Optional[Tensor] = None,
                 memory_key_padding_mask: Optional[Tensor] = None,
                 pos: Optional[Tensor] = None,
-                query_pos: Optional[Tensor] = None):
+                query_pos: Optional[Tensor] = None,
+                grid: Optional[Tuple[int, int, int]] = None):
         if self.normalize_before:
             return self.forward_pre(tgt, memory, tgt_mask, memory_mask,
-                                    tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos)
+                                    tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos, grid)
         return self.forward_post(tgt, memory, tgt_mask, memory_mask,
-                                 tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos)
+                                 tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos, grid)
+
+
+def _additive_mask(mask, dtype):
+    if mask.dtype == torch.bool:
+        return torch.zeros(mask.shape, dtype=dtype, device=mask.device).masked_fill(mask, float('-inf'))
+    return mask.to(dtype)
+
+
+def _split_heads(x, nhead):
+    # [L, N, E] to [N, nhead, L, E / nhead]
+    L, N, E = x.shape
+    return x.view(L, N, nhead, E // nhead).permute(1, 2, 0, 3)
+
+
+def _merge_heads(x):
+    N, nhead, L, head_dim = x.shape
+    return x.permute(2, 0, 1, 3).reshape(L, N, nhead * head_dim)
+
+
+def _chunked_attention(q, k, v, mask, dropout_p, chunk_size):
+    """
+    F.scaled_dot_product_attention over chunks of chunk_size queries, so that even the
+    math fallback (e.g. on cpu) never holds more than [N, nhead, chunk_size, S] scores
+    """
+    L = q.shape[2]
+    if not chunk_size or L <= chunk_size:
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=dropout_p)
+
+    out = []
+    for start in range(0, L, chunk_size):
+        chunk_mask = mask if mask is None or mask.shape[2] == 1 else mask[:, :, start:start + chunk_size]
+        out.append(F.scaled_dot_product_attention(q[:, :, start:start + chunk_size], k, v,
+                                                  attn_mask=chunk_mask, dropout_p=dropout_p))
+    return torch.cat(out, 2)
+
+
+def _window_partition(x, grid, window_size, value=0.):
+    # [d * h * w, N, C] tokens to [N * num_windows, window volume, C], the grid is
+    # padded with value up to a multiple of window_size
+    d, h, w = grid
+    wd, wh, ww = window_size
+    N, C = x.shape[1], x.shape[2]
+    x = x.permute(1, 0, 2).reshape(N, d, h, w, C)
+    x = F.pad(x, (0, 0, 0, -w % ww, 0, -h % wh, 0, -d % wd), value=value)
+    D, H, W = x.shape[1] // wd, x.shape[2] // wh, x.shape[3] // ww
+    x = x.view(N, D, wd, H, wh, W, ww, C).permute(0, 1, 3, 5, 2, 4, 6, 7)
+    return x.reshape(N * D * H * W, wd * wh * ww, C)
+
+
+def _window_reverse(x, grid, window_size, N):
+    d, h, w = grid
+    wd, wh, ww = window_size
+    D, H, W = -(-d // wd), -(-h // wh), -(-w // ww)
+    C = x.shape[-1]
+    x = x.view(N, D, H, W, wd, wh, ww, C).permute(0, 1, 4, 2, 5, 3, 6, 7)
+    x = x.reshape(N, D * wd, H * wh, W * ww, C)[:, :d, :h, :w]
+    return x.reshape(N, d * h * w, C).permute(1, 0, 2)
+
+
+def _window_attention(q, k, v, mask, nhead, grid, window_size, dropout_p):
+    """
+    Every token only attends to the tokens of its window of the d x h x w grid,
+    the padding added to fill the border windows is masked out
+    """
+    if grid is None:
+        raise ValueError('window attention needs the grid shape of the tokens')
+    window_size = [min(s, g) for s, g in zip(window_size, grid)]
+    N = q.shape[1]
+
+    if mask is None:
+        mask = torch.zeros(N, k.shape[0], dtype=q.dtype, device=q.device)
+    window_mask = _window_partition(mask.t()[..., None], grid, window_size, float('-inf'))
+    window_mask = window_mask.view(len(window_mask), 1, 1, -1)
+
+    q, k, v = [_window_partition(x, grid, window_size).transpose(0, 1) for x in (q, k, v)]
+    q, k, v = [_split_heads(x, nhead) for x in (q, k, v)]
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=window_mask, dropout_p=dropout_p)
+    return _window_reverse(_merge_heads(out).transpose(0, 1), grid, window_size, N)
+
+
+def multihead_attention(attn, query, key, value, key_padding_mask=None, attn_mask=None,
+                        impl='sdpa', chunk_size=None, window_size=None, grid=None):
+    """
+    attn(query, key, value)[0] of an nn.MultiheadAttention attn, computed with impl
+    (see Transformer.set_attention_impl) from the in_proj / out_proj weights of attn.
+
+    query: [L, N, E], key, value: [S, N, E]
+    grid: (d, h, w) of the tokens, L == S == d * h * w, only needed by 'window'
+    """
+    if impl == 'mha':
+        return attn(query, key, value=value, attn_mask=attn_mask,
+                    key_padding_mask=key_padding_mask)[0]
+
+    nhead = attn.num_heads
+    L, N, E = query.shape
+    w_q, w_k, w_v = attn.in_proj_weight.chunk(3)
+    b_q, b_k, b_v = attn.in_proj_bias.chunk(3) if attn.in_proj_bias is not None else (None, None, None)
+    q, k, v = F.linear(query, w_q, b_q), F.linear(key, w_k, b_k), F.linear(value, w_v, b_v)
+    dropout_p = attn.dropout if attn.training else 0.0
+
+    mask = None if key_padding_mask is None else _additive_mask(key_padding_mask, q.dtype)
+    if impl == 'window':
+        if attn_mask is not None:
+            raise ValueError('window attention does not support attn_mask')
+        out = _window_attention(q, k, v, mask, nhead, grid, window_size, dropout_p)
+    else:
+        if mask is not None:
+            mask = mask[:, None, None, :]
+        if attn_mask is not None:
+            attn_mask = _additive_mask(attn_mask, q.dtype)
+            attn_mask = attn_mask[None, None] if attn_mask.dim() == 2 else attn_mask.view(N, nhead, L, -1)
+            mask = attn_mask if mask is None else mask + attn_mask
+        q, k, v = [_split_heads(x, nhead) for x in (q, k, v)]
+        out = _merge_heads(_chunked_attention(q, k, v, mask, dropout_p, chunk_size))
+
+    return attn.out_proj(out)
 
 
 def _get_clones(module, N):
@@ -312,6 +492,10 @@ def build_transformer(cfg):
         num_decoder_layers=cfg['dec_layers'],
         normalize_before=cfg['pre_norm'],
         return_intermediate_dec=True,
+        cache_size=cfg['shape_cache_size'],
+        attention_impl=cfg['attention_impl'],
+        attention_chunk_size=cfg['attention_chunk_size'],
+        attention_window_size=cfg['attention_window_size'],
     )
 
 
@@ -0,0 +1,97 @@
+import argparse
+import copy
+import os
+
+import torch
+
+from config import net_config, data_config, train_config
+from dataset.bbox_reader import BboxReader
+from export_model import load_model
+from net.export import time_module
+from net.quantization import QUANTIZATION_MODES, quantize_model, model_size_mb
+
+parser = argparse.ArgumentParser(description='Calibrate and quantize TiCNet for cpu inference')
+parser.add_argument("--weight", type=str, default=train_config['initial_checkpoint'],
+                    help="path to model weights to be quantized")
+parser.add_argument("--mode", type=str, default='static', choices=QUANTIZATION_MODES,
+                    help="dynamic: Linear layers only, static: also the calibrated Conv3d/BN blocks")
+parser.add_argument("--test_set_name", type=str, default=train_config['test_set_name'],
+                    help="path to the image list used for calibration and evaluation")
+parser.add_argument("--calib-scans", type=int, default=4,
+                    help="number of preprocessed scans used for calibration")
+parser.add_argument("--out", type=str, default=os.path.join('models', 'quantized.pth'),
+                    help="path to save the quantized model")
+parser.add_argument("--threads", type=int, default=os.cpu_count(),
+                    help="number of torch threads used for the latency measurement")
+parser.add_argument("--benchmark", type=int, default=3,
+                    help="number of runs to compare fp32 vs int8 latency on one tile, 0 to skip")
+parser.add_argument("--eval", action='store_true',
+                    help="run the FROC evaluation of the fp32 and int8 models on cpu, the FROC score is the "
+                         "average sensitivity at 0.125, 0.25, 0.5, 1, 2, 4 and 8 false positives per scan")
+parser.add_argument("--out-dir", type=str, default=os.path.join(train_config['out_dir'], 'quantized'),
+                    help="path to save the evaluation results")
+
+
+def make_calibration(dataset, num_scans):
+    def calibrate(net):
+        for i in range(min(num_scans, len(dataset))):
+            print(f'[calibrate] scan {i + 1}/{num_scans}: {dataset.filenames[i]}')
+            net.forward_tiled(dataset[i][0].unsqueeze(0))
+
+    return calibrate
+
+
+def main():
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    model = load_model(args.weight, 'cpu')
+    dataset = BboxReader(data_config['preprocessed_data_dir'], args.test_set_name, net_config, mode='eval')
+
+    quantized = quantize_model(copy.deepcopy(model), args.mode, make_calibration(dataset, args.calib_scans))
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    torch.save({'mode': args.mode, 'weight': args.weight, 'state_dict': quantized.state_dict()}, args.out)
+    print(f'Saved {args.mode} quantized model to {args.out}')
+
+    fp32_mb, int8_mb = model_size_mb(model), model_size_mb(quantized)
+    print(f'[size] fp32 {fp32_mb:.1f} MB, int8 {int8_mb:.1f} MB, saving {1 - int8_mb / fp32_mb:.1%}')
+
+    if args.benchmark > 0:
+        inputs = torch.randn(1, 1, *net_config['tile_size'])
+        fp32_ms = time_module(lambda x: model.forward(x, [None], [None]), inputs, repeat=args.benchmark)
+        int8_ms = time_module(lambda x: quantized.forward(x, [None], [None]), inputs, repeat=args.benchmark)
+        print(f'[latency] fp32 {fp32_ms:.1f} ms, int8 {int8_ms:.1f} ms, speedup {fp32_ms / int8_ms:.2f}x')
+
+    if args.eval:
+        from test import eval as evaluate
+        from evaluationScript.noduleCADEvaluationLUNA16 import noduleFROCScore, FROC_points
+
+        recall, froc = {}, {}
+        for name, net in [('fp32', model), ('int8', quantized)]:
+            save_dir = os.path.join(args.out_dir, name)
+            os.makedirs(os.path.join(save_dir, 'FROC'), exist_ok=True)
+            true_positives, total_nodules = evaluate(net, dataset, save_dir, tiled=True)
+            if true_positives is not None and total_nodules:
+                recall[name] = true_positives / total_nodules
+
+            froc_dir = os.path.join(save_dir, 'FROC', 'score')
+            os.makedirs(froc_dir, exist_ok=True)
+            sensitivities, score = noduleFROCScore('annotations/new_annotations.csv',
+                                                   'annotations/new_annotations_excluded.csv', dataset.set_name,
+                                                   os.path.join(save_dir, 'FROC', 'submission_ensemble.csv'),
+                                                   froc_dir)
+            if score is not None:
+                froc[name] = score
+                print(f'[FROC] {name} sensitivity at ' +
+                      ', '.join(f'{fp} FP/scan: {s:.4f}' for fp, s in zip(FROC_points, sensitivities)))
+
+        for label, values in [('recall', recall), ('FROC', froc)]:
+            if len(values) == 2:
+                print(f'[{label}] fp32 {values["fp32"]:.4f}, int8 {values["int8"]:.4f}, '
+                      f'delta {values["int8"] - values["fp32"]:+.4f}')
+            else:
+                print(f'[{label}] noduleCADEvaluation did not return a result')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,28 @@
 # TiCNet 肺结节检测系统
-__version__ = "1.0.0" 
\ No newline at end of file
+__version__ = "1.0.0"
+
+import importlib
+
+# 延迟导入：只有在首次访问时才导入对应模块，避免启动时加载torch、matplotlib、reportlab等
+_LAZY_ATTRS = {
+    'SystemConfig': '.config',
+    'ModelInference': '.model_inference',
+    'ModelLoader': '.model_loader',
+    'InferenceWorkerPool': '.worker_pool',
+    'BatchScheduler': '.batch_scheduler',
+    'ResultVisualizer': '.visualization',
+    'ResultValidator': '.result_validator',
+    'ReportGenerator': '.report_generator',
+    'AIAnalyzer': '.ai_analyzer',
+    'AnnotationHandler': '.annotation_handler',
+}
+
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
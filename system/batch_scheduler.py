@@ -0,0 +1,136 @@
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class BatchScheduler:
+    """
+    动态微批调度器：并发请求在各自的线程中完成预处理，按输入形状放入不同的桶；
+    一个桶凑满max_batch_size个请求，或其中最早的请求已等待batch_window_ms毫秒时，
+    整个桶作为一个batch前向，再把每个图像的检测结果分发回各自的请求
+
+    代价: 单独到达的请求最多多等待batch_window_ms毫秒；所有请求由同一个调度线程
+    依次前向，并发的请求不再各自并行推理，只有同形状的请求能合并时吞吐才会提高
+    """
+
+    def __init__(self, model_inference, window_ms=None, max_batch_size=None, metrics_size=1000):
+        inference_config = model_inference.config.INFERENCE_CONFIG
+        self.model_inference = model_inference
+        self.window = (inference_config.get('batch_window_ms', 50) if window_ms is None else window_ms) / 1000.
+        self.max_batch_size = max_batch_size or inference_config.get('max_batch_size', 4)
+        self.logger = logging.getLogger('BatchScheduler')
+
+        self._buckets = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+        # 最近metrics_size个请求/batch的排队时间和batch填充率
+        self._waits = collections.deque(maxlen=metrics_size)
+        self._fills = collections.deque(maxlen=metrics_size)
+        self._num_requests = 0
+        self._num_batches = 0
+
+    def start(self):
+        """启动调度线程，重复调用不会重复启动"""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+                self._thread.start()
+        return self
+
+    def submit(self, image_path, task_id):
+        """在调用线程中预处理图像，放入对应形状的桶，返回Future"""
+        self.start()
+        image_tensor, meta_info = self.model_inference._preprocess_image(image_path)
+
+        future = Future()
+        request = {'image_path': image_path, 'task_id': task_id, 'image_tensor': image_tensor,
+                   'meta_info': meta_info, 'future': future, 'enqueued': time.time()}
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError("微批调度器已关闭")
+            self._buckets.setdefault(tuple(image_tensor.shape[1:]), []).append(request)
+            self._num_requests += 1
+            self._cond.notify()
+        return future
+
+    def predict(self, image_path, task_id, timeout=None):
+        """与ModelInference.predict相同，可能与其他并发请求合并为一个batch"""
+        return self.submit(image_path, task_id).result(timeout)
+
+    def _next_batch(self):
+        """等待直到某个桶凑满或其最早的请求超过等待窗口，取出该桶中最多max_batch_size个请求"""
+        with self._cond:
+            while not self._stopping:
+                now = time.time()
+                deadline = None
+                for shape, requests in self._buckets.items():
+                    if len(requests) >= self.max_batch_size or requests[0]['enqueued'] + self.window <= now:
+                        batch = requests[:self.max_batch_size]
+                        del requests[:self.max_batch_size]
+                        if not requests:
+                            del self._buckets[shape]
+                        return batch
+                    oldest = requests[0]['enqueued'] + self.window
+                    deadline = oldest if deadline is None else min(deadline, oldest)
+
+                self._cond.wait(None if deadline is None else deadline - now)
+        return None
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+
+            batch_start = time.time()
+            with self._cond:
+                self._waits.extend(batch_start - r['enqueued'] for r in batch)
+                self._fills.append(len(batch) / self.max_batch_size)
+                self._num_batches += 1
+
+            try:
+                outputs = self.model_inference.forward_batch([r['image_tensor'] for r in batch])
+                inference_time = (time.time() - batch_start) / len(batch)
+                for request, output in zip(batch, outputs):
+                    request['future'].set_result(self.model_inference.build_result(
+                        request['image_path'], request['task_id'], output, request['meta_info'], inference_time))
+            except Exception as e:
+                self.logger.error(f"微批推理失败: {str(e)}")
+                for request in batch:
+                    if not request['future'].done():
+                        request['future'].set_exception(e)
+
+    def metrics(self):
+        """排队等待时间(毫秒)和batch填充率 (batch大小 / max_batch_size)"""
+        # 调度线程在锁外追加记录，复制时持锁避免deque在迭代中被修改
+        with self._cond:
+            waits = np.array(self._waits) * 1000
+            fills = np.array(self._fills)
+            queued = sum(len(requests) for requests in self._buckets.values())
+
+        return {
+            'requests': self._num_requests,
+            'batches': self._num_batches,
+            'queued': queued,
+            'window_ms': self.window * 1000,
+            'max_batch_size': self.max_batch_size,
+            'queue_wait_ms_mean': float(waits.mean()) if len(waits) else 0.0,
+            'queue_wait_ms_p95': float(np.percentile(waits, 95)) if len(waits) else 0.0,
+            'batch_fill_ratio_mean': float(fills.mean()) if len(fills) else 0.0,
+        }
+
+    def shutdown(self):
+        """停止调度线程，尚未执行的请求失败"""
+        with self._cond:
+            self._stopping = True
+            pending = [r for requests in self._buckets.values() for r in requests]
+            self._buckets.clear()
+            self._cond.notify_all()
+        for request in pending:
+            request['future'].set_exception(RuntimeError("微批调度器已关闭"))
@@ -1,5 +1,4 @@
 import os
-import torch
 from pathlib import Path
 
 class SystemConfig:
@@ -27,10 +26,29 @@ class SystemConfig:
         self.MODEL_CONFIG = {
             'model_path': trained_model_path if trained_model_path.exists() else fallback_model_path,
             'config_path': self.BASE_DIR / 'config.py',
-            'device': 'cuda' if torch.cuda.is_available() else 'cpu',
+            'device': None,  # None: 首次调用get_device()时自动选择cuda/cpu，避免启动时导入torch
             'batch_size': 1,
             'num_workers': 2,
-            'trained_model_available': trained_model_path.exists()
+            'trained_model_available': trained_model_path.exists(),
+            # export_model.py --format weights导出的推理权重(不含优化器状态)，存在时以内存映射方式加载，
+            # 多个worker进程共享同一份权重
+            'inference_weights_path': self.MODELS_FOLDER / 'inference_weights.pth',
+            # 推理后端: 'pytorch' (eager，存在预编译模型时使用TorchScript) 或 'onnx' (ONNX Runtime CPU)
+            'backend': 'pytorch',
+            # export_model.py导出的预编译FeatureNet+RpnHead，存在时加载，否则使用eager模式
+            'compiled_model_dir': self.MODELS_FOLDER / 'compiled',
+            # export_model.py --format onnx导出的ONNX模型
+            'onnx_model_dir': self.MODELS_FOLDER / 'onnx',
+            'onnx_intra_op_threads': os.cpu_count(),
+            # CPU量化推理: None, 'dynamic' (仅Linear层) 或 'static' (quantize.py校准得到的Conv3d/BN + Linear)
+            'quantization': None,
+            'quantized_model_path': self.MODELS_FOLDER / 'quantized.pth',
+            # 推理前把BatchNorm折叠进卷积、去掉dropout (net/fuse.py)，折叠后的卷积权重为进程私有副本，
+            # 不再与其他worker共享内存映射的推理权重
+            'fuse_modules': True,
+            # 后台加载模型后在虚拟体积上预热一次；请求等待模型就绪的最长时间(秒)
+            'warmup': True,
+            'load_timeout': 600
         }
         
         # 推理配置
@@ -40,7 +58,26 @@ class SystemConfig:
             'max_detections': 100,
             'crop_size': [128, 128, 128],
             'stride': 4,
-            'auto_convert_mhd_to_nrrd': True  # 自动将MHD转换为NRRD
+            'auto_convert_mhd_to_nrrd': True,  # 自动将MHD转换为NRRD
+            'precision': 'fp32',  # 'fp32' 或 'bf16' (CPU/GPU均支持，减少大体积CT的显存和延迟)
+            # 分块全分辨率推理：按原始分辨率切分为重叠子体积，逐批推理后用NMS合并
+            'tiled_inference': True,
+            'max_stride': 16,
+            'tile_size': [128, 128, 128],  # 需为max_stride的整数倍
+            'tile_overlap': 32,
+            'tile_batch_size': 2,  # 每次送入模型的子体积数量，决定峰值显存
+            'max_batch_size': 4,  # predict_batch和微批调度中同一形状的图像每次前向的最大数量
+            # 动态微批: 并发上传的请求在batch_window_ms毫秒内按形状合并为一个batch前向。
+            # 单个请求最多多等待batch_window_ms毫秒，且所有推理串行经过调度线程，
+            # 只在同形状的并发请求较多时开启
+            'micro_batching': False,
+            'batch_window_ms': 50,
+            # 推理进程池: 0表示在Flask进程内推理；K>0时启动K个模型副本进程，请求经共享队列分发
+            'pool_workers': 0,
+            'pool_devices': None,  # 副本设备列表，如['cuda:0', 'cuda:1']；None: 有GPU时轮流分配，否则为cpu
+            'pool_threads_per_worker': None,  # 每个副本的CPU线程数，None: 可用CPU核数 // pool_workers
+            'pool_pin_cpus': True,  # 每个副本绑定一组连续的CPU核，多socket机器上避免跨socket访存
+            'pool_max_restarts': 3  # 副本崩溃后的最大重启次数
         }
         
         # 可视化配置
@@ -88,10 +125,13 @@ class SystemConfig:
     
     def get_device(self):
         """获取计算设备"""
+        if self.MODEL_CONFIG['device'] is None:
+            self.MODEL_CONFIG['device'] = 'cuda' if self.is_cuda_available() else 'cpu'
         return self.MODEL_CONFIG['device']
     
     def is_cuda_available(self):
         """检查CUDA是否可用"""
+        import torch
         return torch.cuda.is_available()
     
     def get_upload_path(self, filename):
@@ -111,7 +151,7 @@ class SystemConfig:
         return f"""
 TiCNet系统配置:
 - 基础目录: {self.BASE_DIR}
-- 计算设备: {self.MODEL_CONFIG['device']}
+- 计算设备: {self.get_device()}
 - CUDA可用: {self.is_cuda_available()}
 - 上传目录: {self.UPLOAD_FOLDER}
 - 结果目录: {self.RESULTS_FOLDER}
@@ -13,8 +13,11 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 from net.main_net import build_model
+from net.export import CompiledBackbone, OnnxBackbone, OnnxRcnnHead
+from net.quantization import quantize_model, load_quantized
+from net.fuse import fuse_for_inference
 from config import net_config
-from .utils import normalize, load_medical_image, preprocess_for_model, calculate_volume
+from .utils import normalize, load_medical_image, preprocess_for_model, preprocess_for_tiled_inference, calculate_volume
 from .annotation_handler import AnnotationHandler
 
 class ModelInference:
@@ -57,50 +60,48 @@ class ModelInference:
             
             # 检查是否有预训练权重
             model_path = self.config.get_model_path()
-            if os.path.exists(model_path):
-                self.logger.info(f"✅ 找到训练好的模型权重: {model_path}")
-                
-                # 检查文件大小
-                file_size = os.path.getsize(model_path) / (1024 * 1024)  # MB
-                self.logger.info(f"模型文件大小: {file_size:.1f} MB")
-                
-                try:
-                    checkpoint = torch.load(model_path, map_location=self.device)
-                    
-                    if 'state_dict' in checkpoint:
-                        self.model.load_state_dict(checkpoint['state_dict'])
-                        epoch = checkpoint.get('epoch', 'unknown')
-                        self.logger.info(f"✅ 成功加载训练权重 (epoch: {epoch})")
-                        
-                        # 显示额外的训练信息
-                        if 'best_loss' in checkpoint:
-                            self.logger.info(f"最佳损失: {checkpoint['best_loss']:.4f}")
-                        if 'lr' in checkpoint:
-                            self.logger.info(f"学习率: {checkpoint['lr']}")
-                            
-                    else:
-                        self.model.load_state_dict(checkpoint)
-                        self.logger.info("✅ 成功加载模型权重")
-                        
-                    # 标记使用了训练权重
-                    self.using_trained_weights = True
-                    
-                except Exception as e:
-                    self.logger.error(f"❌ 加载模型权重失败: {str(e)}")
-                    self.logger.warning("将使用随机初始化权重")
-                    self.using_trained_weights = False
-                    
+            inference_weights = self.config.MODEL_CONFIG.get('inference_weights_path')
+            if inference_weights and os.path.exists(str(inference_weights)):
+                if not self._load_inference_weights(str(inference_weights)):
+                    # 推理权重损坏时改用训练权重，两者都无法加载则加载失败，不能用随机权重提供服务
+                    if not os.path.exists(model_path):
+                        raise RuntimeError(f"推理权重加载失败且未找到模型权重文件: {model_path}")
+                    self.logger.warning(f"改为加载训练权重: {model_path}")
+                    self._load_checkpoint(model_path, required=True)
+            elif os.path.exists(model_path):
+                self._load_checkpoint(model_path)
             else:
                 self.logger.warning(f"⚠️  未找到模型权重文件: {model_path}")
                 self.logger.info("使用随机初始化的权重 (仅用于演示)")
                 self.using_trained_weights = False
             
+            # 量化模型只能在CPU上运行
+            if self.config.MODEL_CONFIG.get('quantization'):
+                self._quantize_model()
+            elif self.config.MODEL_CONFIG.get('fuse_modules', True):
+                self.model = fuse_for_inference(self.model)
+                self.logger.info("已将BatchNorm折叠进卷积层")
+
             # 移动模型到指定设备
             self.model = self.model.to(self.device)
-            self.model.eval()
+            self.model.set_mode('eval')
             
             # 设置推理模式的关键属性
             self.model.use_rcnn = True  # 启用RCNN用于更好的检测结果
+
+            # bf16推理: 主干网络和检测头使用autocast，框解码和NMS保持fp32
+            if self.config.INFERENCE_CONFIG.get('precision', 'fp32') == 'bf16':
+                self.model.inference_dtype = torch.bfloat16
+                self.logger.info("已启用bf16推理")
+
+            # 按MODEL_CONFIG['backend']加载推理后端，量化模型直接使用PyTorch
+            backend = self.config.MODEL_CONFIG.get('backend', 'pytorch')
+            if self.config.MODEL_CONFIG.get('quantization'):
+                self.logger.info("量化推理不使用预编译/ONNX后端")
+            elif backend == 'onnx':
+                self._load_onnx_backend()
+            else:
+                self._load_compiled_backbone()
             
             self.logger.info("模型加载完成")
             
@@ -109,6 +110,123 @@ class ModelInference:
             traceback.print_exc()
             raise
     
+    def _load_checkpoint(self, model_path, required=False):
+        """加载训练得到的模型权重；required为True时加载失败直接抛出异常，否则使用随机初始化权重"""
+        self.logger.info(f"✅ 找到训练好的模型权重: {model_path}")
+
+        # 检查文件大小
+        file_size = os.path.getsize(model_path) / (1024 * 1024)  # MB
+        self.logger.info(f"模型文件大小: {file_size:.1f} MB")
+
+        try:
+            checkpoint = torch.load(model_path, map_location=self.device)
+
+            if 'state_dict' in checkpoint:
+                self.model.load_state_dict(checkpoint['state_dict'])
+                epoch = checkpoint.get('epoch', 'unknown')
+                self.logger.info(f"✅ 成功加载训练权重 (epoch: {epoch})")
+
+                # 显示额外的训练信息
+                if 'best_loss' in checkpoint:
+                    self.logger.info(f"最佳损失: {checkpoint['best_loss']:.4f}")
+                if 'lr' in checkpoint:
+                    self.logger.info(f"学习率: {checkpoint['lr']}")
+
+            else:
+                self.model.load_state_dict(checkpoint)
+                self.logger.info("✅ 成功加载模型权重")
+
+            # 标记使用了训练权重
+            self.using_trained_weights = True
+
+        except Exception as e:
+            self.logger.error(f"❌ 加载模型权重失败: {str(e)}")
+            if required:
+                raise
+            self.logger.warning("将使用随机初始化权重")
+            self.using_trained_weights = False
+
+    def _load_inference_weights(self, path):
+        """以内存映射方式加载export_model.py --format weights导出的推理权重，
+        参数直接使用映射的存储，同一主机上的多个worker共享页缓存中的同一份权重。
+        返回是否加载成功"""
+        try:
+            checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+            self.model.load_state_dict(checkpoint['state_dict'], assign=True)
+        except Exception as e:
+            self.logger.error(f"❌ 加载推理权重失败: {str(e)}")
+            return False
+
+        self.using_trained_weights = True
+        self.logger.info(f"✅ 已内存映射加载推理权重: {path} "
+                         f"(来源: {checkpoint.get('weight', 'unknown')}, epoch: {checkpoint.get('epoch', 'unknown')})")
+        return True
+
+    def _quantize_model(self):
+        """按MODEL_CONFIG['quantization']加载INT8量化模型，失败时使用FP32模型"""
+        mode = self.config.MODEL_CONFIG['quantization']
+        try:
+            if mode == 'static':
+                path = self.config.MODEL_CONFIG.get('quantized_model_path')
+                if not path or not os.path.exists(str(path)):
+                    self.logger.warning("未找到静态量化模型 (请先运行quantize.py校准)，使用FP32模型")
+                    return
+                checkpoint = torch.load(str(path), map_location='cpu')
+                model = load_quantized(build_model(net_config), checkpoint)
+            else:
+                model = quantize_model(self.model, mode)
+
+            self.model = model
+            if str(self.device) != 'cpu':
+                self.logger.info("量化模型只支持CPU，推理设备切换为CPU")
+                self.device = 'cpu'
+            self.logger.info(f"✅ 已启用INT8量化推理 ({mode})")
+        except Exception as e:
+            self.logger.warning(f"量化模型失败，使用FP32模型: {str(e)}")
+
+    def _load_compiled_backbone(self):
+        """加载export_model.py导出的预编译FeatureNet+RpnHead，失败时回退到eager模式"""
+        compiled_dir = self.config.MODEL_CONFIG.get('compiled_model_dir')
+        if not compiled_dir or not os.path.exists(os.path.join(str(compiled_dir), 'manifest.json')):
+            self.logger.info("未找到预编译模型，使用eager模式推理")
+            return
+
+        try:
+            runner = CompiledBackbone.load(str(compiled_dir), self.device)
+            if runner.weight and os.path.abspath(runner.weight) != os.path.abspath(self.config.get_model_path()):
+                self.logger.warning(f"预编译模型来自不同的权重文件 ({runner.weight})，使用eager模式推理")
+                return
+
+            self.model.backbone_runner = runner
+            shapes = ', '.join('x'.join(str(s) for s in shape) for shape in runner.shapes())
+            self.logger.info(f"✅ 已加载预编译模型，输入形状: {shapes}")
+        except Exception as e:
+            self.logger.warning(f"加载预编译模型失败，使用eager模式推理: {str(e)}")
+
+    def _load_onnx_backend(self):
+        """加载export_model.py --format onnx导出的模型，由ONNX Runtime在CPU上运行FeatureNet+RpnHead和RcnnHead，
+        rpn_nms/rcnn_nms后处理仍在Python中完成；失败时回退到PyTorch"""
+        onnx_dir = self.config.MODEL_CONFIG.get('onnx_model_dir')
+        if not onnx_dir or not os.path.exists(os.path.join(str(onnx_dir), 'manifest.json')):
+            self.logger.warning("未找到ONNX模型，使用PyTorch推理")
+            return
+
+        try:
+            threads = self.config.MODEL_CONFIG.get('onnx_intra_op_threads')
+            backbone = OnnxBackbone.load(str(onnx_dir), threads)
+            if backbone.weight and os.path.abspath(backbone.weight) != os.path.abspath(self.config.get_model_path()):
+                self.logger.warning(f"ONNX模型来自不同的权重文件 ({backbone.weight})，使用PyTorch推理")
+                return
+
+            self.model.backbone_runner = backbone
+            self.model.rcnn_runner = OnnxRcnnHead.load(str(onnx_dir), threads)
+            shapes = ', '.join('x'.join(str(s) for s in shape) for shape in backbone.shapes())
+            self.logger.info(f"✅ 已加载ONNX Runtime后端 (intra-op线程数: {threads})，输入形状: {shapes}")
+        except Exception as e:
+            self.model.backbone_runner = None
+            self.model.rcnn_runner = None
+            self.logger.warning(f"加载ONNX模型失败，使用PyTorch推理: {str(e)}")
+
     def _preprocess_image(self, image_path: str) -> Tuple[torch.Tensor, Dict[str, Any]]:
         """预处理输入图像"""
         try:
@@ -121,8 +239,13 @@ class ModelInference:
             image_array, meta_info = load_medical_image(image_path, auto_convert_to_nrrd=auto_convert)
             
             # 使用系统工具函数预处理图像
-            target_size = tuple(self.config.INFERENCE_CONFIG['crop_size'])
-            image_tensor = preprocess_for_model(image_array, target_size)
+            if self.config.INFERENCE_CONFIG.get('tiled_inference', False):
+                # 分块推理保持原始分辨率，只填充到max_stride的整数倍
+                image_tensor = preprocess_for_tiled_inference(
+                    image_array, self.config.INFERENCE_CONFIG['max_stride'])
+            else:
+                target_size = tuple(self.config.INFERENCE_CONFIG['crop_size'])
+                image_tensor = preprocess_for_model(image_array, target_size)
             
             self.logger.info(f"图像预处理完成，形状: {image_tensor.shape}")
             return image_tensor, meta_info
@@ -278,6 +401,37 @@ class ModelInference:
         """计算结节体积"""
         return calculate_volume(bbox, spacing)
     
+    def warmup(self):
+        """在虚拟体积上运行一次前向，提前完成CUDA/cuDNN初始化和形状缓存，使首个请求不承担这些开销"""
+        tiled = self.config.INFERENCE_CONFIG.get('tiled_inference', False)
+        size = self.config.INFERENCE_CONFIG['tile_size' if tiled else 'crop_size']
+        dummy = torch.zeros((1, 1) + tuple(size))
+        if not tiled:
+            dummy = dummy.to(self.device)
+
+        start_time = time.time()
+        self._forward(dummy)
+        if str(self.device).startswith('cuda'):
+            torch.cuda.synchronize()
+        self.logger.info(f"模型预热完成，输入形状: {list(dummy.shape)}，用时: {time.time() - start_time:.2f}秒")
+
+    def _forward(self, image_tensor: torch.Tensor) -> Tuple[np.ndarray, np.ndarray, np.ndarray, tuple]:
+        """
+        运行模型，返回rpn_proposals、detections、ensemble_proposals (第0列为batch索引) 和各阶段候选框数量。
+        MainNet.infer不在模型上保存任何请求状态，多个Flask线程可以共享同一个模型实例
+        """
+        tiled = self.config.INFERENCE_CONFIG.get('tiled_inference', False)
+        result = self.model.infer(
+            image_tensor,
+            tiled=tiled,
+            tile_size=self.config.INFERENCE_CONFIG.get('tile_size'),
+            tile_overlap=self.config.INFERENCE_CONFIG.get('tile_overlap'),
+            tile_batch_size=self.config.INFERENCE_CONFIG.get('tile_batch_size')
+        )
+
+        return (result.rpn_proposals.cpu().numpy(), result.detections.cpu().numpy(),
+                result.ensemble_proposals.cpu().numpy(), result.proposal_stats)
+
     def predict(self, image_path: str, task_id: str) -> Dict[str, Any]:
         """对单个图像进行预测"""
         start_time = time.time()
@@ -287,83 +441,51 @@ class ModelInference:
             
             # 预处理图像
             image_tensor, meta_info = self._preprocess_image(image_path)
-            image_tensor = image_tensor.to(self.device)
+            tiled = self.config.INFERENCE_CONFIG.get('tiled_inference', False)
+            if not tiled:
+                # 分块推理时整幅图像留在CPU上，只把当前批次的子体积移动到设备
+                image_tensor = image_tensor.to(self.device)
             
-            # 模型推理
-            with torch.no_grad():
-                self.logger.info("正在进行模型推理...")
-                
-                # 设置模型为评估模式
-                self.model.set_mode('eval')
+            # 模型推理，模型在加载时已设置为评估模式，请求之间不修改模型状态
+            self.logger.info("正在进行模型推理...")
+
+            # 调用模型，评估模式下不使用truth数据
+            try:
+                rpn_raw, detections_raw, ensemble_raw, proposal_stats = self._forward(image_tensor)
                 
-                # 获取真实的truth数据用于推理
-                batch_size = image_tensor.shape[0]
-                device = image_tensor.device
+                # 调试：打印原始模型输出
+                if len(ensemble_raw) > 0:
+                    self.logger.info(f"Ensemble原始输出形状: {ensemble_raw.shape}")
+                    self.logger.info(f"Ensemble前3个样本: {ensemble_raw[:3] if len(ensemble_raw) >= 3 else ensemble_raw}")
+                if len(detections_raw) > 0:
+                    self.logger.info(f"Detections原始输出形状: {detections_raw.shape}")
+                    self.logger.info(f"Detections前3个样本: {detections_raw[:3] if len(detections_raw) >= 3 else detections_raw}")
                 
-                # 从注解文件获取truth数据
-                truth_boxes_list = []
-                truth_labels_list = []
+                model_output = {
+                    'rpn_proposals': rpn_raw,
+                    'detections': detections_raw,
+                    'ensemble_proposals': ensemble_raw
+                }
                 
-                for i in range(batch_size):
-                    # 获取该图像的truth数据
-                    truth_boxes, truth_labels = self.annotation_handler.get_truth_data_for_image(
-                        image_path, 
-                        meta_info['spacing'], 
-                        meta_info['origin'],
-                        meta_info['original_shape']
-                    )
-                    
-                    # 转换为torch张量
-                    if truth_boxes:
-                        truth_boxes_tensor = torch.tensor(truth_boxes, dtype=torch.float32, device=device)
-                        truth_labels_tensor = torch.tensor(truth_labels, dtype=torch.long, device=device)
-                    else:
-                        # 如果没有真实标注，使用空张量
-                        truth_boxes_tensor = torch.zeros((0, 6), dtype=torch.float32, device=device)
-                        truth_labels_tensor = torch.zeros((0,), dtype=torch.long, device=device)
-                    
-                    truth_boxes_list.append(truth_boxes_tensor)
-                    truth_labels_list.append(truth_labels_tensor)
+                self.logger.info(f"模型推理完成")
+                self.logger.info(f"RPN提议数量: {len(model_output['rpn_proposals'])}")
+                self.logger.info(f"RCNN检测数量: {len(model_output['detections'])}")
+                self.logger.info(f"集成结果数量: {len(model_output['ensemble_proposals'])}")
+                for stats in proposal_stats:
+                    self.logger.info(f"候选框各阶段数量: {stats}")
+                for name, stats in self.model.cache_stats().items():
+                    self.logger.debug(f"形状缓存 {name}: 命中率 {stats['hit_rate']:.2%}, 条目数 {stats['size']}")
                 
-                # 调用模型
-                try:
-                    # TiCNet的forward方法没有返回值，结果保存在模型属性中
-                    self.model.forward(image_tensor, truth_boxes_list, truth_labels_list)
-                    
-                    # 从模型属性中获取检测结果
-                    rpn_raw = self.model.rpn_proposals.cpu().numpy() if hasattr(self.model, 'rpn_proposals') and self.model.rpn_proposals is not None else np.array([])
-                    detections_raw = self.model.detections.cpu().numpy() if hasattr(self.model, 'detections') and self.model.detections is not None else np.array([])
-                    ensemble_raw = self.model.ensemble_proposals.cpu().numpy() if hasattr(self.model, 'ensemble_proposals') and self.model.ensemble_proposals is not None else np.array([])
-                    
-                    # 调试：打印原始模型输出
-                    if len(ensemble_raw) > 0:
-                        self.logger.info(f"Ensemble原始输出形状: {ensemble_raw.shape}")
-                        self.logger.info(f"Ensemble前3个样本: {ensemble_raw[:3] if len(ensemble_raw) >= 3 else ensemble_raw}")
-                    if len(detections_raw) > 0:
-                        self.logger.info(f"Detections原始输出形状: {detections_raw.shape}")
-                        self.logger.info(f"Detections前3个样本: {detections_raw[:3] if len(detections_raw) >= 3 else detections_raw}")
-                    
-                    model_output = {
-                        'rpn_proposals': rpn_raw,
-                        'detections': detections_raw,
-                        'ensemble_proposals': ensemble_raw
-                    }
-                    
-                    self.logger.info(f"模型推理完成")
-                    self.logger.info(f"RPN提议数量: {len(model_output['rpn_proposals'])}")
-                    self.logger.info(f"RCNN检测数量: {len(model_output['detections'])}")
-                    self.logger.info(f"集成结果数量: {len(model_output['ensemble_proposals'])}")
-                    
-                except Exception as e:
-                    self.logger.error(f"模型推理失败: {str(e)}")
-                    traceback.print_exc()
-                    # 返回空结果
-                    model_output = {
-                        'rpn_proposals': np.array([]),
-                        'detections': np.array([]),
-                        'ensemble_proposals': np.array([])
-                    }
-            
+            except Exception as e:
+                self.logger.error(f"模型推理失败: {str(e)}")
+                traceback.print_exc()
+                # 返回空结果
+                model_output = {
+                    'rpn_proposals': np.array([]),
+                    'detections': np.array([]),
+                    'ensemble_proposals': np.array([])
+                }
+        
             # 后处理
             detections = self._postprocess_detections(model_output, meta_info)
             
@@ -394,6 +516,90 @@ class ModelInference:
             traceback.print_exc()
             raise
     
+    def predict_batch(self, image_paths: List[str], task_ids: List[str] = None) -> List[Dict[str, Any]]:
+        """
+        批量预测多个图像：预处理后按输入形状分组，同一组最多max_batch_size个图像一次前向，
+        再按batch索引拆分检测结果，每个图像的结果与predict相同
+        """
+        start_time = time.time()
+        task_ids = task_ids or [os.path.splitext(os.path.basename(p))[0] for p in image_paths]
+        max_batch_size = self.config.INFERENCE_CONFIG.get('max_batch_size', 4)
+
+        self.logger.info(f"开始批量处理 {len(image_paths)} 个图像")
+
+        # 预处理并按形状分组
+        images, buckets = [], {}
+        for i, image_path in enumerate(image_paths):
+            image_tensor, meta_info = self._preprocess_image(image_path)
+            images.append((image_tensor, meta_info))
+            buckets.setdefault(tuple(image_tensor.shape[1:]), []).append(i)
+
+        outputs = [None] * len(image_paths)
+        inference_times = [0.0] * len(image_paths)
+        for shape, indices in buckets.items():
+            for start in range(0, len(indices), max_batch_size):
+                batch = indices[start:start + max_batch_size]
+                batch_start = time.time()
+                split = self.forward_batch([images[i][0] for i in batch])
+                for i, output in zip(batch, split):
+                    outputs[i] = output
+                    inference_times[i] = (time.time() - batch_start) / len(batch)
+
+        results = [self.build_result(image_path, task_id, outputs[i], images[i][1], inference_times[i])
+                   for i, (image_path, task_id) in enumerate(zip(image_paths, task_ids))]
+
+        self.logger.info(f"批量处理完成，共 {len(image_paths)} 个图像，分组数 {len(buckets)}，"
+                         f"总时间: {time.time() - start_time:.2f}秒")
+        return results
+
+    def forward_batch(self, image_tensors: List[torch.Tensor]) -> List[Dict[str, np.ndarray]]:
+        """
+        同一形状的多个预处理后图像一次前向，按batch索引拆分检测结果，索引重置为0，与单图像predict的输出一致
+        """
+        image_tensor = torch.cat(image_tensors, 0)
+        if not self.config.INFERENCE_CONFIG.get('tiled_inference', False):
+            image_tensor = image_tensor.to(self.device)
+
+        self.logger.info(f"批量推理: 输入形状 {list(image_tensor.shape[1:])}, 图像数 {len(image_tensors)}")
+        try:
+            raws = self._forward(image_tensor)[:3]
+        except Exception as e:
+            self.logger.error(f"批量推理失败: {str(e)}")
+            traceback.print_exc()
+            raws = (np.array([]), np.array([]), np.array([]))
+
+        outputs = []
+        for b in range(len(image_tensors)):
+            split = []
+            for raw in raws:
+                if len(raw) == 0:
+                    split.append(np.array([]))
+                    continue
+                r = raw[raw[:, 0] == b].copy()
+                r[:, 0] = 0
+                split.append(r)
+            outputs.append(dict(zip(['rpn_proposals', 'detections', 'ensemble_proposals'], split)))
+
+        return outputs
+
+    def build_result(self, image_path: str, task_id: str, output: Dict[str, np.ndarray],
+                     meta_info: Dict, inference_time: float) -> Dict[str, Any]:
+        """由一个图像的模型输出生成与predict相同格式的结果"""
+        detections = self._postprocess_detections(output, meta_info)
+        return {
+            'task_id': task_id,
+            'image_path': image_path,
+            'detections': detections,
+            'statistics': self._calculate_statistics(detections, meta_info),
+            'meta_info': meta_info,
+            'inference_time': inference_time,
+            'model_info': {
+                'name': 'TiCNet',
+                'device': self.device,
+                'confidence_threshold': self.config.INFERENCE_CONFIG['min_confidence']
+            }
+        }
+
     def _calculate_statistics(self, detections: List[Dict], meta_info: Dict) -> Dict[str, Any]:
         """计算检测统计信息"""
         if not detections:
@@ -0,0 +1,67 @@
+import threading
+import time
+import logging
+import traceback
+
+
+class ModelLoader:
+    """在后台线程中加载模型并预热，Web服务启动时不必等待模型加载完成"""
+
+    def __init__(self, config, warmup=True):
+        self.config = config
+        self.warmup = warmup
+        self.logger = logging.getLogger('ModelLoader')
+
+        self.model_inference = None
+        self.error = None
+        self.load_time = None
+        self.ready = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._started_at = None
+
+    def start(self):
+        """启动后台加载线程，重复调用不会重复加载"""
+        with self._lock:
+            if self._thread is None:
+                self._started_at = time.time()
+                self._thread = threading.Thread(target=self._load, name='model-loader', daemon=True)
+                self._thread.start()
+        return self
+
+    def _load(self):
+        try:
+            # 在后台线程中才导入torch和模型代码
+            from .model_inference import ModelInference
+
+            model_inference = ModelInference(self.config)
+            if self.warmup:
+                model_inference.warmup()
+
+            self.model_inference = model_inference
+            self.load_time = time.time() - self._started_at
+            self.logger.info(f"模型已就绪，加载和预热用时: {self.load_time:.2f}秒")
+        except Exception as e:
+            self.error = str(e)
+            self.logger.error(f"后台加载模型失败: {self.error}")
+            traceback.print_exc()
+        finally:
+            self.ready.set()
+
+    @property
+    def status(self):
+        """'not_started'、'loading'、'ready' 或 'failed'"""
+        if self._thread is None:
+            return 'not_started'
+        if not self.ready.is_set():
+            return 'loading'
+        return 'failed' if self.error else 'ready'
+
+    def get(self, timeout=None):
+        """等待模型加载完成并返回ModelInference"""
+        self.start()
+        if not self.ready.wait(timeout):
+            raise TimeoutError("模型仍在加载中，请稍后重试")
+        if self.error:
+            raise RuntimeError(f"模型加载失败: {self.error}")
+        return self.model_inference
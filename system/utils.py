@@ -245,6 +245,25 @@ def preprocess_for_model(image: np.ndarray, target_size: Tuple[int, int, int] =
     
     return image_tensor
 
+def preprocess_for_tiled_inference(image: np.ndarray, factor: int = 16) -> torch.Tensor:
+    """为分块推理预处理图像
+
+    保持原始分辨率，只在每个维度的末尾填充到factor(max_stride)的整数倍，
+    因此检测结果的坐标与原始图像体素坐标一致
+    """
+    # 归一化
+    image = normalize(image)
+
+    # 末尾填充到factor的整数倍
+    pad = [(0, int(np.ceil(s / float(factor))) * factor - s) for s in image.shape]
+    image = np.pad(image, pad, mode='constant', constant_values=-1)
+
+    # 转换为PyTorch张量
+    image_tensor = torch.from_numpy(image.astype(np.float32))
+    image_tensor = image_tensor.unsqueeze(0).unsqueeze(0)  # 添加batch和channel维度
+
+    return image_tensor
+
 def calculate_volume(bbox: list, spacing: Tuple[float, float, float]) -> float:
     """计算结节体积（以mm³为单位）"""
     try:
@@ -0,0 +1,257 @@
+import collections
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+
+
+def _worker_main(worker_id, config, device, cpus, num_threads, warmup, requests, results):
+    """副本进程入口：绑定CPU核和线程数、选择设备，加载模型后不断从自己的请求队列中取请求"""
+    try:
+        if cpus and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        # 必须在导入torch之前设置，OpenMP线程池只在初始化时读取
+        os.environ['OMP_NUM_THREADS'] = str(num_threads)
+        os.environ['MKL_NUM_THREADS'] = str(num_threads)
+
+        import torch
+        torch.set_num_threads(num_threads)
+        if device == 'auto':
+            count = torch.cuda.device_count()
+            device = f'cuda:{worker_id % count}' if count else 'cpu'
+        config.MODEL_CONFIG['device'] = device
+        config.MODEL_CONFIG['onnx_intra_op_threads'] = num_threads
+
+        from .model_inference import ModelInference
+        model_inference = ModelInference(config)
+        if warmup:
+            model_inference.warmup()
+    except Exception:
+        results.put(('failed', worker_id, None, traceback.format_exc()))
+        return
+
+    results.put(('ready', worker_id, None, device))
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+
+        request_id, method, args = request
+        try:
+            results.put(('done', worker_id, request_id, getattr(model_inference, method)(*args)))
+        except Exception:
+            results.put(('error', worker_id, request_id, traceback.format_exc()))
+
+
+class InferenceWorkerPool:
+    """
+    推理进程池：启动K个模型副本进程，每个副本绑定一个设备和一组CPU核(线程预算)。
+    请求先在主进程中排队，由主进程分配给空闲的副本，结果通过Future返回；
+    请求在交给副本之前就记录在该副本名下，副本崩溃时其正在处理的请求一定会失败，
+    并在max_restarts次以内自动重启该副本
+    """
+
+    def __init__(self, config, num_workers=None, devices=None, threads_per_worker=None,
+                 pin_cpus=None, max_restarts=None, warmup=None):
+        inference_config = config.INFERENCE_CONFIG
+        self.config = config
+        self.num_workers = num_workers or inference_config.get('pool_workers') or 1
+        self.max_restarts = inference_config.get('pool_max_restarts', 3) if max_restarts is None else max_restarts
+        self.warmup = config.MODEL_CONFIG.get('warmup', True) if warmup is None else warmup
+        self.logger = logging.getLogger('InferenceWorkerPool')
+
+        # None: 每个副本在子进程中自动选择，有GPU时按GPU轮流分配，否则使用cpu
+        devices = devices or inference_config.get('pool_devices') or [config.MODEL_CONFIG['device'] or 'auto']
+        self.devices = [devices[k % len(devices)] for k in range(self.num_workers)]
+
+        # 按副本平均划分CPU核，连续的核通常位于同一个socket
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        threads_per_worker = threads_per_worker or inference_config.get('pool_threads_per_worker')
+        self.threads_per_worker = threads_per_worker or max(1, len(cpus) // self.num_workers)
+        pin_cpus = inference_config.get('pool_pin_cpus', True) if pin_cpus is None else pin_cpus
+        t = self.threads_per_worker
+        self.cpus = [cpus[k * t:(k + 1) * t] if pin_cpus and (k + 1) * t <= len(cpus) else None
+                     for k in range(self.num_workers)]
+
+        # spawn: CUDA不能在fork出的子进程中使用
+        self._ctx = mp.get_context('spawn')
+        self._results = self._ctx.Queue()
+        self._pending = collections.deque()
+        self._futures = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._collector = None
+        self._stopping = False
+
+    def start(self):
+        """启动所有副本进程和结果收集线程，重复调用不会重复启动"""
+        with self._lock:
+            if self._collector is not None:
+                return self
+            for k in range(self.num_workers):
+                self._workers.append({'restarts': 0, 'served': 0})
+                self._start_worker(k)
+            self._collector = threading.Thread(target=self._collect, name='inference-pool', daemon=True)
+            self._collector.start()
+        return self
+
+    def _start_worker(self, k):
+        worker = self._workers[k]
+        # 每个副本一个请求队列，重启时换新的，不会取到崩溃前残留的请求
+        worker['requests'] = self._ctx.Queue()
+        worker['current'] = None
+        worker['status'] = 'loading'
+        worker['device'] = self.devices[k]
+        worker['process'] = self._ctx.Process(
+            target=_worker_main, name=f'inference-worker-{k}', daemon=True,
+            args=(k, self.config, self.devices[k], self.cpus[k], self.threads_per_worker, self.warmup,
+                  worker['requests'], self._results))
+        worker['process'].start()
+        self.logger.info(f"推理副本{k}已启动，设备: {self.devices[k]}，CPU核: {self.cpus[k]}，"
+                         f"线程数: {self.threads_per_worker}，pid: {worker['process'].pid}")
+
+    def _resolve(self, request_id, result=None, error=None):
+        with self._lock:
+            future = self._futures.pop(request_id, None)
+        if future is None:
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _dispatch(self):
+        """把排队的请求分配给空闲的就绪副本，先记录在副本名下再放入其队列"""
+        with self._lock:
+            for worker in self._workers:
+                if not self._pending:
+                    break
+                if worker['status'] == 'ready' and worker['current'] is None:
+                    request = self._pending.popleft()
+                    worker['current'] = request[0]
+                    worker['requests'].put(request)
+
+    def _collect(self):
+        """收集副本返回的结果，并检查副本进程是否崩溃"""
+        while not self._stopping:
+            try:
+                kind, k, request_id, payload = self._results.get(timeout=0.5)
+            except queue.Empty:
+                kind = None
+
+            if kind == 'ready':
+                with self._lock:
+                    self._workers[k]['status'] = 'ready'
+                self._workers[k]['device'] = payload
+                self.logger.info(f"推理副本{k}已就绪，设备: {payload}")
+            elif kind == 'failed':
+                self._workers[k]['status'] = 'failed'
+                self._workers[k]['error'] = payload
+                self.logger.error(f"推理副本{k}加载模型失败:\n{payload}")
+            elif kind == 'done':
+                self._workers[k]['served'] += 1
+                self._release(k, request_id)
+                self._resolve(request_id, result=payload)
+            elif kind == 'error':
+                self._release(k, request_id)
+                self._resolve(request_id, error=RuntimeError(payload))
+
+            self._check_workers()
+            self._dispatch()
+
+    def _release(self, k, request_id):
+        with self._lock:
+            if self._workers[k]['current'] == request_id:
+                self._workers[k]['current'] = None
+
+    def _check_workers(self):
+        for k, worker in enumerate(self._workers):
+            if self._stopping or worker['status'] in ['failed', 'dead'] or worker['process'].is_alive():
+                continue
+
+            if worker['process'].exitcode == 0:
+                # 正常退出只发生在模型加载失败时，重启也无济于事
+                worker['status'] = 'failed'
+                continue
+
+            with self._lock:
+                request_id, worker['current'] = worker['current'], None
+            self.logger.error(f"推理副本{k}异常退出，退出码: {worker['process'].exitcode}")
+            if request_id is not None:
+                self._resolve(request_id, error=RuntimeError(f"推理副本{k}在处理请求时崩溃"))
+
+            if worker['restarts'] < self.max_restarts:
+                worker['restarts'] += 1
+                self.logger.info(f"重启推理副本{k} ({worker['restarts']}/{self.max_restarts})")
+                self._start_worker(k)
+            else:
+                worker['status'] = 'dead'
+
+        # 没有可用副本时，排队的请求不会再被处理
+        if self._workers and all(w['status'] in ['failed', 'dead'] for w in self._workers):
+            with self._lock:
+                self._pending.clear()
+                pending = list(self._futures)
+            for request_id in pending:
+                self._resolve(request_id, error=RuntimeError("没有可用的推理副本"))
+
+    def submit(self, method, *args):
+        """把ModelInference.<method>(*args)放入排队，有空闲副本时立即分配，返回Future"""
+        self.start()
+        if self.status == 'failed':
+            raise RuntimeError("没有可用的推理副本")
+
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._futures[request_id] = future
+            self._pending.append((request_id, method, args))
+        self._dispatch()
+        return future
+
+    def predict(self, image_path, task_id, timeout=None):
+        """与ModelInference.predict相同，由任意一个空闲副本执行"""
+        return self.submit('predict', image_path, task_id).result(timeout)
+
+    @property
+    def status(self):
+        """'not_started'、'loading'、'ready' (至少一个副本就绪) 或 'failed' (所有副本均不可用)"""
+        statuses = [w['status'] for w in self._workers]
+        if not statuses:
+            return 'not_started'
+        if 'ready' in statuses:
+            return 'ready'
+        if all(s in ['failed', 'dead'] for s in statuses):
+            return 'failed'
+        return 'loading'
+
+    def stats(self):
+        """每个副本的设备、CPU核、状态、重启次数和已处理请求数"""
+        return [{'worker': k, 'device': w['device'], 'cpus': self.cpus[k], 'status': w['status'],
+                 'pid': w['process'].pid, 'restarts': w['restarts'], 'served': w['served'],
+                 'busy': w['current'] is not None}
+                for k, w in enumerate(self._workers)]
+
+    def shutdown(self, timeout=10):
+        """通知所有副本退出，超时后强制结束，未完成的请求失败"""
+        self._stopping = True
+        for worker in self._workers:
+            worker['requests'].put(None)
+
+        deadline = time.time() + timeout
+        for worker in self._workers:
+            worker['process'].join(max(0.0, deadline - time.time()))
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+
+        with self._lock:
+            self._pending.clear()
+            pending = list(self._futures)
+        for request_id in pending:
+            self._resolve(request_id, error=RuntimeError("推理进程池已关闭"))
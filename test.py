@@ -29,6 +29,10 @@ parser.add_argument("--out-dir", type=str, default=train_config['out_dir'],
                     help="path to save the results")
 parser.add_argument("--test_set_name", type=str, default=train_config['test_set_name'],
                     help="path to test image list")
+parser.add_argument("--tiled", action='store_true',
+                    help="run full-resolution inference on overlapping tiles of net_config['tile_size']")
+parser.add_argument("--bf16", action='store_true',
+                    help="autocast the backbone and heads to bfloat16, box decoding and nms stay in fp32")
 
 def main():
     logging.basicConfig(
@@ -42,6 +46,8 @@ def main():
     initial_checkpoint = args.weight
     model = build_model(net_config)
     model = model.cuda()
+    if args.bf16:
+        model.inference_dtype = torch.bfloat16
 
     if initial_checkpoint:
         print(f'Loading model from {initial_checkpoint}...')
@@ -60,9 +66,9 @@ def main():
     sys.stdout = Logger(logfile)
 
     dataset = BboxReader(data_dir, test_set_name, net_config, mode='eval')
-    eval(model, dataset, save_dir)
+    eval(model, dataset, save_dir, tiled=args.tiled)
 
-def eval(net, dataset, save_dir=None):
+def eval(net, dataset, save_dir=None, tiled=False):
     net.use_rcnn = True
     net.set_mode('eval')
     rpn_res = []
@@ -77,8 +83,13 @@ def eval(net, dataset, save_dir=None):
             print(f'CT图像的pid: {pid}, CT图像的形状:{image.shape}\n')
 
             with torch.no_grad():
-                input = input.cuda().unsqueeze(0)
-                net.forward(input, truth_bboxes, truth_labels)
+                if tiled:
+                    # Keep the whole volume on cpu, tiles are moved to gpu batch by batch
+                    input = input.unsqueeze(0)
+                    net.forward_tiled(input)
+                else:
+                    input = input.cuda().unsqueeze(0)
+                    net.forward(input, truth_bboxes, truth_labels)
 
             rpns = net.rpn_proposals.cpu().numpy()
             rcnns = net.detections.cpu().numpy()
@@ -172,6 +183,8 @@ def eval(net, dataset, save_dir=None):
                         'annotations/new_annotations_excluded.csv',
                         dataset.set_name, ensemble_submission_path, os.path.join(eval_dir, 'ensemble'))
 
+    return true_positives, total_nodules
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试NMS：tensor_nms、sweep_nms与py_nms保留的框一致
+"""
+
+import sys
+import traceback
+
+import numpy as np
+import torch
+
+from net.layer.util import tensor_nms, batched_tensor_nms
+from net.lib.box.nms.sweep_nms import sweep_nms
+from utils.util import py_nms
+
+
+def synthetic_dets(num_boxes, seed=0, size=128):
+    """成簇的候选框 [p, z, y, x, d, h, w]"""
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(0, size, size=(max(num_boxes // 20, 1), 3))
+    cluster = rng.randint(0, len(centers), num_boxes)
+    sizes = rng.uniform(4, 30, size=(len(centers), 1))[cluster] * rng.uniform(0.8, 1.2, size=(num_boxes, 3))
+    center = centers[cluster] + rng.normal(scale=0.2, size=(num_boxes, 3)) * sizes
+    scores = rng.uniform(0, 1, size=(num_boxes, 1))
+    return np.concatenate([scores, center, sizes], 1).astype(np.float32)
+
+
+def devices():
+    return ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+def test_tensor_nms_parity():
+    """tensor_nms与py_nms保留相同的框"""
+    for num_boxes in [1, 50, 1000]:
+        for thresh in [0.1, 0.5]:
+            dets = synthetic_dets(num_boxes, seed=num_boxes)
+            _, reference = py_nms(dets, thresh)
+            for device in devices():
+                x = torch.from_numpy(dets).to(device)
+                keep = tensor_nms(x[:, 1:7], x[:, 0], thresh).cpu()
+                assert keep.tolist() == reference.tolist(), \
+                    f"{num_boxes}个框, thresh {thresh}, {device}: 与py_nms不一致"
+    print("✅ tensor_nms与py_nms一致")
+
+
+def test_batched_tensor_nms():
+    """batched_tensor_nms等于逐组的tensor_nms"""
+    dets = synthetic_dets(600, seed=1)
+    groups = torch.from_numpy(np.random.RandomState(1).randint(0, 3, len(dets)))
+    for device in devices():
+        x = torch.from_numpy(dets).to(device)
+        keep = batched_tensor_nms(x[:, 1:7], x[:, 0], groups.to(device), 0.1).cpu()
+        expected = []
+        for g in range(3):
+            index = torch.nonzero(groups == g).view(-1)
+            expected += index[tensor_nms(x[index.to(device), 1:7], x[index.to(device), 0], 0.1).cpu()].tolist()
+        assert keep.tolist() == expected, f"{device}: 分组结果不一致"
+    print("✅ batched_tensor_nms与逐组结果一致")
+
+
+def reference_soft_nms(dets, thresh, method, sigma=0.5, score_thresh=0.001):
+    """逐个框的Soft-NMS参考实现"""
+    scores = dets[:, 0].astype(np.float64).copy()
+    boxes = dets[:, 1:7].astype(np.float64)
+    alive = list(range(len(dets)))
+    keep = []
+    while alive:
+        k = max(alive, key=lambda i: scores[i])
+        if scores[k] < score_thresh:
+            break
+        keep.append(k)
+        alive.remove(k)
+        for i in alive:
+            start = np.maximum(boxes[k, :3] - boxes[k, 3:] / 2., boxes[i, :3] - boxes[i, 3:] / 2.)
+            end = np.minimum(boxes[k, :3] + boxes[k, 3:] / 2., boxes[i, :3] + boxes[i, 3:] / 2.)
+            intersect = np.prod(np.maximum(0.0, end - start))
+            iou = intersect / (np.prod(boxes[k, 3:]) + np.prod(boxes[i, 3:]) - intersect)
+            if method == 'soft_linear':
+                scores[i] *= 1 - iou if iou > thresh else 1.0
+            else:
+                scores[i] *= np.exp(-iou ** 2 / sigma)
+    return keep, scores[keep]
+
+
+def test_sweep_nms_parity():
+    """sweep_nms hard与py_nms一致，wbf保留相同的框，soft与逐框的参考实现一致"""
+    for num_boxes in [1, 50, 1000]:
+        for thresh in [0.1, 0.5]:
+            dets = synthetic_dets(num_boxes, seed=num_boxes)
+            _, reference = py_nms(dets, thresh)
+            for method in ['hard', 'wbf']:
+                out, keep = sweep_nms(dets, thresh, method)
+                assert keep.tolist() == reference.tolist(), f"{num_boxes}个框, thresh {thresh}, {method}: 与py_nms不一致"
+                assert np.array_equal(out[:, 0], dets[keep, 0]), f"{method}: 分数被修改"
+
+    dets = synthetic_dets(200, seed=2)
+    for method in ['soft_linear', 'soft_gaussian']:
+        out, keep = sweep_nms(dets, 0.3, method)
+        reference, scores = reference_soft_nms(dets, 0.3, method)
+        assert keep.tolist() == reference, f"{method}: 保留的框与参考实现不一致"
+        assert np.allclose(out[:, 0], scores, atol=1e-6), f"{method}: 衰减后的分数与参考实现不一致"
+    print("✅ sweep_nms与py_nms / 参考实现一致")
+
+
+def test_sweep_nms_tensor():
+    """sweep_nms接受cpu tensor，并保留额外的列"""
+    dets = synthetic_dets(300, seed=3)
+    dets = np.concatenate([dets, np.arange(len(dets), dtype=np.float32)[:, None]], 1)
+    out, keep = sweep_nms(torch.from_numpy(dets), 0.1)
+    assert isinstance(out, torch.Tensor) and isinstance(keep, torch.Tensor)
+    assert out[:, 7].long().tolist() == keep.tolist(), "额外的列没有随框保留"
+    assert len(sweep_nms(torch.from_numpy(dets[:0]), 0.1)[1]) == 0
+    print("✅ sweep_nms的tensor输入正常")
+
+
+def main():
+    tests = [
+        ("tensor_nms与py_nms一致", test_tensor_nms_parity),
+        ("batched_tensor_nms分组", test_batched_tensor_nms),
+        ("sweep_nms与py_nms一致", test_sweep_nms_parity),
+        ("sweep_nms的tensor输入", test_sweep_nms_tensor),
+    ]
+
+    results = []
+    for name, test in tests:
+        print(f"\n测试: {name}")
+        try:
+            test()
+            results.append((name, True))
+        except Exception:
+            traceback.print_exc()
+            results.append((name, False))
+
+    print("\n" + "=" * 60)
+    for name, result in results:
+        print(f"{'✅ 通过' if result else '❌ 失败'} - {name}")
+    passed = sum(1 for _, result in results if result)
+    print(f"总计: {passed}/{len(results)} 项测试通过")
+    return 0 if passed == len(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())